@@ -1,5 +1,6 @@
 from django.contrib import admin
 from h5pp.models import *
+from h5pp.h5p.h5pcache import getLibraryCache
 
 class LibrariesAdmin(admin.ModelAdmin):
 	list_display = ('title', 'library_id')
@@ -7,6 +8,14 @@ class LibrariesAdmin(admin.ModelAdmin):
 	readonly_fields = ('library_id', 'major_version', 'minor_version', 'patch_version')
 	exclude = ('restricted', 'runnable')
 
+	def save_model(self, request, obj, form, change):
+		super(LibrariesAdmin, self).save_model(request, obj, form, change)
+		getLibraryCache().invalidate()
+
+	def delete_model(self, request, obj):
+		super(LibrariesAdmin, self).delete_model(request, obj)
+		getLibraryCache().invalidate()
+
 admin.site.register(h5p_libraries, LibrariesAdmin)
 
 class LibrariesLanguageAdmin(admin.ModelAdmin):
@@ -20,7 +29,11 @@ class ContentsAdmin(admin.ModelAdmin):
 	list_display = ('title', 'author', 'content_type')
 	ordering = ('title', 'author')
 	readonly_fields = ('content_id', 'main_library_id')
-	exclude = ('disable',)
+	exclude = ('disable', 'render_bundle')
+
+	def save_model(self, request, obj, form, change):
+		obj.render_bundle = ''
+		super(ContentsAdmin, self).save_model(request, obj, form, change)
 
 admin.site.register(h5p_contents, ContentsAdmin)
 
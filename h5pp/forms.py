@@ -4,25 +4,21 @@ from h5pp.models import h5p_libraries
 from h5pp.h5p.h5pclasses import H5PDjango
 from h5pp.h5p.h5pmodule import h5pInsert, h5pGetContent
 from h5pp.h5p.editor.h5peditormodule import createContent
+from h5pp.h5p.h5pjobs import enqueueJob
+from h5pp.h5p.h5pupload import H5PUploadSession
 import json
-import os
 
 ##
-# Function who handle uploading h5p file
+# Function who handle uploading h5p file. The file is staged in a folder
+# of its own, which the caller removes with cleanup().
 ##
 
 
 def handleUploadedFile(files, filename):
-    tmpdir = os.path.join(settings.MEDIA_ROOT, 'h5pp', 'tmp')
+    upload = H5PUploadSession()
+    upload.saveUploadedFile(files, filename)
 
-    if not os.path.exists(tmpdir):
-        os.makedirs(tmpdir)
-
-    with open(os.path.join(tmpdir, filename), 'wb+') as destination:
-        for chunk in files.chunks():
-            destination.write(chunk)
-
-    return {'folderPath': tmpdir, 'path': os.path.join(tmpdir, filename)}
+    return upload
 
 ##
 # Form for upload/update h5p libraries
@@ -49,17 +45,18 @@ class LibrariesForm(forms.Form):
                 raise forms.ValidationError(
                     'Too many choices selected.')
             interface = H5PDjango(self.user)
-            paths = handleUploadedFile(h5pfile, h5pfile.name)
-            validator = interface.h5pGetInstance(
-                'validator', paths['folderPath'], paths['path'])
-
-            if not validator.isValidPackage(True, False):
-                raise forms.ValidationError(
-                    'The uploaded file was not a valid h5p package.')
+            upload = handleUploadedFile(h5pfile, h5pfile.name)
+            try:
+                validator = interface.h5pGetInstance('validator')
+                if not validator.isValidPackage(True, False, upload):
+                    raise forms.ValidationError(
+                        'The uploaded file was not a valid h5p package.')
 
-            storage = interface.h5pGetInstance('storage')
-            if not storage.savePackage(None, None, True):
-                raise forms.ValidationError('Error during library save.')
+                storage = interface.h5pGetInstance('storage')
+                if not storage.savePackage(None, None, True, dict(), upload):
+                    raise forms.ValidationError('Error during library save.')
+            finally:
+                upload.cleanup()
         elif down != False:
             if unins != False:
                 raise forms.ValidationError(
@@ -108,18 +105,19 @@ class CreateForm(forms.Form):
                     'You need to choose a valid h5p package.')
 
             interface = H5PDjango(self.request.user)
-            paths = handleUploadedFile(h5pfile, h5pfile.name)
-            validator = interface.h5pGetInstance(
-                'validator', paths['folderPath'], paths['path'])
-
-            if not validator.isValidPackage(False, False):
-                raise forms.ValidationError(
-                    'The uploaded file was not a valid h5p package.')
-
-            self.request.POST['h5p_upload'] = paths['path']
-            self.request.POST['h5p_upload_folder'] = paths['folderPath']
-            if not h5pInsert(self.request, interface):
-                raise forms.ValidationError('Error during saving the content.')
+            upload = handleUploadedFile(h5pfile, h5pfile.name)
+            try:
+                validator = interface.h5pGetInstance('validator')
+                if not validator.isValidPackage(False, False, upload):
+                    raise forms.ValidationError(
+                        'The uploaded file was not a valid h5p package.')
+
+                self.request.POST['h5p_upload'] = upload.path
+                self.request.POST['h5p_upload_folder'] = upload.folderPath
+                if not h5pInsert(self.request, interface, upload):
+                    raise forms.ValidationError('Error during saving the content.')
+            finally:
+                upload.cleanup()
         else:
             interface = H5PDjango(self.request.user)
             core = interface.h5pGetInstance('core')
@@ -153,6 +151,8 @@ class CreateForm(forms.Form):
                 if not createContent(self.request, content, params):
                     raise forms.ValidationError(
                         'Impossible to create the content')
+                enqueueJob('filter', content['id'])
+                enqueueJob('images', content['id'])
 
                 return content['id']
 
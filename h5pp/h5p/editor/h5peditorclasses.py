@@ -148,15 +148,13 @@ class H5PDjangoEditor:
 
         # Order dependencies by weight
         orderedDependencies = collections.OrderedDict()
-        for i in range(1, len(dependencies) + 1):
-            for key, dependency in dependencies.iteritems():
-                if dependency['weight'] == i and dependency['type'] == 'editor':
-                    # Only load editor libraries
-                    dependency['library']['id'] = dependency[
-                        'library']['library_id']
-                    orderedDependencies[dependency['library'][
-                        'library_id']] = dependency['library']
-                    break
+        for dependency in sorted(dependencies.itervalues(), key=lambda dependency: dependency['weight']):
+            if dependency['type'] == 'editor':
+                # Only load editor libraries
+                dependency['library']['id'] = dependency[
+                    'library']['library_id']
+                orderedDependencies[dependency['library'][
+                    'library_id']] = dependency['library']
 
         return orderedDependencies
 
@@ -263,7 +261,7 @@ class H5PDjangoEditor:
                 1), matches.group(4), matches.group(5))
             dest = os.path.join(self.contentDirectory, matches.group(5))
             if os.path.exists(source) and not os.path.exists(dest):
-                shutil.copy(source, dest)
+                self.h5p.fs.copyFile(source, dest)
 
             params['path'] = matches.group(5)
         else:
@@ -271,7 +269,7 @@ class H5PDjangoEditor:
             newPath = os.path.join(
                 self.basePath, self.contentDirectory, params['path'])
             if not os.path.exists(newPath) and os.path.exists(oldPath):
-                shutil.copy(oldPath, newPath)
+                self.h5p.fs.copyFile(oldPath, newPath)
 
         files.append(params['path'])
 
@@ -3,8 +3,9 @@
 ##
 from django.conf import settings
 from h5pp.models import h5p_content_user_data, h5p_libraries, h5p_points
-from h5pp.h5p.h5pmodule import h5pAddCoreAssets, h5pAddFilesAndSettings
+from h5pp.h5p.h5pmodule import h5pAddCoreAssets, h5pAddFilesAndSettings, h5pUpsert
 from h5pp.h5p.h5pclasses import H5PDjango
+from h5pp.h5p.h5pupload import getChunkSize
 import shutil
 import time
 import json
@@ -86,7 +87,9 @@ def h5peditorContent(request, contentId=None):
         'libraryPath': settings.BASE_URL + settings.STATIC_URL + 'h5p/h5peditor/',
         'copyrightSemantics': contentValidator.getCopyrightSemantics(),
         'assets': assets,
-        'contentRelUrl': '../media/h5pp/content/'
+        'contentRelUrl': '../media/h5pp/content/',
+        # Larger files are uploaded in parts, see H5PChunkedUpload
+        'uploadChunkSize': getChunkSize()
     }
 
     return {'editor': json.dumps(editor), 'coreAssets': coreAssets, 'assets': assets, 'add': add}
@@ -156,31 +159,17 @@ def getUserData(contentId, subContentId, dataId, userId):
 
 
 def saveUserData(contentId, subContentId, dataId, preload, invalidate, data, userId):
-    update = getUserData(contentId, subContentId, dataId, userId)
-
-    preload = 0 if preload == '0' else 1
-    invalidate = 0 if invalidate == '0' else 1
-
-    if not update:
-        h5p_content_user_data.objects.create(
-            user_id=userId,
-            content_main_id=contentId,
-            sub_content_id=subContentId,
-            data_id=dataId,
-            timestamp=time.time(),
-            data=data,
-            preloaded=preload,
-            delete_on_content_change=invalidate
-        )
-    else:
-        update.user_id = userId
-        update.content_main_id = contentId
-        update.sub_content_id = subContentId
-        update.data_id = dataId
-        update.data = data
-        update.preloaded = preload
-        update.delete_on_content_change = invalidate
-        update.save()
+    h5pUpsert(h5p_content_user_data, {
+        'user_id': userId,
+        'content_main_id': contentId,
+        'sub_content_id': subContentId,
+        'data_id': dataId
+    }, {
+        'timestamp': int(time.time()),
+        'data': data,
+        'preloaded': 0 if preload == '0' else 1,
+        'delete_on_content_change': 0 if invalidate == '0' else 1
+    })
 
 ##
 # Delete user data with specific content from database
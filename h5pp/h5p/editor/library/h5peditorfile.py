@@ -1,5 +1,6 @@
 from django.conf import settings
-from PIL import Image
+from h5pp.h5p.library.h5pmediaprobe import probeMedia
+import StringIO
 import json
 import uuid
 import os
@@ -8,13 +9,12 @@ import re
 
 class H5PEditorFile:
 
-    global name
-    name = None
-
     ##
     # Constructor. Process data for file uploaded through the editor
     ##
     def __init__(self, request, files, framework):
+        self.name = None
+        self.result = None
         if not 'field' in request.POST or request.POST['field'] == None:
             return
 
@@ -24,7 +24,6 @@ class H5PEditorFile:
         self.result = dict()
         self.field = json.loads(field)
         self.files = files['file']
-        self.path = os.path.join(settings.MEDIA_ROOT, 'h5pp', 'tmp', self.files.name)
 
         # Check if uploaded base64 encoded file
         if 'dataURI' in request.POST and request.POST['dataURI'] != '':
@@ -98,20 +97,12 @@ class H5PEditorFile:
                 print('Invalid image file format. Use jpg, png or gif')
                 return False
 
-            # Get image size from base64 string
-            if 'data' in locals() or 'data' in globals():
-                image = Image.open(self.data)
-            else:
-                with open(self.path, 'w+') as f:
-                    f.write(self.files.read())
-                # Image size from tmp file
-                image = Image.open(self.path)
-
-            if not image:
+            media = self.probe()
+            if media == None or not media['format'] in ('png', 'jpeg', 'gif'):
                 print('File is not an image')
                 return False
 
-            self.result['width'], self.result['height'] = image.size
+            self.result['width'], self.result['height'] = media['width'], media['height']
             self.result['mime'] = self.typ
 
         elif self.field['type'] == 'audio':
@@ -126,6 +117,12 @@ class H5PEditorFile:
                 print('Invalid audio file format. Use mp3 or wav')
                 return False
 
+            media = self.probe()
+            if media == None or not media['format'] in ('mp3', 'wav', 'ogg'):
+                print('File is not an audio file')
+                return False
+
+            self.addMediaResult(media, ['duration', 'codecs'])
             self.result['mime'] = self.typ
 
         elif self.field['type'] == 'video':
@@ -138,6 +135,12 @@ class H5PEditorFile:
                 print('Invalid video file format. Use mp4 or webm')
                 return False
 
+            media = self.probe()
+            if media == None or not media['format'] in ('mp4', 'webm', 'ogg'):
+                print('File is not a video')
+                return False
+
+            self.addMediaResult(media, ['width', 'height', 'duration', 'codecs'])
             self.result['mime'] = self.typ
 
         elif self.field['type'] == 'file':
@@ -149,6 +152,21 @@ class H5PEditorFile:
 
         return True
 
+    ##
+    # Read the size, duration and codecs from the headers of the file,
+    # without reading the whole file
+    ##
+    def probe(self):
+        if hasattr(self, 'data'):
+            return probeMedia(StringIO.StringIO(self.data))
+
+        return probeMedia(self.files)
+
+    def addMediaResult(self, media, keys):
+        for key in keys:
+            if key in media:
+                self.result[key] = media[key]
+
     ##
     # Get the type of the current file
     ##
@@ -159,19 +177,18 @@ class H5PEditorFile:
     # Get the name of the current file
     ##
     def getName(self):
-        global name
-        if name == None:
-            name = str(uuid.uuid1())
+        if self.name == None:
+            self.name = str(uuid.uuid1())
 
             # Add extension to name
             if 'data' in locals() or 'data' in globals():
-                name = name + self.extension
+                self.name = self.name + self.extension
             else:
                 matches = re.search('(?i)([a-z0-9]{1,})$', self.files.name)
                 if matches.group(1):
-                    name = name + '.' + matches.group(1)
+                    self.name = self.name + '.' + matches.group(1)
 
-        return name
+        return self.name
 
     def getFile(self):
         return self.files
@@ -186,7 +203,6 @@ class H5PEditorFile:
     # Print result from file processing
     ##
     def printResult(self):
-        global name
         self.result['path'] = self.getType() + 's/' + self.getName()
-        name = None
+        self.name = None
         return json.dumps(self.result)
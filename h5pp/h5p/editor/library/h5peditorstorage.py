@@ -1,8 +1,8 @@
 ##
 # Handles all communication with the database
 ##
-from django.db import connection
 from h5pp.models import h5p_libraries
+from h5pp.h5p.h5pqueries import fetchAll
 
 
 class H5PEditorStorage:
@@ -41,15 +41,8 @@ class H5PEditorStorage:
     ##
     def getLanguage(self, machineName, majorVersion, minorVersion, language):
         # Load translation field from DB
-        cursor = connection.cursor()
-        cursor.execute("""
-			SELECT hlt.language_json
-			FROM h5p_libraries_languages hlt
-			JOIN h5p_libraries hl ON hl.library_id = hlt.library_id
-			WHERE hl.machine_name = %s AND hl.major_version = %s AND hl.minor_version = %s AND hlt.language_code = %s
-			""" % ("'" + machineName + "'", majorVersion, minorVersion, "'" + language + "'"))
-
-        result = self.dictfetchall(cursor)
+        result = fetchAll('libraryLanguage', [
+                          machineName, majorVersion, minorVersion, language])
         return result[0]['language_json'] if len(result) > 0 else False
 
     ##
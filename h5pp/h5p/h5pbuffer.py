@@ -0,0 +1,99 @@
+##
+# Write-behind buffer for values that can be persisted a bit later
+##
+from django.db import close_old_connections
+import threading
+import atexit
+import time
+
+
+class H5PWriteBuffer:
+
+    ##
+    # Constructor for the H5PWriteBuffer
+    #
+    # writer is called with a dict of the pending values each time the buffer
+    # is flushed. Values wait at most maxStaleness seconds, and the buffer is
+    # flushed right away when it holds maxSize values.
+    ##
+    def __init__(self, writer, maxStaleness=5, maxSize=1000):
+        self.writer = writer
+        self.maxStaleness = maxStaleness
+        self.maxSize = maxSize
+        self.pending = dict()
+        self.lock = threading.Lock()
+        self.thread = None
+
+    ##
+    # Buffer a value, replacing the pending value of the same key
+    ##
+    def put(self, key, value):
+        with self.lock:
+            self.pending[key] = value
+            full = len(self.pending) >= self.maxSize
+
+        self.start()
+        if full:
+            self.flush()
+
+    ##
+    # Get the pending value of a key, None if it has already been written
+    ##
+    def get(self, key):
+        with self.lock:
+            return self.pending.get(key)
+
+    ##
+    # Get a copy of all the pending values
+    ##
+    def items(self):
+        with self.lock:
+            return self.pending.items()
+
+    ##
+    # Write the pending values, or only the ones of the given keys.
+    # If the writer fails, the values are kept for the next flush.
+    ##
+    def flush(self, keys=None):
+        with self.lock:
+            if keys == None:
+                values = self.pending
+                self.pending = dict()
+            else:
+                values = dict((key, self.pending.pop(key))
+                              for key in keys if key in self.pending)
+
+        if len(values) == 0:
+            return
+
+        try:
+            self.writer(values)
+        except Exception:
+            with self.lock:
+                for key, value in values.iteritems():
+                    self.pending.setdefault(key, value)
+            raise
+
+    ##
+    # Start the thread flushing the buffer every maxStaleness seconds
+    ##
+    def start(self):
+        if self.thread != None:
+            return
+
+        with self.lock:
+            if self.thread != None:
+                return
+            self.thread = threading.Thread(target=self.run)
+            self.thread.daemon = True
+            self.thread.start()
+        atexit.register(self.flush)
+
+    def run(self):
+        while True:
+            time.sleep(self.maxStaleness)
+            close_old_connections()
+            try:
+                self.flush()
+            except Exception as e:
+                print('Unable to flush the write buffer : %s' % e)
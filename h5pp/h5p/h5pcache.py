@@ -0,0 +1,258 @@
+##
+# Process-wide cache for library metadata and parsed semantics
+##
+from django.conf import settings
+from django.core.cache import caches
+import collections
+import threading
+import copy
+import time
+import uuid
+import os
+
+
+class H5PLibraryCache:
+
+    VERSION_KEY = 'h5pp:libraries:version'
+
+    ##
+    # Constructor for the H5PLibraryCache
+    #
+    # size is the number of entries kept in the in-process LRU, backend the
+    # name of an optional Django cache shared by all the processes.
+    ##
+    def __init__(self, size=256, backend=None, timeout=86400, checkInterval=2):
+        self.size = size
+        self.backend = caches[backend] if backend else None
+        self.timeout = timeout
+        self.checkInterval = checkInterval
+        self.entries = collections.OrderedDict()
+        self.lock = threading.RLock()
+        self.version = 0
+        self.checked = 0
+        # Dependency graph of the libraries, with the version it was built at
+        self.graph = None
+
+    ##
+    # Get a copy of a cached value, None if not cached
+    ##
+    def get(self, kind, key):
+        version = self.getVersion()
+        with self.lock:
+            entry = self.entries.pop((kind, key), None)
+            if entry != None and entry[0] == version:
+                # Move entry to the top of the LRU
+                self.entries[(kind, key)] = entry
+                return copy.deepcopy(entry[1])
+
+        if self.backend == None:
+            return None
+
+        value = self.backend.get(self.backendKey(version, kind, key))
+        if value != None:
+            self.storeLocal(version, kind, key, value)
+            return copy.deepcopy(value)
+
+        return None
+
+    ##
+    # Store a value in every tier of the cache
+    ##
+    def set(self, kind, key, value):
+        version = self.getVersion()
+        value = copy.deepcopy(value)
+        self.storeLocal(version, kind, key, value)
+        if self.backend != None:
+            self.backend.set(self.backendKey(
+                version, kind, key), value, self.timeout)
+
+    ##
+    # Get the dependency graph of the libraries, built by build() once per
+    # version of the cache. It is only kept in the process, not in the
+    # backend.
+    ##
+    def getGraph(self, build):
+        version = self.getVersion()
+        graph = self.graph
+        if graph != None and graph[0] == version:
+            return graph[1]
+
+        value = build()
+        with self.lock:
+            self.graph = (version, value)
+        return value
+
+    ##
+    # Forget every cached library. Must be called each time a library row,
+    # its dependencies or its semantics change.
+    ##
+    def invalidate(self):
+        with self.lock:
+            self.entries.clear()
+            self.graph = None
+            self.version = self.version + 1
+
+        if self.backend != None:
+            try:
+                self.version = self.backend.incr(self.VERSION_KEY)
+            except ValueError:
+                self.backend.set(self.VERSION_KEY, self.version, None)
+            self.checked = time.time()
+
+    ##
+    # Current version of the cache. When a shared backend is used, the version
+    # is read from it so invalidations done by other processes are seen.
+    ##
+    def getVersion(self):
+        if self.backend == None or time.time() - self.checked < self.checkInterval:
+            return self.version
+
+        version = self.backend.get(self.VERSION_KEY)
+        if version == None:
+            self.backend.add(self.VERSION_KEY, self.version, None)
+            version = self.backend.get(self.VERSION_KEY, self.version)
+
+        with self.lock:
+            if version != self.version:
+                self.entries.clear()
+                self.graph = None
+                self.version = version
+            self.checked = time.time()
+
+        return self.version
+
+    def storeLocal(self, version, kind, key, value):
+        if self.size <= 0:
+            return
+
+        with self.lock:
+            self.entries.pop((kind, key), None)
+            self.entries[(kind, key)] = (version, value)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def backendKey(self, version, kind, key):
+        return 'h5pp:libraries:%s:%s:%s' % (version, kind, key.replace(' ', '_'))
+
+libraryCache = None
+
+##
+# Get the shared library cache, created on first use from the settings
+##
+
+
+def getLibraryCache():
+    global libraryCache
+    if libraryCache == None:
+        libraryCache = H5PLibraryCache(
+            getattr(settings, 'H5P_LIBRARY_CACHE_SIZE', 256),
+            getattr(settings, 'H5P_LIBRARY_CACHE_BACKEND', None),
+            getattr(settings, 'H5P_LIBRARY_CACHE_TIMEOUT', 86400))
+    return libraryCache
+
+
+class H5PExportCache:
+
+    ##
+    # Constructor for the H5PExportCache
+    #
+    # Recently downloaded packages are kept in path, and the least recently
+    # used ones are removed when they take more than maxSize bytes.
+    ##
+    def __init__(self, path, maxSize, chunkSize=65536):
+        self.path = path
+        self.maxSize = maxSize
+        self.chunkSize = chunkSize
+
+    ##
+    # Stream a cached package, or generate it and store it while it is sent.
+    # key must change with anything put in the package.
+    ##
+    def stream(self, key, generate):
+        path = os.path.join(self.path, key + '.h5p')
+        try:
+            f = open(path, 'rb')
+        except IOError:
+            return self.streamAndStore(path, generate())
+
+        # Mark the package as recently used
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        return self.readFile(f)
+
+    def readFile(self, f):
+        with f:
+            while True:
+                chunk = f.read(self.chunkSize)
+                if not chunk:
+                    break
+                yield chunk
+
+    def streamAndStore(self, path, chunks):
+        if not os.path.isdir(self.path):
+            try:
+                os.makedirs(self.path)
+            except OSError:
+                pass
+
+        # Packages are written through a tmp file, and not kept if the
+        # download is interrupted
+        tmpPath = path + '.' + str(uuid.uuid1()) + '.tmp'
+        complete = False
+        try:
+            with open(tmpPath, 'wb') as f:
+                for chunk in chunks:
+                    f.write(chunk)
+                    yield chunk
+            os.rename(tmpPath, path)
+            complete = True
+        finally:
+            if not complete and os.path.exists(tmpPath):
+                os.remove(tmpPath)
+
+        self.evict()
+
+    ##
+    # Remove the least recently used packages until the cache fits in maxSize
+    ##
+    def evict(self):
+        files = list()
+        for name in os.listdir(self.path):
+            if name.endswith('.h5p'):
+                path = os.path.join(self.path, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, path))
+
+        total = sum(size for mtime, size, path in files)
+        for mtime, size, path in sorted(files):
+            if total <= self.maxSize:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total = total - size
+
+exportCache = None
+
+##
+# Get the cache of the downloaded packages, None if H5P_EXPORT_CACHE_SIZE
+# is not set
+##
+
+
+def getExportCache():
+    global exportCache
+    maxSize = getattr(settings, 'H5P_EXPORT_CACHE_SIZE', 0)
+    if not maxSize:
+        return None
+
+    if exportCache == None:
+        exportCache = H5PExportCache(
+            os.path.join(settings.MEDIA_ROOT, 'h5pp', 'exports-cache'), maxSize)
+    return exportCache
@@ -7,6 +7,9 @@ from django.db import connection
 from django.template.defaultfilters import slugify
 from h5pp.models import *
 from h5pp.h5p.h5pevent import H5PEvent
+from h5pp.h5p.h5pcache import getLibraryCache
+from h5pp.h5p.h5pqueries import executeQuery, fetchAll
+from h5pp.h5p.h5pjobs import enqueueJobs
 from h5pp.h5p.library.h5pclasses import *
 from h5pp.h5p.editor.h5peditorclasses import H5PDjangoEditor
 from h5pp.h5p.editor.library.h5peditorstorage import H5PEditorStorage
@@ -20,14 +23,15 @@ import os
 
 
 class H5PDjango:
-    global path, dirpath, h5pWhitelist, h5pWhitelistExtras
-    path = None
-    dirpath = None
+    global h5pWhitelist, h5pWhitelistExtras
     h5pWhitelist = 'json png jpg jpeg gif bmp tif tiff svg eot ttf woff woff2 otf webm mp4 ogg mp3 txt pdf rtf doc docx xls xlsx ppt pptx odt ods odp xml csv diff patch swf md textile'
     h5pWhitelistExtras = ' js css'
 
     def __init__(self, user):
         self.user = user
+        # Upload of the current request, see H5PUploadSession
+        self.uploadedH5pFolderPath = None
+        self.uploadedH5pPath = None
 
     ##
     # Get an instance of one of the h5p library classes
@@ -42,7 +46,8 @@ class H5PDjango:
 
         if not hasattr(self, 'core'):
             self.core = H5PCore(self.interface, os.path.join(settings.MEDIA_ROOT, 'h5pp'), settings.BASE_DIR,
-                                'en', True if getattr(settings, 'H5P_EXPORT') else False, False)
+                                'en', True if getattr(settings, 'H5P_EXPORT') and not getattr(settings, 'H5P_EXPORT_ON_DEMAND', False) else False, False,
+                                None if self.isInDevMode() else getLibraryCache())
 
         if typ == 'validator':
             return H5PValidator(self.interface, self.core)
@@ -90,6 +95,7 @@ class H5PDjango:
         tutorial = h5p_libraries.objects.get(machine_name=machineName)
         tutorial.tutorial_url = tutorialUrl
         tutorial.save()
+        getLibraryCache().invalidate()
 
     ##
     # Show the user an error message
@@ -106,19 +112,17 @@ class H5PDjango:
     # Get the path to the last uploaded h5p dir
     ##
     def getUploadedH5pFolderPath(self, folder=None):
-        global dirpath
         if folder != None:
-            dirpath = folder
-        return dirpath
+            self.uploadedH5pFolderPath = folder
+        return self.uploadedH5pFolderPath
 
     ##
     # Get the path to the last uploaded h5p file
     ##
     def getUploadedH5pPath(self, files=None):
-        global path
         if files != None:
-            path = files
-        return path
+            self.uploadedH5pPath = files
+        return self.uploadedH5pPath
 
     ##
     # Get a list of the current installed libraries
@@ -155,6 +159,19 @@ class H5PDjango:
 
         return libraryId[0]['library_id'] if len(libraryId) > 0 and 'library_id' in libraryId[0] else None
 
+    ##
+    # Get the id and patch version of every installed version of the given
+    # libraries, keyed by library string, in a single query
+    ##
+    def getLibraryVersions(self, machineNames):
+        versions = dict()
+        for library in h5p_libraries.objects.filter(machine_name__in=set(machineNames)).values(
+                'library_id', 'machine_name', 'major_version', 'minor_version', 'patch_version'):
+            versions[library['machine_name'] + ' ' + str(library['major_version']) +
+                     '.' + str(library['minor_version'])] = library
+
+        return versions
+
     ##
     # Is the library a patched version of an existing library ?
     ##
@@ -187,15 +204,7 @@ class H5PDjango:
     ##
     def getLibraryUsage(self, libraryId, skipContent=False):
         usage = dict()
-        cursor = connection.cursor()
-        cursor.execute("""
-			SELECT COUNT(distinct n.content_id)
-			FROM h5p_libraries l
-			JOIN h5p_contents_libraries cl ON l.library_id = cl.library_id
-			JOIN h5p_contents n ON cl.content_id = n.content_id
-			WHERE l.library_id = %s
-		""" % libraryId)
-        usage['content'] = cursor.fetchall()
+        usage['content'] = executeQuery('libraryUsage', [libraryId]).fetchall()
         usage['libraries'] = h5p_libraries_libraries.objects.filter(
             required_library_id=libraryId).count()
 
@@ -302,9 +311,32 @@ class H5PDjango:
         h5p_libraries_languages.objects.filter(
             library_id=libraryData['libraryId']).delete()
         if 'language' in libraryData:
-            for languageCode, languageJson in libraryData['language'].iteritems():
-                pid = h5p_libraries_languages.objects.create(library_id=libraryData[
-                                                             'libraryId'], language_code=languageCode, language_json=languageJson)
+            h5p_libraries_languages.objects.bulk_create([
+                h5p_libraries_languages(library_id=libraryData['libraryId'],
+                                        language_code=languageCode, language_json=languageJson)
+                for languageCode, languageJson in libraryData['language'].iteritems()
+            ])
+
+        getLibraryCache().invalidate()
+
+    ##
+    # Keep track of the libraries included in an aggregated assets file
+    ##
+    def saveCachedAssets(self, key, libraries):
+        h5p_libraries_cachedassets.objects.filter(hash=key).delete()
+        h5p_libraries_cachedassets.objects.bulk_create([
+            h5p_libraries_cachedassets(library_id=libraryId, hash=key)
+            for libraryId in set(library['library_id'] for library in libraries.itervalues())
+        ])
+
+    ##
+    # Forget the aggregated assets files using a library and return their keys
+    ##
+    def deleteCachedAssets(self, libraryId):
+        keys = list(h5p_libraries_cachedassets.objects.filter(
+            library_id=libraryId).values_list('hash', flat=True).distinct())
+        h5p_libraries_cachedassets.objects.filter(hash__in=keys).delete()
+        return keys
 
     ##
     # Convert list of file paths to csv
@@ -321,8 +353,14 @@ class H5PDjango:
     # Delete all dependencies belonging to given library
     ##
     def deleteLibraryDependencies(self, libraryId):
-        if h5p_libraries_libraries.objects.filter(library_id=libraryId).count() > 0:
-            h5p_libraries_libraries.objects.get(library_id=libraryId).delete()
+        self.deleteLibrariesDependencies([libraryId])
+
+    ##
+    # Delete all dependencies belonging to the given libraries
+    ##
+    def deleteLibrariesDependencies(self, libraryIds):
+        h5p_libraries_libraries.objects.filter(
+            library_id__in=libraryIds).delete()
 
     ##
     # Delete a library from database and file system
@@ -338,6 +376,7 @@ class H5PDjango:
         h5p_libraries_libraries.objects.get(library_id=libraryId).delete()
         h5p_libraries_languages.objects.get(library_id=libraryId).delete()
         h5p_libraries.objects.get(library_id=libraryId).delete()
+        getLibraryCache().invalidate()
 
     ##
     # Save what libraries a library is depending on
@@ -349,6 +388,17 @@ class H5PDjango:
             h5p_libraries_libraries.objects.create(library_id=libraryId, required_library_id=pid[
                                                    'library_id'], dependency_type="'" + dependencyType + "'")
 
+    ##
+    # Save the dependencies of several libraries at once. Each dependency
+    # is a tuple of the library id, the required library id and the type.
+    ##
+    def saveLibrariesDependencies(self, dependencies):
+        h5p_libraries_libraries.objects.bulk_create([
+            h5p_libraries_libraries(library_id=libraryId, required_library_id=requiredLibraryId,
+                                    dependency_type="'" + dependencyType + "'")
+            for libraryId, requiredLibraryId, dependencyType in dependencies
+        ])
+
     ##
     # Update old content
     ##
@@ -367,6 +417,7 @@ class H5PDjango:
         update.embed_type = 'div'
         update.main_library_id = content['library']['libraryId']
         update.filtered = ''
+        update.render_bundle = ''
         update.disable = content['disable']
         update.slug = slugify(content['title'])
         update.save()
@@ -482,17 +533,7 @@ class H5PDjango:
 
         library = library[0]
 
-        cursor = connection.cursor()
-        cursor.execute("""
-			SELECT hl.machine_name AS name,
-					hl.major_version AS major,
-					hl.minor_version AS minor,
-					hll.dependency_type AS type
-			FROM h5p_libraries_libraries hll
-			JOIN h5p_libraries hl ON hll.required_library_id = hl.library_id
-			WHERE hll.library_id = %s
-		""" % library['library_id'])
-        result = self.dictfetchall(cursor)
+        result = fetchAll('libraryDependencies', [library['library_id']])
 
         for dependency in result:
             typ = dependency['type'].replace("'", "") + 'Dependencies'
@@ -522,6 +563,20 @@ class H5PDjango:
             return semantics
         return False
 
+    ##
+    # Load every library, without its semantics, and every dependency
+    # between them, for the dependency graph of H5PCore
+    ##
+    def loadDependencyGraph(self):
+        fields = [field.attname for field in h5p_libraries._meta.fields
+                  if field.attname != 'semantics']
+        libraries = list(h5p_libraries.objects.values(*fields))
+        dependencies = [(libraryId, requiredLibraryId, dependencyType.replace("'", ""))
+                        for libraryId, requiredLibraryId, dependencyType in h5p_libraries_libraries.objects.order_by('id').values_list(
+                            'library_id', 'required_library_id', 'dependency_type')]
+
+        return libraries, dependencies
+
     ##
     # Loads library semantics
     ##
@@ -546,76 +601,56 @@ class H5PDjango:
     # Load content
     ##
     def loadContent(self, pid):
+        content = fetchAll('content', [pid])
+        return None if len(content) == 0 else content[0]
+
+    ##
+    # Load all contents available
+    ##
+    def loadAllContents(self):
+        result = h5p_contents.objects.values('content_id', 'title')
+        return result if len(result) > 0 else None
+
+    ##
+    # Load a page of contents with their main library, ordered by title.
+    # after is the (title, id) pair of the last content of the previous
+    # page, which does not need to exist anymore.
+    ##
+    def loadContentsList(self, limit, after=None):
+        where = ''
+        params = list()
+        if after != None:
+            where = 'WHERE hn.title > %s OR (hn.title = %s AND hn.content_id > %s)'
+            params = [after[0], after[0], after[1]]
+        params.append(limit)
+
         cursor = connection.cursor()
         cursor.execute("""
 			SELECT hn.content_id AS id,
 					hn.title,
-					hn.json_contents AS params,
-					hn.embed_type,
-                    hn.content_type,
-                    hn.author,
+					hn.author,
+					hn.content_type,
+					hn.slug,
 					hl.library_id,
 					hl.machine_name AS library_name,
 					hl.major_version AS library_major_version,
-					hl.minor_version AS library_minor_version,
-					hl.embed_types AS library_embed_types,
-					hl.fullscreen AS library_fullscreen,
-					hn.filtered,
-					hn.disable,
-					hn.slug
+					hl.minor_version AS library_minor_version
 			FROM h5p_contents hn
 			JOIN h5p_libraries hl ON hl.library_id = hn.main_library_id
-			WHERE content_id = %s
-		""" % pid)
-        content = self.dictfetchall(cursor)
-        return None if len(content) == 0 else content[0]
-
-    ##
-    # Load all contents available
-    ##
-    def loadAllContents(self):
-        result = h5p_contents.objects.values('content_id', 'title')
-        return result if len(result) > 0 else None
+			""" + where + """
+			ORDER BY hn.title, hn.content_id
+			LIMIT %s
+		""", params)
+        return self.dictfetchall(cursor)
 
     ##
     # Load dependencies for the given content of the given type
     ##
     def loadContentDependencies(self, pid, typ=None):
-        cursor = connection.cursor()
         if typ != None:
-            cursor.execute("""
-				SELECT hl.library_id,
-						hl.machine_name,
-						hl.major_version,
-						hl.minor_version,
-						hl.patch_version,
-						hl.preloaded_css,
-						hl.preloaded_js,
-						hnl.drop_css,
-						hnl.dependency_type
-				FROM h5p_contents_libraries hnl
-				JOIN h5p_libraries hl ON hnl.library_id = hl.library_id
-				WHERE hnl.content_id = %s AND hnl.dependency_type = %s
-				ORDER BY hnl.weight
-			""" % (pid, "'" + typ + "'"))
+            result = fetchAll('contentDependenciesByType', [pid, typ])
         else:
-            cursor.execute("""
-				SELECT hl.library_id,
-						hl.machine_name,
-						hl.major_version,
-						hl.minor_version,
-						hl.patch_version,
-						hl.preloaded_css,
-						hl.preloaded_js,
-						hnl.drop_css,
-						hnl.dependency_type
-				FROM h5p_contents_libraries hnl
-				JOIN h5p_libraries hl ON hnl.library_id = hl.library_id
-				WHERE hnl.content_id = %s
-				ORDER BY hnl.weight
-			""" % pid)
-
-        result = self.dictfetchall(cursor)
+            result = fetchAll('contentDependencies', [pid])
         dependencies = collections.OrderedDict()
         for dependency in result:
             dependencies[dependency['library_id']] = dependency
@@ -659,15 +694,15 @@ class H5PDjango:
             return inputValue
 
     ##
-    # This will update selected fields on the given content
+    # This will update selected fields on the given content. With params,
+    # the fields are only written if the parameters of the content are
+    # still these ones. Returns the number of contents updated.
     ##
-    def updateContentFields(self, pid, fields):
-        cursor = connection.cursor()
-        for name, value in fields.iteritems():
-            query = {
-                '{0}'.format(name): value
-            }
-            h5p_contents.objects.filter(content_id=pid).update(**query)
+    def updateContentFields(self, pid, fields, params=None):
+        contents = h5p_contents.objects.filter(content_id=pid)
+        if params != None:
+            contents = contents.filter(json_contents=params)
+        return contents.update(**fields)
 
     ##
     # Not implemented yet
@@ -677,12 +712,16 @@ class H5PDjango:
 
     ##
     # Will clear filtered params for all the content that uses the specified
-    # library. This means that the content dependencies will have to be rebuilt,
-    # and the parameters refiltered
+    # library, or list of libraries. This means that the content dependencies will have to be rebuilt,
+    # and the parameters refiltered, which is queued as background jobs
     ##
     def clearFilteredParameters(self, libraryId):
-        # TODO
-        return ''
+        libraryIds = libraryId if isinstance(libraryId, list) else [libraryId]
+        contentIds = list(h5p_contents_libraries.objects.filter(
+            library_id__in=libraryIds).values_list('content_id', flat=True).distinct())
+        h5p_contents.objects.filter(content_id__in=contentIds).update(
+            filtered='', filtered_subcontents='', render_bundle='')
+        enqueueJobs('filter', contentIds)
 
     ##
     # Get number of contents that has to get their content dependencies rebuilt
@@ -0,0 +1,237 @@
+##
+# Database backed queue of the work done after a content is saved, like
+# the parameters filtering, the library usage and the export file.
+# Jobs are run by the h5p_worker management command, and also by a pool
+# of threads of the web process when H5P_JOBS_THREADS is set. When neither
+# is used (H5P_JOBS_WORKER unset), the request which queued jobs runs them
+# once its response is sent. No broker is needed, the workers claim the
+# jobs with a conditional update.
+##
+from django.conf import settings
+from django.core.signals import request_finished
+from django.db import close_old_connections
+from django.db.models import Q, F
+from h5pp.models import h5p_jobs
+import traceback
+import threading
+import time
+
+# Handlers of the job types, called with the content id
+JOB_HANDLERS = dict()
+
+# Jobs started for longer are considered lost and are retried
+JOB_TIMEOUT = 600
+
+##
+# Register the function running a type of job
+##
+
+
+def registerJobHandler(name, handler):
+    JOB_HANDLERS[name] = handler
+
+##
+# Queue a job for each content, unless one is already pending
+##
+
+
+def enqueueJobs(name, contentIds):
+    contentIds = set(int(contentId) for contentId in contentIds)
+    if len(contentIds) == 0:
+        return
+
+    pending = set(h5p_jobs.objects.filter(type=name, content_id__in=contentIds,
+                                          started_at=None).values_list('content_id', flat=True))
+    now = int(time.time())
+    h5p_jobs.objects.bulk_create([
+        h5p_jobs(type=name, content_id=contentId, created_at=now)
+        for contentId in contentIds if not contentId in pending
+    ])
+
+    pool = getJobPool()
+    if pool != None:
+        pool.notify()
+    elif not getattr(settings, 'H5P_JOBS_WORKER', False):
+        runAfterRequest(len(contentIds))
+
+
+def enqueueJob(name, contentId):
+    enqueueJobs(name, [contentId])
+
+##
+# Take the oldest job which is pending, or lost by its worker.
+# The update only succeeds for one worker, so no lock is needed.
+##
+
+
+def claimJob(timeout=JOB_TIMEOUT):
+    now = int(time.time())
+    maxAttempts = getattr(settings, 'H5P_JOBS_MAX_ATTEMPTS', 3)
+    candidates = h5p_jobs.objects.filter(
+        Q(started_at=None) | Q(started_at__lt=now - timeout),
+        attempts__lt=maxAttempts).values_list('job_id', 'started_at')[0:10]
+
+    for jobId, startedAt in candidates:
+        claimed = h5p_jobs.objects.filter(job_id=jobId, started_at=startedAt).update(
+            started_at=now, attempts=F('attempts') + 1)
+        if claimed == 1:
+            return h5p_jobs.objects.get(job_id=jobId)
+
+    return None
+
+##
+# Run a claimed job. It is removed when it succeeds, and the error is
+# kept for the next attempt when it fails.
+##
+
+
+def runJob(job):
+    handler = JOB_HANDLERS.get(job.type)
+    try:
+        if handler == None:
+            raise Exception('No handler for the jobs of type "%s"' % job.type)
+        handler(job.content_id)
+    except Exception:
+        error = traceback.format_exc()
+        print('H5P job %s (%s of content %s) failed : %s' %
+              (job.job_id, job.type, job.content_id, error))
+        h5p_jobs.objects.filter(job_id=job.job_id).update(error=error)
+        return False
+
+    h5p_jobs.objects.filter(job_id=job.job_id).delete()
+    return True
+
+##
+# Run the jobs until the queue is empty, or limit jobs have been run.
+# Returns the number of jobs run.
+##
+
+
+def runPendingJobs(limit=None):
+    count = 0
+    while limit == None or count < limit:
+        job = claimJob()
+        if job == None:
+            pruneFailedJobs()
+            break
+        runJob(job)
+        count = count + 1
+
+    return count
+
+
+##
+# Remove the jobs which failed H5P_JOBS_MAX_ATTEMPTS times, once their
+# last attempt is over, and report their last error. Returns the number
+# of jobs removed.
+##
+
+
+def pruneFailedJobs(timeout=JOB_TIMEOUT):
+    maxAttempts = getattr(settings, 'H5P_JOBS_MAX_ATTEMPTS', 3)
+    failed = h5p_jobs.objects.filter(attempts__gte=maxAttempts,
+                                     started_at__lt=int(time.time()) - timeout)
+    count = 0
+    for job in failed:
+        print('H5P job %s (%s of content %s) given up after %d attempts : %s' %
+              (job.job_id, job.type, job.content_id, job.attempts, job.error))
+        h5p_jobs.objects.filter(job_id=job.job_id).delete()
+        count = count + 1
+
+    return count
+
+
+class H5PJobPool:
+
+    ##
+    # Constructor for the H5PJobPool
+    #
+    # The threads run the pending jobs at the end of the requests which
+    # queued some, once the files of the content are written and the
+    # transaction is committed, and every pollInterval seconds to pick up
+    # the jobs queued by the other processes.
+    ##
+    def __init__(self, threads=1, pollInterval=30):
+        self.threads = threads
+        self.pollInterval = pollInterval
+        self.event = threading.Event()
+        self.lock = threading.Lock()
+        self.notified = False
+        self.workers = None
+
+    def notify(self):
+        self.start()
+        self.notified = True
+
+    def requestFinished(self, **kwargs):
+        if self.notified:
+            self.notified = False
+            self.event.set()
+
+    def start(self):
+        if self.workers != None:
+            return
+
+        with self.lock:
+            if self.workers != None:
+                return
+            self.workers = [threading.Thread(target=self.run)
+                            for i in range(self.threads)]
+            for worker in self.workers:
+                worker.daemon = True
+                worker.start()
+        request_finished.connect(self.requestFinished, weak=False)
+
+    def run(self):
+        while True:
+            self.event.wait(self.pollInterval)
+            self.event.clear()
+            close_old_connections()
+            try:
+                runPendingJobs()
+            except Exception as e:
+                print('Unable to run the H5P jobs : %s' % e)
+
+##
+# Run jobs in the thread of the request once its response is sent, when
+# no pool or worker runs them
+##
+afterRequest = threading.local()
+
+
+def runAfterRequest(count):
+    if getattr(afterRequest, 'count', 0) == 0:
+        request_finished.connect(runJobsAfterRequest, weak=False,
+                                 dispatch_uid='h5pp.h5p.h5pjobs.runJobsAfterRequest')
+    afterRequest.count = getattr(afterRequest, 'count', 0) + count
+
+
+def runJobsAfterRequest(**kwargs):
+    count = getattr(afterRequest, 'count', 0)
+    if count == 0:
+        return
+
+    afterRequest.count = 0
+    try:
+        runPendingJobs(count)
+    except Exception as e:
+        print('Unable to run the H5P jobs : %s' % e)
+
+jobPool = None
+
+##
+# Get the thread pool of the web process, None if the jobs are only run
+# by the h5p_worker command
+##
+
+
+def getJobPool():
+    global jobPool
+    threads = getattr(settings, 'H5P_JOBS_THREADS', 0)
+    if not threads:
+        return None
+
+    if jobPool == None:
+        jobPool = H5PJobPool(
+            threads, getattr(settings, 'H5P_JOBS_POLL_INTERVAL', 30))
+    return jobPool
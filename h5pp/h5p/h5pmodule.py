@@ -2,16 +2,26 @@
 # Django module h5p.
 ##
 from django.conf import settings
-from django.contrib.auth.models import User
+from django.contrib.auth.models import User, AnonymousUser
+from django.db import connection, transaction, IntegrityError
+from django.db.models import Q, F, Count, Sum, Case, When, Value, IntegerField
 from h5pp.models import *
 from h5pp.h5p.h5pclasses import H5PDjango
+from h5pp.h5p.library.h5pclasses import H5PCore
+from h5pp.h5p.h5pbuffer import H5PWriteBuffer
+from h5pp.h5p.h5pcache import getExportCache
+from h5pp.h5p.h5pjobs import registerJobHandler, enqueueJob
+from h5pp.h5p.library.h5pimages import H5PImageDerivatives
 import collections
+import StringIO
 import hashlib
+import base64
 import shutil
 import uuid
 import time
 import math
 import json
+import csv
 import os
 import re
 
@@ -35,13 +45,63 @@ SCRIPTS = [
 ]
 
 ##
-# Get path to HML5 Package
+# Get path to HML5 Package. With H5P_EXPORT_ON_DEMAND, packages are not
+# stored but generated by the export view when they are downloaded.
 ##
 
 
 def h5pGetExportPath(content):
+    if getattr(settings, 'H5P_EXPORT', False) and getattr(settings, 'H5P_EXPORT_ON_DEMAND', False):
+        return settings.BASE_URL + settings.H5P_URL + 'export/' + str(content['id']) + '/'
     return os.path.join(settings.MEDIA_ROOT, 'h5pp', 'exports', ((content['slug'] + '-') if 'slug' in content else ''), str(content['id']) + '.h5p')
 
+##
+# Get the file name and the chunks of the package of a content, generated
+# from the content and library folders. None if the content does not
+# exist or cannot be downloaded, False if its dependencies are not built
+# yet. Recently downloaded packages are kept when H5P_EXPORT_CACHE_SIZE
+# is set.
+##
+
+
+def h5pGetExportStream(user, contentId):
+    if not getattr(settings, 'H5P_EXPORT', False) or not getattr(settings, 'H5P_EXPORT_ON_DEMAND', False):
+        return None
+
+    interface = H5PDjango(user)
+    core = interface.h5pGetInstance('core')
+    content = core.loadContent(contentId)
+    if content == None or int(content['disable'] or 0) & H5PCore.DISABLE_DOWNLOAD:
+        return None
+
+    content['id'] = str(contentId)
+    content['embedType'] = content['embed_type']
+
+    if not content['filtered']:
+        # The dependencies are built by the filter job, not by the download
+        enqueueJob('filter', contentId)
+        return False
+
+    content['dependencies'] = collections.OrderedDict()
+    for libraryId, dependency in core.loadContentDependencies(contentId).iteritems():
+        content['dependencies'][libraryId] = {
+            'library': dependency,
+            'type': dependency['dependency_type']
+        }
+
+    exporter = interface.h5pGetInstance('export')
+    filename = (content['slug'] or 'content') + '-' + content['id'] + '.h5p'
+    cache = getExportCache()
+    if cache == None:
+        return filename, exporter.streamExportFile(content)
+
+    key = hashlib.sha1(json.dumps([
+        content['id'], content['title'], content['embedType'], content['params'],
+        [(dependency['library']['machine_name'], dependency['library']['major_version'], dependency['library']['minor_version'],
+          dependency['library']['patch_version'], dependency['type']) for dependency in content['dependencies'].values()]
+    ])).hexdigest()
+    return filename, cache.stream(key, lambda: exporter.streamExportFile(content))
+
 ##
 # Creates the title for the library details page
 ##
@@ -56,11 +116,13 @@ def h5pLibraryDetailsTitle(libraryId):
 ##
 
 
-def h5pInsert(request, interface):
+def h5pInsert(request, interface, upload=None):
     if 'h5p_upload' in request.POST:
         storage = interface.h5pGetInstance('storage')
-        storage.savePackage(h5pGetContentId(request), None, False, {
-                            'disable': request.POST['disable'], 'title': request.POST['title']})
+        if not storage.savePackage(h5pGetContentId(request), None, False, {
+                'disable': request.POST['disable'], 'title': request.POST['title']}, upload):
+            return False
+        contentId = storage.contentId
     else:
         if not 'name' in request.POST['main_library']:
             lib = h5p_libraries.objects.filter(library_id=request.POST['main_library_id']).values(
@@ -79,7 +141,7 @@ def h5pInsert(request, interface):
                 'minorVersion': request.POST['main_library']['minorVersion'] if 'minorVersion' in request.POST['main_library'] else ''
             }
         core = h5pGetInstance('core')
-        core.saveContent({
+        contentId = core.saveContent({
             'id': h5pGetContentId(request),
             'title': request.POST['title'],
             'params': request.POST['json_content'],
@@ -90,8 +152,53 @@ def h5pInsert(request, interface):
             'h5p_library': request.POST['h5p_library'] if 'h5p_library' in request.POST else None
         }, request.POST['nid'])
 
+    enqueueJob('filter', contentId)
+    enqueueJob('images', contentId)
     return True
 
+##
+# Filter the parameters of a saved content in background. This rebuilds
+# its library usage and its export file, so its first view does not have to.
+##
+
+
+def h5pFilterContentJob(contentId):
+    interface = H5PDjango(AnonymousUser())
+    core = interface.h5pGetInstance('core')
+    content = core.loadContent(contentId)
+    if content == None:
+        # Deleted since
+        return
+
+    content['id'] = str(contentId)
+    content['embedType'] = content['embed_type']
+    core.filterParameters(content)
+
+registerJobHandler('filter', h5pFilterContentJob)
+
+##
+# Generate the resized variants of the images of a saved content in
+# background. The render bundle is rebuilt to list them.
+##
+
+
+def h5pImagesContentJob(contentId):
+    interface = H5PDjango(AnonymousUser())
+    core = interface.h5pGetInstance('core')
+    derivatives = H5PImageDerivatives(core.fs)
+    if not derivatives.isEnabled():
+        return
+    content = core.loadContent(contentId)
+    if content == None:
+        # Deleted since
+        return
+
+    if derivatives.update(contentId, json.loads(content['params'])):
+        h5p_contents.objects.filter(
+            content_id=contentId).update(render_bundle='')
+
+registerJobHandler('images', h5pImagesContentJob)
+
 
 def h5pUpdate(request):
     if 'h5p_upload' in request:
@@ -162,7 +269,7 @@ def h5pView(request):
     if not html:
         html = '<div>' + 'Sorry, preview of H5P content is not yet available.' + '</div>'
     else:
-        h5pSetStarted(h5pGetContentId(request))
+        h5pSetStarted(request.user, h5pGetContentId(request))
 
     return request
 
@@ -178,19 +285,126 @@ def h5pUserDelete(user):
 ##
 
 
-def includeH5p(request):
-    contentId = h5pGetContentId(request)
-    embed = determineEmbedType(request.GET['embed_type'], request.GET[
-                               'main_library']['embedTypes'])
+def includeH5p(request, content=None):
+    bundle = h5pGetRenderBundle(request, content)
+    integration = h5pGetIntegration(request.user, bundle)
+
+    data = {
+        'integration': json.dumps(integration),
+        'assets': h5pAddCoreAssets(),
+        'filesAssets': bundle['filesAssets']
+    }
+
+    return {'html': bundle['html'], 'data': data}
+
+##
+# Get the render bundle of a content : the user independent part of
+# H5PIntegration and the ordered lists of assets. The bundle is built
+# the first time the content is viewed after a save and then stored.
+##
+
+
+def h5pGetRenderBundle(request, content=None):
+    if content == None:
+        content = h5p_contents.objects.get(
+            content_id=h5pGetContentId(request))
+
+    if content.render_bundle:
+        request.GET = request.GET.copy()
+        request.GET['title'] = content.title
+        return json.loads(content.render_bundle)
+
+    h5pLoad(request)
+    bundle = h5pBuildRenderBundle(request)
+
+    if bundle['integration']['contents']['cid-' + str(bundle['contentId'])]['jsonContent'] != None:
+        h5p_contents.objects.filter(content_id=content.content_id).update(
+            render_bundle=json.dumps(bundle))
+
+    return bundle
 
-    data = h5pAddFilesAndSettings(request, embed)
-    if embed == 'div':
+##
+# Build the render bundle of the content loaded by h5pLoad
+##
+
+
+def h5pBuildRenderBundle(request):
+    interface = H5PDjango(request.user)
+    core = interface.h5pGetInstance('core')
+    content = h5pGetContent(request)
+    contentId = content['id']
+    embedType = determineEmbedType(request.GET['embed_type'], request.GET[
+                                   'main_library']['embedTypes'])
+
+    if embedType == 'div':
         html = '<div class="h5p-content" data-content-id="' + contentId + '"></div>'
     else:
         html = '<div class="h5p-iframe-wrapper"><iframe id="h5p-iframe-' + contentId + '" class="h5p-iframe" data-content-id="' + \
             contentId + '" style="height:1px" src="about:blank" frameBorder="0" scrolling="no"></iframe></div>'
 
-    return {'html': html, 'data': data}
+    integration = dict()
+    integration['contents'] = dict()
+    integration['contents'][
+        str('cid-' + contentId)] = h5pGetBaseContentSettings(core, content)
+
+    # Content dependencies are rebuilt by the parameters filtering above
+    preloadedDependencies = core.loadContentDependencies(contentId)
+    files = core.getDependenciesFiles(preloadedDependencies)
+
+    filesAssets = {
+        'js': list(),
+        'css': list()
+    }
+    if embedType == 'div':
+        integration['loadedJs'] = list()
+        integration['loadedCss'] = list()
+        for script in files['scripts']:
+            filesAssets['js'].append(
+                settings.MEDIA_URL + 'h5pp/' + script['path'])
+            integration['loadedJs'].append(settings.MEDIA_URL + 'h5pp/' +
+                                           script['path'] + script['version'])
+        for style in files['styles']:
+            filesAssets['css'].append(
+                settings.MEDIA_URL + 'h5pp/' + style['path'])
+            integration['loadedCss'].append(settings.MEDIA_URL + 'h5pp/' +
+                                            style['path'] + style['version'])
+        #Override CSS
+        filesAssets['css'].append(OVERRIDE_STYLES)
+        integration['loadedCss'].append(OVERRIDE_STYLES)
+
+    elif embedType == 'iframe':
+        h5pAddIframeAssets(request, integration, contentId, files)
+
+    # Assets of the embed page
+    coreAssets = h5pAddCoreAssets()
+    scripts = coreAssets['js'] + core.getAssetsUrls(files['scripts'])
+    styles = coreAssets['css'] + core.getAssetsUrls(files['styles'])
+
+    return {
+        'contentId': contentId,
+        'embedType': embedType,
+        'html': html,
+        'integration': integration,
+        'filesAssets': filesAssets,
+        'scripts': scripts,
+        'styles': styles
+    }
+
+##
+# Merge the user specific settings into a render bundle and get the
+# H5PIntegration object
+##
+
+
+def h5pGetIntegration(user, bundle):
+    integration = h5pGetCoreSettings(user)
+    integration.update(bundle['integration'])
+
+    for key, contentSettings in integration['contents'].iteritems():
+        contentSettings['contentUserData'] = h5pGetContentUserData(
+            user, contentSettings['mainId'])
+
+    return integration
 
 ##
 # Set that the logged in user has started on an h5p
@@ -198,18 +412,144 @@ def includeH5p(request):
 
 
 def h5pSetStarted(user, contentId):
-    if user.id:
-        exist = h5p_points.objects.filter(
-            content_id=contentId, uid=user.id).values()
-        if len(exist) > 0:
-            update = h5p_points.objects.get(content_id=contentId, uid=user.id)
-            update.content_id = contentId
-            update.uid = user.id
-            update.started = int(time.time())
-            update.save()
-        else:
-            h5p_points.objects.create(
-                content_id=contentId, uid=user.id, started=int(time.time()))
+    startedBuffer = getStartedBuffer()
+    if user.id and startedBuffer != None:
+        startedBuffer.put((int(contentId), user.id), int(time.time()))
+    elif user.id:
+        h5pUpsert(h5p_points, {'content_id': contentId, 'uid': user.id},
+                  {'started': int(time.time())}, {'finished': 0})
+
+##
+# Insert a row, or update the values of the row having the same keys.
+# Uses a single INSERT ... ON CONFLICT / ON DUPLICATE KEY statement when the
+# database supports it, an UPDATE followed by an INSERT otherwise.
+# defaults are only written when the row is created.
+##
+
+
+def h5pUpsert(model, keys, values, defaults=None):
+    defaults = defaults if defaults else dict()
+    vendor = connection.vendor
+    if vendor == 'postgresql' and connection.pg_version >= 90500:
+        update = 'ON CONFLICT (%s) DO UPDATE SET %s'
+        assign = '%s = EXCLUDED.%s'
+    elif vendor == 'sqlite' and connection.Database.sqlite_version_info >= (3, 24, 0):
+        update = 'ON CONFLICT (%s) DO UPDATE SET %s'
+        assign = '%s = excluded.%s'
+    elif vendor == 'mysql':
+        update = 'ON DUPLICATE KEY UPDATE %s'
+        assign = '%s = VALUES(%s)'
+    else:
+        with transaction.atomic():
+            if model.objects.filter(**keys).update(**values) == 0:
+                try:
+                    with transaction.atomic():
+                        model.objects.create(
+                            **dict(keys, **dict(defaults, **values)))
+                except IntegrityError:
+                    model.objects.filter(**keys).update(**values)
+        return
+
+    quote = connection.ops.quote_name
+    row = dict(defaults, **dict(keys, **values))
+    columns = row.keys()
+    sql = 'INSERT INTO %s (%s) VALUES (%s) ' % (
+        quote(model._meta.db_table),
+        ', '.join(quote(column) for column in columns),
+        ', '.join(['%s'] * len(columns)))
+    assignments = ', '.join(assign % (quote(column), quote(column))
+                            for column in values)
+    if vendor == 'mysql':
+        sql = sql + update % assignments
+    else:
+        sql = sql + update % (', '.join(quote(key) for key in keys), assignments)
+
+    cursor = connection.cursor()
+    cursor.execute(sql, [row[column] for column in columns])
+
+startedBuffer = None
+
+##
+# Get the buffer of started timestamps, None if they are written right away.
+# Timestamps are buffered when H5P_STARTED_MAX_STALENESS is set.
+##
+
+
+def getStartedBuffer():
+    global startedBuffer
+    maxStaleness = getattr(settings, 'H5P_STARTED_MAX_STALENESS', 0)
+    if maxStaleness <= 0:
+        return None
+    if startedBuffer == None:
+        startedBuffer = H5PWriteBuffer(saveStartedBatch, maxStaleness,
+                                       getattr(settings, 'H5P_STARTED_BUFFER_SIZE', 1000))
+    return startedBuffer
+
+##
+# Write buffered started timestamps, keyed by (content id, user id)
+##
+
+
+def saveStartedBatch(started, chunkSize=200):
+    started = started.items()
+    for i in range(0, len(started), chunkSize):
+        chunk = dict(started[i:i + chunkSize])
+        match = Q()
+        for contentId, userId in chunk:
+            match = match | Q(content_id=contentId, uid=userId)
+
+        with transaction.atomic():
+            existing = set(h5p_points.objects.filter(
+                match).values_list('content_id', 'uid'))
+            if len(existing) > 0:
+                h5p_points.objects.filter(match).update(started=Case(
+                    *[When(content_id=key[0], uid=key[1], then=Value(chunk[key])) for key in existing],
+                    default=F('started'), output_field=IntegerField()))
+
+            missing = [key for key in chunk if key not in existing]
+            try:
+                with transaction.atomic():
+                    h5p_points.objects.bulk_create([
+                        h5p_points(content_id=key[0], uid=key[1], started=chunk[key])
+                        for key in missing
+                    ])
+            except IntegrityError:
+                for key in missing:
+                    h5pUpsert(h5p_points, {'content_id': key[0], 'uid': key[1]},
+                              {'started': chunk[key]}, {'finished': 0})
+
+##
+# Apply the buffered started timestamps to scores read from the database.
+# Buffered views of contents not yet in the database are added as new scores.
+##
+
+
+def mergeStartedBuffer(scores, contentIds, user=None, ownedIds=None):
+    startedBuffer = getStartedBuffer()
+    buffered = dict(startedBuffer.items()) if startedBuffer != None else None
+    if not buffered:
+        return scores
+
+    for score in scores:
+        started = buffered.pop((score['content_id'], score['uid']), None)
+        if started != None:
+            score['started'] = started
+
+    contentIds = set(int(contentId) for contentId in contentIds)
+    ownedIds = set(ownedIds) if ownedIds else set()
+    for (contentId, userId), started in buffered.iteritems():
+        if contentId in contentIds and (user == None or userId == user.id or contentId in ownedIds):
+            scores.append({
+                'content_id': contentId,
+                'uid': userId,
+                'started': started,
+                'finished': 0,
+                'points': None,
+                'max_points': None
+            })
+    scores.sort(key=lambda score: (score['content_id'], score['uid']))
+
+    return scores
 
 ##
 # Handle grades storage for users
@@ -226,6 +566,9 @@ def h5pSetFinished(request):
     }
 
     if contentId.isdigit() and score.isdigit() and maxScore.isdigit():
+        startedBuffer = getStartedBuffer()
+        if startedBuffer != None:
+            startedBuffer.flush([(int(contentId), request.user.id)])
         update = h5p_points.objects.get(
             content_id=contentId, uid=request.user.id)
         update.finished = int(time.time())
@@ -236,6 +579,130 @@ def h5pSetFinished(request):
 
     return json.dumps(response)
 
+##
+# Handle a batch of finished and state records sent by the client at once.
+# Records are coalesced per content (and per data type for states), then
+# written with a constant number of statements.
+##
+
+
+def h5pSaveBatch(request):
+    response = {
+        'success': False
+    }
+    if not request.user.id or 'records' not in request.POST:
+        return json.dumps(response)
+
+    try:
+        records = json.loads(request.POST['records'])
+    except ValueError:
+        return json.dumps(response)
+    if not isinstance(records, list):
+        return json.dumps(response)
+
+    finished = collections.OrderedDict()
+    states = collections.OrderedDict()
+    for record in records:
+        if not isinstance(record, dict):
+            continue
+        contentId = unicode(record.get('contentId', ''))
+        if not contentId.isdigit():
+            continue
+
+        if record.get('type') == 'finished':
+            score = unicode(record.get('score', ''))
+            maxScore = unicode(record.get('maxScore', ''))
+            if score.isdigit() and maxScore.isdigit():
+                finished[int(contentId)] = {
+                    'points': int(score),
+                    'max_points': int(maxScore)
+                }
+        elif record.get('type') == 'state':
+            subContentId = unicode(record.get('subContentId') or 0)
+            dataId = record.get('dataType')
+            if subContentId.isdigit() and dataId and 'data' in record:
+                states[(int(contentId), int(subContentId), dataId)] = record
+
+    with transaction.atomic():
+        saveFinishedBatch(request.user.id, finished)
+        saveUserDataBatch(request.user.id, states)
+
+    response['success'] = True
+    return json.dumps(response)
+
+##
+# Store the scores of several contents for one user
+##
+
+
+def saveFinishedBatch(userId, finished):
+    if len(finished) == 0:
+        return
+
+    now = int(time.time())
+    existing = set(h5p_points.objects.filter(
+        uid=userId, content_id__in=finished.keys()).values_list('content_id', flat=True))
+    missing = [contentId for contentId in finished if contentId not in existing]
+    try:
+        with transaction.atomic():
+            h5p_points.objects.bulk_create([
+                h5p_points(content_id=contentId, uid=userId, started=now)
+                for contentId in missing
+            ])
+    except IntegrityError:
+        # Rows created meanwhile by h5pSetStarted
+        for contentId in missing:
+            h5pUpsert(h5p_points, {'content_id': contentId, 'uid': userId},
+                      {'finished': now}, {'started': now})
+
+    h5p_points.objects.filter(uid=userId, content_id__in=finished.keys()).update(
+        finished=now,
+        points=Case(*[When(content_id=contentId, then=Value(score['points']))
+                      for contentId, score in finished.iteritems()],
+                    output_field=IntegerField()),
+        max_points=Case(*[When(content_id=contentId, then=Value(score['max_points']))
+                          for contentId, score in finished.iteritems()],
+                        output_field=IntegerField()))
+
+##
+# Store or delete several content user data for one user.
+# States are keyed by (content id, sub content id, data type).
+##
+
+
+def saveUserDataBatch(userId, states):
+    if len(states) == 0:
+        return
+
+    match = Q()
+    for contentId, subContentId, dataId in states:
+        match = match | Q(content_main_id=contentId,
+                          sub_content_id=subContentId, data_id=dataId)
+    h5p_content_user_data.objects.filter(match, user_id=userId).delete()
+
+    now = int(time.time())
+    rows = [{
+        'user_id': userId,
+        'content_main_id': contentId,
+        'sub_content_id': subContentId,
+        'data_id': dataId,
+        'timestamp': now,
+        'data': record['data'],
+        'preloaded': 0 if unicode(record.get('preload')) == '0' else 1,
+        'delete_on_content_change': 0 if unicode(record.get('invalidate')) == '0' else 1
+    } for (contentId, subContentId, dataId), record in states.iteritems()
+        if unicode(record['data']) != '0']
+    try:
+        with transaction.atomic():
+            h5p_content_user_data.objects.bulk_create(
+                [h5p_content_user_data(**row) for row in rows])
+    except IntegrityError:
+        # Rows saved meanwhile by another request
+        keys = ['user_id', 'content_main_id', 'sub_content_id', 'data_id']
+        for row in rows:
+            h5pUpsert(h5p_content_user_data, dict((key, row[key]) for key in keys),
+                      dict((key, value) for key, value in row.iteritems() if not key in keys))
+
 ##
 # Adds content independent scripts, styles and settings
 ##
@@ -322,6 +789,13 @@ def h5pGetCoreSettings(user):
             'mail': user.email
         }
 
+    # Let the client coalesce results and states into batch requests
+    batchInterval = getattr(settings, 'H5P_BATCH_INTERVAL', 0)
+    if batchInterval > 0:
+        coreSettings['ajax']['batch'] = settings.BASE_URL + \
+            settings.H5P_URL + 'ajax/?batch'
+        coreSettings['ajax']['batchInterval'] = batchInterval
+
     return coreSettings
 
 ##
@@ -330,51 +804,15 @@ def h5pGetCoreSettings(user):
 
 
 def h5pAddFilesAndSettings(request, embedType):
-    interface = H5PDjango(request.user)
     integration = h5pGetCoreSettings(request.user)
-    assets = h5pAddCoreAssets()
 
     if not 'json_content' in request.GET or not 'contentId' in request.GET:
         return integration
 
-    content = h5pGetContent(request)
-    if 'contents' in integration and content['id'] in integration['contents']:
-        return integration
-
-    integration['contents'] = dict()
-    integration['contents'][
-        str('cid-' + content['id'])] = h5pGetContentSettings(request.user, content)
-
-    core = interface.h5pGetInstance('core')
-    preloadedDependencies = core.loadContentDependencies(content['id'])
-    files = core.getDependenciesFiles(preloadedDependencies)
-    libraryList = h5pDependenciesToLibraryList(preloadedDependencies)
-
-    filesAssets = {
-        'js': list(),
-        'css': list()
-    }
-    if embedType == 'div':
-        for script in files['scripts']:
-            url = settings.MEDIA_URL + 'h5pp/' + \
-                script['path'] + script['version']
-            filesAssets['js'].append(
-                settings.MEDIA_URL + 'h5pp/' + script['path'])
-            integration['loadedJs'] = url
-        for style in files['styles']:
-            url = settings.MEDIA_URL + 'h5pp/' + \
-                style['path'] + style['version']
-            filesAssets['css'].append(
-                settings.MEDIA_URL + 'h5pp/' + style['path'])
-            integration['loadedCss'] = url
-        #Override CSS
-        filesAssets['css'].append(OVERRIDE_STYLES)
-        integration['loadedCss'] = OVERRIDE_STYLES
-
-    elif embedType == 'iframe':
-        h5pAddIframeAssets(request, integration, content['id'], files)
+    bundle = h5pBuildRenderBundle(request)
+    integration = h5pGetIntegration(request.user, bundle)
 
-    return {'integration': json.dumps(integration), 'assets': assets, 'filesAssets': filesAssets}
+    return {'integration': json.dumps(integration), 'assets': h5pAddCoreAssets(), 'filesAssets': bundle['filesAssets']}
 
 ##
 # Get a content by request
@@ -401,21 +839,42 @@ def h5pGetContent(request):
 def h5pGetContentSettings(user, content):
     interface = H5PDjango(user)
     core = interface.h5pGetInstance('core')
-    filtered = core.filterParameters(content)
+    contentSettings = h5pGetBaseContentSettings(core, content)
+    contentSettings['contentUserData'] = h5pGetContentUserData(
+        user, content['id'])
+    return contentSettings
+
+##
+# Get preloaded user data
+##
 
-    # Get preloaded user data
-    results = h5p_content_user_data.objects.filter(user_id=user.id, content_main_id=content[
-                                                   'id'], preloaded=1).values('sub_content_id', 'data_id', 'data')
 
+def h5pGetContentUserData(user, contentId):
     contentUserData = {
         0: {
             'state': '{}'
         }
     }
+    if not user.id:
+        return contentUserData
+
+    results = h5p_content_user_data.objects.filter(user_id=user.id, content_main_id=contentId,
+                                                   preloaded=1).values('sub_content_id', 'data_id', 'data')
     for result in results:
-        contentUserData[result['sub_content_id']][
+        contentUserData.setdefault(result['sub_content_id'], dict())[
             result['data_id']] = result['data']
 
+    return contentUserData
+
+##
+# Get the settings of a content which are the same for every user
+##
+
+
+def h5pGetBaseContentSettings(core, content):
+    # The export file is built by the filter job queued when it was saved
+    filtered = core.filterParameters(content, False)
+
     contentSettings = {
         'library': libraryToString(content['library']),
         'jsonContent': filtered,
@@ -425,11 +884,31 @@ def h5pGetContentSettings(user, content):
         'mainId': content['id'],
         'url': str(content['url']),
         'title': str(content['title'].encode('utf-8')),
-        'contentUserData': contentUserData,
-        'displayOptions': content['displayOptions']
+        'displayOptions': content['displayOptions'],
+        'imageVariants': h5pGetImageVariants(core, content['id'])
     }
     return contentSettings
 
+##
+# Get the URLs of the resized variants of the images of a content, by
+# path of the original image, smallest first
+##
+
+
+def h5pGetImageVariants(core, contentId):
+    url = settings.BASE_URL + settings.MEDIA_URL + \
+        'h5pp/content/' + str(contentId) + '/'
+    imageVariants = dict()
+    for path, image in core.fs.getImageVariants(contentId).items():
+        imageVariants[path] = [{
+            'src': url + variant['path'],
+            'width': variant['width'],
+            'height': variant['height'],
+            'mime': variant['mime']
+        } for variant in image['variants']]
+
+    return imageVariants
+
 
 def h5pGetResizeUrl():
     return settings.H5P_PATH + '/js/h5p-resizer.js'
@@ -442,19 +921,67 @@ def h5pGetContentId(request):
     return request.GET['contentId']
 
 
+##
+# Get a page of contents with the scores the user is allowed to see.
+# The page starts after the cursor given in the "after" parameter, None
+# if the cursor is invalid.
+##
+
+
 def h5pGetListContent(request):
     interface = H5PDjango(request.user)
-    contents = interface.getNumContentPlus()
-    if contents > 0:
-        result = list()
-        for content in interface.loadAllContents():
-            load = interface.loadContent(content['content_id'])
-            load['score'] = getUserScore(content['content_id'])
-            result.append(load)
-        return result
-    else:
+    pageSize = getattr(settings, 'H5P_LIST_PAGE_SIZE', 50)
+    after = None
+    if request.GET.get('after'):
+        after = decodeListCursor(request.GET['after'])
+        if after == None:
+            return None
+
+    contents = interface.loadContentsList(pageSize + 1, after)
+    if len(contents) == 0:
         return 0
 
+    nextCursor = None
+    if len(contents) > pageSize:
+        contents = contents[0:pageSize]
+        nextCursor = encodeListCursor(contents[-1])
+
+    if request.user.is_authenticated():
+        contentIds = [content['id'] for content in contents]
+        if request.user.is_superuser:
+            scores = getContentsScores(contentIds)
+        else:
+            ownedIds = [content['id'] for content in contents
+                        if content['author'] == request.user.username]
+            scores = getContentsScores(contentIds, request.user, ownedIds)
+        summaries = getContentsScoreSummary(contentIds)
+        for content in contents:
+            content['score'] = scores.get(content['id'], list())
+            content['scoreSummary'] = summaries.get(
+                content['id'], {'users': 0, 'finished': 0})
+
+    return {'contents': contents, 'next': nextCursor}
+
+##
+# The cursor of the list holds the title and the id of the last content
+# of the page, so the next page is found even if that content is deleted
+##
+
+
+def encodeListCursor(content):
+    return base64.urlsafe_b64encode(json.dumps([content['title'], content['id']]))
+
+
+def decodeListCursor(cursor):
+    try:
+        title, contentId = json.loads(base64.urlsafe_b64decode(str(cursor)))
+    except (TypeError, ValueError, UnicodeEncodeError):
+        return None
+    if not isinstance(title, basestring) or not isinstance(contentId, (int, long)):
+        return None
+
+    return title, contentId
+
 ##
 # Determine the correct embed type to use.
 ##
@@ -552,46 +1079,22 @@ def h5pAddIframeAssets(request, integration, contentId, files):
 ##
 # Generate embed page to be included in iframe
 ##
-def h5pEmbed(request):
-    h5pPath = settings.STATIC_URL + 'h5p/'
-    coreSettings = h5pGetCoreSettings(request.user)
-    framework = H5PDjango(request.user)
-    
-    scripts = list()
-    for script in SCRIPTS:
-        scripts.append(h5pPath + script)
-    styles = list()
-    for style in STYLES:
-        styles.append(h5pPath + style)
-
-    integration = h5pGetCoreSettings(request.user)
-    
-    content = h5pGetContent(request)
+def h5pEmbed(request, content=None):
+    bundle = h5pGetRenderBundle(request, content)
+    integration = h5pGetIntegration(request.user, bundle)
 
-    integration['contents'] = dict()
-    integration['contents']['cid-' + content['id']] = h5pGetContentSettings(request.user, content)
-
-    core = framework.h5pGetInstance('core')
-    preloadedDependencies = core.loadContentDependencies(content['id'])
-    files = core.getDependenciesFiles(preloadedDependencies)
-    libraryList = h5pDependenciesToLibraryList(preloadedDependencies)
-
-    scripts = scripts + core.getAssetsUrls(files['scripts'])
-    styles = styles + core.getAssetsUrls(files['styles'])
-
-    return {'h5p': json.dumps(integration), 'scripts': scripts, 'styles': styles, 'lang': settings.H5P_LANGUAGE}
+    return {'h5p': json.dumps(integration), 'scripts': bundle['scripts'], 'styles': bundle['styles'], 'lang': settings.H5P_LANGUAGE}
 
 def getUserScore(contentId, user=None, ajax=False):
     if user != None:
         scores = h5p_points.objects.filter(
             content_id=contentId, uid=user.id).values('points', 'max_points')
+        startedBuffer = getStartedBuffer()
+        if len(scores) == 0 and startedBuffer != None and startedBuffer.get((int(contentId), user.id)) != None:
+            # Content viewed but not written yet
+            scores = [{'points': None, 'max_points': None}]
     else:
-        scores = h5p_points.objects.filter(content_id=contentId)
-        for score in scores:
-            score.uid = User.objects.get(id=score.uid).username
-            score.has_finished = score.finished >= score.started
-            score.points = '..' if score.points == None else score.points
-            score.max_points = '..' if score.max_points == None else score.max_points
+        scores = getContentsScores([contentId]).get(int(contentId), list())
 
     if len(scores) > 0:
         if ajax:
@@ -600,34 +1103,152 @@ def getUserScore(contentId, user=None, ajax=False):
 
     return None
 
-def exportScore(contentId=None):
-    response = ''
-    if contentId:
-        scores = h5p_points.objects.filter(content_id=contentId)
-        content = h5p_contents.objects.get(content_id=contentId)
-        response = response + '[Content] : %s - [Users] : %s\n' % (content.title, len(scores))
-        for score in scores:
-            score.uid = User.objects.get(id=score.uid).username
-            score.has_finished = 'Completed' if score.finished >= score.started else 'Not completed'
-            score.points = '..' if score.points == None else score.points
-            score.max_points = '..' if score.max_points == None else score.max_points
-            response = response + '[Username] : %s | [Current] : %s | [Max] : %s | [Progression] : %s\n' % (score.uid, score.points, score.max_points, score.has_finished)
-        return response
+##
+# Get the scores of several contents in one query, with the usernames
+# resolved in a second one. If user is given, only his own scores and the
+# scores of the contents in ownedIds are returned.
+##
 
-    scores = h5p_points.objects.all()
-    response = response + '[Users] : %s\n' % len(scores)
-    currentContent = ''
+
+def getContentsScores(contentIds, user=None, ownedIds=None):
+    scores = h5p_points.objects.filter(content_id__in=contentIds)
+    if user != None:
+        scores = scores.filter(
+            Q(uid=user.id) | Q(content_id__in=ownedIds if ownedIds else list()))
+    scores = list(scores.values('content_id', 'uid', 'started',
+                                'finished', 'points', 'max_points'))
+    scores = mergeStartedBuffer(scores, contentIds, user, ownedIds)
+
+    usernames = dict(User.objects.filter(id__in=set(
+        score['uid'] for score in scores)).values_list('id', 'username'))
+
+    result = dict()
     for score in scores:
-        content = h5p_contents.objects.get(content_id=score.content_id)
-        if content.content_id != currentContent:
-            response = response + '--------------------\n[Content] : %s\n--------------------\n' % content.title
-        score.uid = User.objects.get(id=score.uid).username
-        score.has_finished = 'Completed' if score.finished >= score.started else 'Not completed'
-        score.points = '..' if score.points == None else score.points
-        score.max_points = '..' if score.max_points == None else score.max_points
-        response = response + '[Username] : %s | [Current] : %s | [Max] : %s | [Progression] : %s\n' % (score.uid, score.points, score.max_points, score.has_finished)
-        currentContent = content.content_id
-    return response
+        score['uid'] = usernames.get(score['uid'], '')
+        score['has_finished'] = score['finished'] >= score['started']
+        score['points'] = '..' if score['points'] == None else score['points']
+        score['max_points'] = '..' if score['max_points'] == None else score['max_points']
+        result.setdefault(score['content_id'], list()).append(score)
+
+    return result
+
+##
+# Count the users and the users who finished, for several contents.
+# The buffered started timestamps are counted like in mergeStartedBuffer.
+##
+
+
+def getContentsScoreSummary(contentIds):
+    summaries = h5p_points.objects.filter(content_id__in=contentIds).order_by().values('content_id').annotate(
+        users=Count('id'),
+        finished=Sum(Case(When(finished__gte=F('started'), then=Value(1)),
+                          default=Value(0), output_field=IntegerField())))
+
+    result = dict()
+    for summary in summaries:
+        result[summary['content_id']] = {
+            'users': summary['users'],
+            'finished': summary['finished']
+        }
+
+    startedBuffer = getStartedBuffer()
+    contentIds = set(int(contentId) for contentId in contentIds)
+    buffered = dict((key, started) for key, started in startedBuffer.items()
+                    if key[0] in contentIds) if startedBuffer != None else None
+    if not buffered:
+        return result
+
+    match = Q()
+    for contentId, userId in buffered:
+        match = match | Q(content_id=contentId, uid=userId)
+    for contentId, userId, started, finished in h5p_points.objects.filter(match).values_list(
+            'content_id', 'uid', 'started', 'finished'):
+        # Started again since it was finished
+        if started <= finished < buffered.pop((contentId, userId)):
+            result[contentId]['finished'] -= 1
+
+    for contentId, userId in buffered:
+        summary = result.setdefault(contentId, {'users': 0, 'finished': 0})
+        summary['users'] += 1
+
+    return result
+
+##
+# Export the users score as a stream of lines, in "txt", "csv" or "jsonl"
+# format. Scores are read by batches of H5P_EXPORT_BATCH_SIZE rows and the
+# usernames of each batch are resolved with a single query.
+##
+
+
+def exportScore(contentId=None, format='txt'):
+    scores = h5p_points.objects.all()
+    titles = h5p_contents.objects.all()
+    if contentId:
+        scores = scores.filter(content_id=contentId)
+        titles = titles.filter(content_id=contentId)
+    titles = dict(titles.values_list('content_id', 'title'))
+
+    if format == 'csv':
+        yield exportScoreCsvRow(['content_id', 'content', 'username', 'points',
+                                 'max_points', 'started', 'finished', 'completed'])
+    elif format == 'txt':
+        if contentId:
+            yield '[Content] : %s - [Users] : %s\n' % (titles.get(int(contentId), ''), scores.count())
+        else:
+            yield '[Users] : %s\n' % scores.count()
+
+    currentContent = None
+    for score in exportScoreRows(scores):
+        score['content'] = titles.get(score['content_id'], '')
+        score['completed'] = score['finished'] >= score['started']
+        if format == 'csv':
+            yield exportScoreCsvRow([score['content_id'], score['content'], score['username'], score['points'],
+                                     score['max_points'], score['started'], score['finished'], int(score['completed'])])
+        elif format == 'jsonl':
+            yield json.dumps(score) + '\n'
+        else:
+            line = ''
+            if not contentId and score['content_id'] != currentContent:
+                line = '--------------------\n[Content] : %s\n--------------------\n' % score['content']
+                currentContent = score['content_id']
+            yield line + '[Username] : %s | [Current] : %s | [Max] : %s | [Progression] : %s\n' % (
+                score['username'],
+                '..' if score['points'] == None else score['points'],
+                '..' if score['max_points'] == None else score['max_points'],
+                'Completed' if score['completed'] else 'Not completed')
+
+##
+# Walk the scores ordered by content with a keyset on (content_id, id), so
+# only one batch is held in memory whatever the database backend.
+##
+
+
+def exportScoreRows(scores):
+    batchSize = getattr(settings, 'H5P_EXPORT_BATCH_SIZE', 1000)
+    scores = scores.order_by('content_id', 'id').values(
+        'id', 'content_id', 'uid', 'started', 'finished', 'points', 'max_points')
+    last = None
+    while True:
+        batch = scores
+        if last != None:
+            batch = batch.filter(Q(content_id__gt=last['content_id']) | Q(
+                content_id=last['content_id'], id__gt=last['id']))
+        batch = list(batch[0:batchSize])
+        if len(batch) == 0:
+            return
+
+        usernames = dict(User.objects.filter(id__in=set(
+            score['uid'] for score in batch)).values_list('id', 'username'))
+        for score in batch:
+            score['username'] = usernames.get(score['uid'], '')
+            yield score
+
+        last = batch[-1]
+
+def exportScoreCsvRow(row):
+    output = StringIO.StringIO()
+    csv.writer(output).writerow([unicode(value).encode('utf-8') for value in row])
+    return output.getvalue()
 ##
 # Uninstall H5P
 ##
@@ -641,6 +1262,7 @@ def uninstall():
     h5p_contents_libraries.objects.all().delete()
     h5p_libraries.objects.all().delete()
     h5p_libraries_libraries.objects.all().delete()
+    h5p_libraries_cachedassets.objects.all().delete()
     h5p_libraries_languages.objects.all().delete()
     h5p_contents.objects.all().delete()
     h5p_points.objects.all().delete()
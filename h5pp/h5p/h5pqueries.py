@@ -0,0 +1,145 @@
+##
+# Parameterised SQL statements used on the hot paths.
+# On PostgreSQL, the statements can be prepared once per connection and
+# executed by name when H5P_PREPARED_STATEMENTS is set. Leave it unset
+# behind a transaction-pooling proxy, which does not keep sessions.
+##
+from django.conf import settings
+from django.db import connection
+import threading
+
+QUERIES = {
+    'libraryUsage': """
+			SELECT COUNT(distinct n.content_id)
+			FROM h5p_libraries l
+			JOIN h5p_contents_libraries cl ON l.library_id = cl.library_id
+			JOIN h5p_contents n ON cl.content_id = n.content_id
+			WHERE l.library_id = %s
+		""",
+    'libraryDependencies': """
+			SELECT hl.machine_name AS name,
+					hl.major_version AS major,
+					hl.minor_version AS minor,
+					hll.dependency_type AS type
+			FROM h5p_libraries_libraries hll
+			JOIN h5p_libraries hl ON hll.required_library_id = hl.library_id
+			WHERE hll.library_id = %s
+		""",
+    'content': """
+			SELECT hn.content_id AS id,
+					hn.title,
+					hn.json_contents AS params,
+					hn.embed_type,
+					hn.content_type,
+					hn.author,
+					hl.library_id,
+					hl.machine_name AS library_name,
+					hl.major_version AS library_major_version,
+					hl.minor_version AS library_minor_version,
+					hl.embed_types AS library_embed_types,
+					hl.fullscreen AS library_fullscreen,
+					hn.filtered,
+					hn.filtered_subcontents,
+					hn.disable,
+					hn.slug
+			FROM h5p_contents hn
+			JOIN h5p_libraries hl ON hl.library_id = hn.main_library_id
+			WHERE content_id = %s
+		""",
+    'contentDependencies': """
+				SELECT hl.library_id,
+						hl.machine_name,
+						hl.major_version,
+						hl.minor_version,
+						hl.patch_version,
+						hl.preloaded_css,
+						hl.preloaded_js,
+						hnl.drop_css,
+						hnl.dependency_type
+				FROM h5p_contents_libraries hnl
+				JOIN h5p_libraries hl ON hnl.library_id = hl.library_id
+				WHERE hnl.content_id = %s
+				ORDER BY hnl.weight
+			""",
+    'contentDependenciesByType': """
+				SELECT hl.library_id,
+						hl.machine_name,
+						hl.major_version,
+						hl.minor_version,
+						hl.patch_version,
+						hl.preloaded_css,
+						hl.preloaded_js,
+						hnl.drop_css,
+						hnl.dependency_type
+				FROM h5p_contents_libraries hnl
+				JOIN h5p_libraries hl ON hnl.library_id = hl.library_id
+				WHERE hnl.content_id = %s AND hnl.dependency_type = %s
+				ORDER BY hnl.weight
+			""",
+    'libraryLanguage': """
+			SELECT hlt.language_json
+			FROM h5p_libraries_languages hlt
+			JOIN h5p_libraries hl ON hl.library_id = hlt.library_id
+			WHERE hl.machine_name = %s AND hl.major_version = %s AND hl.minor_version = %s AND hlt.language_code = %s
+			"""
+}
+
+# Statements prepared on the raw connection of each thread
+prepared = threading.local()
+
+##
+# Run a named statement and return the cursor
+##
+
+
+def executeQuery(name, params, prepare=None):
+    if prepare == None:
+        prepare = getattr(settings, 'H5P_PREPARED_STATEMENTS', False)
+
+    cursor = connection.cursor()
+    if prepare and connection.vendor == 'postgresql':
+        statement = prepareQuery(cursor, name)
+        cursor.execute('EXECUTE %s(%s)' % (statement, ', '.join(
+            ['%s'] * len(params))) if len(params) > 0 else 'EXECUTE ' + statement, params)
+    else:
+        cursor.execute(QUERIES[name], params)
+
+    return cursor
+
+##
+# Run a named statement and return all the rows as dicts
+##
+
+
+def fetchAll(name, params, prepare=None):
+    cursor = executeQuery(name, params, prepare)
+    desc = cursor.description
+    return [
+        dict(zip([col[0] for col in desc], row))
+        for row in cursor.fetchall()
+    ]
+
+##
+# Prepare a statement on the current connection if it is not already,
+# and return the name to execute it with
+##
+
+
+def prepareQuery(cursor, name):
+    statement = 'h5pp_' + name.lower()
+    if getattr(prepared, 'connection', None) is not connection.connection:
+        # New database session, find out what it already holds
+        cursor.execute('SELECT name FROM pg_prepared_statements')
+        prepared.connection = connection.connection
+        prepared.names = set(row[0] for row in cursor.fetchall())
+
+    if statement not in prepared.names:
+        sql = QUERIES[name]
+        position = 1
+        while '%s' in sql:
+            sql = sql.replace('%s', '$' + str(position), 1)
+            position = position + 1
+        cursor.execute('PREPARE %s AS %s' % (statement, sql))
+        prepared.names.add(statement)
+
+    return statement
@@ -0,0 +1,231 @@
+##
+# Staging of the uploaded .h5p packages and of the chunked editor uploads.
+# Each upload gets its own folder in the tmp dir, so concurrent uploads
+# never see each other's files. The folders left behind by interrupted
+# requests are removed after H5P_UPLOAD_MAX_AGE seconds.
+##
+from django.conf import settings
+from django.core.files.uploadedfile import UploadedFile
+import tempfile
+import hashlib
+import shutil
+import uuid
+import time
+import re
+import os
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# Prefix of the staging folders, the other files of the tmp dir are kept
+STAGING_PREFIX = 'upload-'
+
+
+class H5PUploadSession:
+
+    ##
+    # Constructor for the H5PUploadSession
+    ##
+    def __init__(self, tmpPath=None):
+        if tmpPath == None:
+            tmpPath = os.path.join(settings.MEDIA_ROOT, 'h5pp', 'tmp')
+        prepareStagingPath(tmpPath)
+        self.folderPath = tempfile.mkdtemp(prefix=STAGING_PREFIX, dir=tmpPath)
+        self.path = None
+        # Set by H5PValidator.isValidPackage once the package is valid
+        self.package = None
+
+    ##
+    # Write an uploaded file to the staging folder and return its path
+    ##
+    def saveUploadedFile(self, files, filename):
+        # Only the base name of the client file name is kept
+        filename = os.path.basename(filename.replace('\\', '/'))
+        self.path = os.path.join(self.folderPath, filename)
+        with open(self.path, 'wb') as destination:
+            for chunk in files.chunks():
+                destination.write(chunk)
+
+        return self.path
+
+    ##
+    # Remove the staging folder and everything left in it
+    ##
+    def cleanup(self):
+        if self.package != None:
+            self.package.delete()
+            self.package = None
+        shutil.rmtree(self.folderPath, ignore_errors=True)
+
+
+class H5PChunkedUpload:
+
+    ##
+    # Constructor for the H5PChunkedUpload. Large editor uploads are sent
+    # in parts of at most H5P_UPLOAD_CHUNK_SIZE bytes, appended to a file
+    # of the staging folder of the upload. A new upload of size bytes is
+    # started by a logged in user when uploadId is None. Raises ValueError
+    # for an unknown upload, one started by another user, or a size larger
+    # than H5P_UPLOAD_MAX_SIZE.
+    ##
+    def __init__(self, user, uploadId=None, tmpPath=None, size=None):
+        if tmpPath == None:
+            tmpPath = os.path.join(settings.MEDIA_ROOT, 'h5pp', 'tmp')
+        self.chunkSize = getChunkSize()
+        owner = str(user.pk) if user.pk != None else ''
+
+        if uploadId == None:
+            if user.pk == None:
+                raise ValueError('Login required')
+            if size == None or size <= 0 or size > getMaxSize():
+                raise ValueError('The file must not be larger than %d bytes' % getMaxSize())
+            prepareStagingPath(tmpPath)
+            uploadId = uuid.uuid4().hex
+            self.folderPath = os.path.join(tmpPath, STAGING_PREFIX + uploadId)
+            os.mkdir(self.folderPath)
+            with open(os.path.join(self.folderPath, 'owner'), 'w') as f:
+                f.write(owner)
+            with open(os.path.join(self.folderPath, 'size'), 'w') as f:
+                f.write(str(size))
+        else:
+            if not re.search('^[0-9a-f]{32}$', uploadId):
+                raise ValueError('Invalid upload id')
+            self.folderPath = os.path.join(tmpPath, STAGING_PREFIX + uploadId)
+            try:
+                with open(os.path.join(self.folderPath, 'owner')) as f:
+                    if f.read() != owner:
+                        raise ValueError('Unknown upload')
+                with open(os.path.join(self.folderPath, 'size')) as f:
+                    size = int(f.read())
+            except (IOError, ValueError):
+                raise ValueError('Unknown upload')
+
+        # Declared size of the file, no more bytes are accepted
+        self.size = size
+
+        self.uploadId = uploadId
+        self.path = os.path.join(self.folderPath, 'data')
+
+    ##
+    # Number of bytes received so far, where the next part starts
+    ##
+    def getOffset(self):
+        return os.path.getsize(self.path) if os.path.exists(self.path) else 0
+
+    def isComplete(self):
+        return self.getOffset() >= self.size
+
+    ##
+    # Append a part given as chunks and return the new offset. The part
+    # is refused when it does not start at the current offset, is larger
+    # than chunkSize, goes past the declared size or does not match its
+    # SHA-256 checksum. The client then resumes from getOffset().
+    ##
+    def appendPart(self, chunks, offset, checksum=None):
+        with open(self.path, 'ab') as f:
+            if fcntl != None:
+                # Parts of the same upload sent at the same time
+                fcntl.flock(f, fcntl.LOCK_EX)
+            f.seek(0, os.SEEK_END)
+            if f.tell() != offset:
+                raise ValueError('The part does not start at offset %d' % f.tell())
+
+            sha = hashlib.sha256()
+            size = 0
+            for chunk in chunks:
+                size += len(chunk)
+                if size > self.chunkSize:
+                    f.truncate(offset)
+                    raise ValueError('The part is larger than %d bytes' % self.chunkSize)
+                if offset + size > self.size:
+                    f.truncate(offset)
+                    raise ValueError('The file is larger than %d bytes' % self.size)
+                sha.update(chunk)
+                f.write(chunk)
+
+            if checksum and sha.hexdigest() != checksum.lower():
+                f.truncate(offset)
+                raise ValueError('The checksum of the part does not match')
+
+        # Keeps the folder from being cleaned up while parts are received
+        os.utime(self.folderPath, None)
+        return offset + size
+
+    ##
+    # The assembled file, to be processed like a regular upload
+    ##
+    def getFile(self, name, contentType=None):
+        return H5PAssembledFile(open(self.path, 'rb'), name,
+                                contentType or 'application/octet-stream', self.getOffset(), None)
+
+    def cleanup(self):
+        shutil.rmtree(self.folderPath, ignore_errors=True)
+
+
+class H5PAssembledFile(UploadedFile):
+
+    ##
+    # Path of the file on disk, so the storage can move it instead of
+    # copying it, like for the uploads Django writes to temporary files
+    ##
+    def temporary_file_path(self):
+        return self.file.name
+
+##
+# Size of the parts of the chunked uploads
+##
+
+
+def getChunkSize():
+    return getattr(settings, 'H5P_UPLOAD_CHUNK_SIZE', 5 * 1024 * 1024)
+
+##
+# Largest file accepted by the chunked uploads
+##
+
+
+def getMaxSize():
+    return getattr(settings, 'H5P_UPLOAD_MAX_SIZE', 1024 * 1024 * 1024)
+
+##
+# Create the tmp dir if needed and remove the old staging folders
+##
+
+
+def prepareStagingPath(tmpPath):
+    try:
+        os.makedirs(tmpPath)
+    except OSError:
+        # Created by another request
+        if not os.path.isdir(tmpPath):
+            raise
+
+    cleanupStagingFolders(tmpPath)
+
+##
+# Remove the staging folders older than maxAge seconds. Returns the
+# number of folders removed.
+##
+
+
+def cleanupStagingFolders(tmpPath, maxAge=None):
+    if maxAge == None:
+        maxAge = getattr(settings, 'H5P_UPLOAD_MAX_AGE', 86400)
+    limit = time.time() - maxAge
+
+    removed = 0
+    for name in os.listdir(tmpPath):
+        if not name.startswith(STAGING_PREFIX):
+            continue
+        folder = os.path.join(tmpPath, name)
+        try:
+            if os.path.getmtime(folder) < limit:
+                shutil.rmtree(folder)
+                removed += 1
+        except OSError:
+            # Removed by another request
+            pass
+
+    return removed
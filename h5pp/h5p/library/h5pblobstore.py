@@ -0,0 +1,174 @@
+##
+# Content addressed store of the media files. Each distinct file is kept
+# once under its SHA-256, and the content folders hold hard links to it,
+# so the same video used by many contents, their clones and the folders
+# exported from them share the same bytes on disk. The number of links
+# of a blob is its reference count, a blob only linked from the store is
+# not used anymore and is removed by collectGarbage.
+##
+import hashlib
+import shutil
+import errno
+import uuid
+import time
+import os
+
+
+class H5PBlobStore:
+
+    ##
+    # Constructor for the H5PBlobStore
+    ##
+    def __init__(self, path, chunkSize=65536):
+        self.path = path
+        self.chunkSize = chunkSize
+
+    ##
+    # Hard links are not available everywhere (Python 2 on Windows), the
+    # files are copied there and nothing is shared
+    ##
+    def isEnabled(self):
+        return hasattr(os, 'link')
+
+    def getBlobPath(self, key):
+        return os.path.join(self.path, key[0:2], key[2:])
+
+    ##
+    # Write a file given as chunks to the store and return the path of
+    # its blob. A blob which already exists is kept and touched, so the
+    # garbage collector does not remove it before it is linked.
+    ##
+    def store(self, chunks):
+        self.makeDirs(self.path)
+        tmpPath = os.path.join(self.path, '.' + str(uuid.uuid1()) + '.tmp')
+        sha = hashlib.sha256()
+        try:
+            with open(tmpPath, 'wb') as f:
+                for chunk in chunks:
+                    sha.update(chunk)
+                    f.write(chunk)
+
+            blob = self.getBlobPath(sha.hexdigest())
+            if os.path.exists(blob):
+                os.utime(blob, None)
+            else:
+                self.makeDirs(os.path.dirname(blob))
+                os.rename(tmpPath, blob)
+        finally:
+            if os.path.exists(tmpPath):
+                os.remove(tmpPath)
+
+        return blob
+
+    ##
+    # Move a file to the store and return the path of its blob. The file
+    # is only read to be hashed, it is renamed to its blob when it is on
+    # the same file system.
+    ##
+    def storeFile(self, path):
+        sha = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(self.chunkSize), ''):
+                sha.update(chunk)
+
+        blob = self.getBlobPath(sha.hexdigest())
+        if os.path.exists(blob):
+            os.utime(blob, None)
+            os.remove(path)
+            return blob
+
+        self.makeDirs(os.path.dirname(blob))
+        # Temporary files are only readable by their owner
+        os.chmod(path, 0644)
+        try:
+            os.rename(path, blob)
+        except OSError:
+            # Another file system, the blob must not be seen half written
+            tmpPath = os.path.join(self.path, '.' + str(uuid.uuid1()) + '.tmp')
+            shutil.copyfile(path, tmpPath)
+            os.rename(tmpPath, blob)
+            os.remove(path)
+
+        return blob
+
+    ##
+    # Make destination a link to a blob, or to any other file
+    ##
+    def link(self, source, destination):
+        self.makeDirs(os.path.dirname(destination))
+        tmpPath = destination + '.' + str(uuid.uuid1()) + '.tmp'
+        try:
+            os.link(source, tmpPath)
+        except (OSError, AttributeError):
+            # Another file system, or no hard links
+            shutil.copyfile(source, tmpPath)
+        os.rename(tmpPath, destination)
+
+    ##
+    # Save a file given as chunks to destination through the store
+    ##
+    def saveFile(self, chunks, destination):
+        if not self.isEnabled():
+            self.makeDirs(os.path.dirname(destination))
+            with open(destination, 'wb') as f:
+                for chunk in chunks:
+                    f.write(chunk)
+            return
+
+        self.link(self.store(chunks), destination)
+
+    ##
+    # Move the file at path to destination through the store
+    ##
+    def saveFilePath(self, path, destination):
+        if not self.isEnabled():
+            self.makeDirs(os.path.dirname(destination))
+            shutil.move(path, destination)
+            return
+
+        self.link(self.storeFile(path), destination)
+
+    ##
+    # Save a file object to destination through the store
+    ##
+    def saveFileObject(self, source, destination):
+        self.saveFile(iter(lambda: source.read(self.chunkSize), ''), destination)
+
+    ##
+    # Remove the blobs which are not linked from any content folder, and
+    # the files left by interrupted writes. Only the files older than
+    # minAge seconds are removed, the newer ones may be about to be
+    # linked. Returns the number of files and bytes removed.
+    ##
+    def collectGarbage(self, minAge=3600, dryRun=False):
+        count = 0
+        size = 0
+        if not os.path.isdir(self.path):
+            return (count, size)
+
+        limit = time.time() - minAge
+        for root, dirs, files in os.walk(self.path):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                    if stat.st_mtime >= limit:
+                        continue
+                    if stat.st_nlink > 1 and not name.endswith('.tmp'):
+                        continue
+                    if not dryRun:
+                        os.remove(path)
+                except OSError:
+                    # Removed by another collector
+                    continue
+                count += 1
+                size += stat.st_size
+
+        return (count, size)
+
+    def makeDirs(self, path):
+        try:
+            os.makedirs(path)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
@@ -12,9 +12,15 @@ import time
 import hashlib
 import uuid
 import cgi
+from multiprocessing.pool import ThreadPool
+from django.db import transaction
 from django.template.defaultfilters import slugify
 from h5pdevelopment import H5PDevelopment
 from h5pdefaultstorage import H5PDefaultStorage
+from h5pxss import H5PXssFilter
+from h5pzipstream import H5PZipStream
+from h5ppackage import H5PPackage
+from h5pdependencygraph import H5PDependencyGraph
 
 is_array = lambda var: isinstance(var, (list, tuple))
 
@@ -25,6 +31,19 @@ def empty(variable):
     return False
 
 
+def escapeValue(value):
+    if isinstance(value, basestring):
+        return cgi.escape(value, True)
+    return value
+
+
+def intValue(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return 0
+
+
 def substr_replace(subject, replace, start, length):
     if length == None:
         return subject[:start] + replace
@@ -142,51 +161,50 @@ class H5PValidator:
 
     ##
     # Validates a .h5p file
+    #
+    # The package is validated from the central directory of the zip,
+    # nothing is extracted. H5PStorage extracts it once it is valid.
+    # upload is the H5PUploadSession of the request, without it the path
+    # given to the framework is used.
     ##
-    def isValidPackage(self, skipContent=False, upgradeOnly=False):
+    def isValidPackage(self, skipContent=False, upgradeOnly=False, upload=None):
 
-        # Create a temporary dir to extract package in.
-        tmpDir = self.h5pF.getUploadedH5pFolderPath()
-        tmpPath = self.h5pF.getUploadedH5pPath()
+        tmpPath = upload.path if upload != None else self.h5pF.getUploadedH5pPath()
 
         # Only allow files with the .h5p extension.
         if tmpPath[-3:].lower() != "h5p":
             print(
                 "The file you uploaded is not a valid HTML5 Package (It does not have the .h5p file extension)")
-            self.h5pC.deleteFileTree(tmpDir)
+            if os.path.exists(tmpPath):
+                os.remove(tmpPath)
             return False
 
-        zipf = zipfile.ZipFile(tmpPath, "r")
-        if zipf:
-            zipf.extractall(tmpDir)
-            zipf.close()
-        else:
+        try:
+            package = H5PPackage(tmpPath)
+        except (zipfile.BadZipfile, IOError, ValueError) as e:
             print(
-                "The file you uploaded is not a valid HTML5 Package (We are unable to unzip it)")
-            self.h5pC.deleteFileTree(tmpDir)
+                "The file you uploaded is not a valid HTML5 Package (We are unable to unzip it : %s)" % e)
+            if os.path.exists(tmpPath):
+                os.remove(tmpPath)
             return False
 
-        os.remove(tmpPath)
-
         # Process content and libraries
         valid = True
         libraries = dict()
-        files = os.listdir(tmpDir)
         mainH5pData = None
         libraryJsonData = None
         contentJsonData = None
         mainH5pExists = imageExists = contentExists = False
-        for f in files:
+        for f in package.getRootFiles():
             if f[0:1] in [".", "_"]:
                 continue
 
-            filePath = tmpDir + "/" + f
             # Check for h5p.json file.
             if f.lower() == "h5p.json":
                 if skipContent == True:
                     continue
 
-                mainH5pData = self.getJsonData(filePath)
+                mainH5pData = package.getJsonData(f)
                 if mainH5pData == False:
                     valid = False
                     print(
@@ -205,20 +223,21 @@ class H5PValidator:
             elif f.lower() == "h5p.jpg":
                 imageExists = True
 
+            # Other files are ignored. Probably files that shouldn"t have
+            # been included.
+
+        for f in package.getFolders():
+            if f[0:1] in [".", "_"]:
+                continue
+
             # Content directory holds content.
-            elif f == "content":
+            if f == "content":
                 # We do a separate skipContent check to avoid having the
                 # content folder being treated as a library.
                 if skipContent:
                     continue
-                if not os.path.isdir(filePath):
-                    print(
-                        "Invalid content folder")
-                    valid = False
-                    continue
 
-                contentJsonData = self.getJsonData(
-                    filePath + "/" + "content.json")
+                contentJsonData = package.getJsonData("content/content.json")
 
                 if contentJsonData == False:
                     print(
@@ -230,19 +249,14 @@ class H5PValidator:
                     # In the future we might left the libraries provide
                     # validation functions for content.json.
 
-                if not self.h5pCV.validateContentFiles(filePath):
-                    # validateContentFiles adds potential errors to the queue
+                if not self.h5pCV.validateContentFileNames(package.getFiles(f)):
+                    # validateContentFileNames adds potential errors to the queue
                     valid = False
                     continue
 
             # The rest should be library folders.
             elif self.h5pF.mayUpdateLibraries():
-                if not os.path.isdir(filePath):
-                    # Ignore self. Probably a file that shouldn"t have been
-                    # included.
-                    continue
-
-                libraryH5PData = self.getLibraryData(f, filePath, tmpDir)
+                libraryH5PData = self.getLibraryData(f, package)
 
                 if libraryH5PData != False:
                     # Library"s directory name must be:
@@ -260,7 +274,7 @@ class H5PValidator:
                         valid = False
                         continue
 
-                    libraryH5PData["uploadDirectory"] = filePath
+                    libraryH5PData["packageFolder"] = f
                     libraries[self.h5pC.libraryToString(
                         libraryH5PData)] = libraryH5PData
                 else:
@@ -319,20 +333,25 @@ class H5PValidator:
 
             valid = empty(missingLibraries[0]) and valid
 
-        if not valid:
-            self.h5pC.deleteFileTree(tmpDir)
+        if valid:
+            # Kept open for H5PStorage
+            self.h5pC.package = package
+            if upload != None:
+                upload.package = package
+        else:
+            package.delete()
         return valid
 
     ##
     # Validates a H5P library
     ##
-    def getLibraryData(self, f, filePath, tmpDir):
+    def getLibraryData(self, f, package):
         if not re.search("^[\w0-9\-\.]{1,255}$", f):
             print(
                 "Invalid library name: %s" % (f))
             return False
 
-        h5pData = self.getJsonData(filePath + "/" + "library.json")
+        h5pData = package.getJsonData(f + "/" + "library.json")
 
         if h5pData == False:
             print(
@@ -340,10 +359,10 @@ class H5PValidator:
             return False
 
         # validate json if a semantics file is provided
-        semanticsPath = filePath + "/" + "semantics.json"
+        semanticsPath = f + "/" + "semantics.json"
 
-        if os.path.exists(semanticsPath):
-            semantics = self.getJsonData(semanticsPath, True)
+        if package.hasFile(semanticsPath):
+            semantics = package.getJsonData(semanticsPath, True)
             if semantics == False:
                 print(
                     "Invalid semantics.json file has been included in the library %s" % (f))
@@ -352,45 +371,42 @@ class H5PValidator:
                 h5pData["semantics"] = semantics
 
         # validate language folder if it exists
-        languagePath = filePath + "/" + "language"
+        for name in package.getFiles(f):
+            if not name.startswith("language/"):
+                continue
 
-        if os.path.exists(languagePath):
-            languageFiles = os.listdir(languagePath)
-            for languageFile in languageFiles:
-                if languageFile in [".", ".."]:
-                    continue
-                if not re.search("^(-?[a-z]+){1,7}\.json$", languageFile):
-                    print(
-                        "Invalid language file %s in library %s" % (languageFile, f))
-                    return False
+            languageFile = name[len("language/"):]
+            if not re.search("^(-?[a-z]+){1,7}\.json$", languageFile):
+                print(
+                    "Invalid language file %s in library %s" % (languageFile, f))
+                return False
 
-                languageJson = self.getJsonData(
-                    languagePath + "/" + languageFile, True)
+            languageJson = package.getJsonData(f + "/" + name, True)
 
-                if languageJson == False:
-                    print(
-                        "Invalid language file %s has been included in the library %s" % (languageFile, f))
-                    return False
-
-                # parts[0] is the language code
-                parts = languageFile.split(".")
-                lang = {parts[0]: languageJson}
-                if not "language" in h5pData:
-                    h5pData[u"language"] = lang
-                else:
-                    h5pData["language"][parts[0]] = languageJson
+            if languageJson == False:
+                print(
+                    "Invalid language file %s has been included in the library %s" % (languageFile, f))
+                return False
+
+            # parts[0] is the language code
+            parts = languageFile.split(".")
+            lang = {parts[0]: languageJson}
+            if not "language" in h5pData:
+                h5pData[u"language"] = lang
+            else:
+                h5pData["language"][parts[0]] = languageJson
 
         validLibrary = self.isValidH5pData(
             h5pData, f, self.libraryRequired, self.libraryOptional)
 
-        validLibrary = self.h5pCV.validateContentFiles(filePath, True)
+        validLibrary = self.h5pCV.validateContentFileNames(package.getFiles(f), True)
 
         if "preloadedJs" in h5pData:
             validLibrary = self.isExistingFiles(
-                h5pData["preloadedJs"], tmpDir, f) and validLibrary
+                h5pData["preloadedJs"], package, f) and validLibrary
         if "preloadedCss" in h5pData:
             validLibrary = self.isExistingFiles(
-                h5pData["preloadedCss"], tmpDir, f) and validLibrary
+                h5pData["preloadedCss"], package, f) and validLibrary
         if validLibrary:
             return h5pData
         else:
@@ -430,10 +446,10 @@ class H5PValidator:
     #
     # Triggers error messages if files doesn"t exist
     ##
-    def isExistingFiles(self, files, tmpDir, library):
+    def isExistingFiles(self, files, package, library):
         for f in files:
             path = f["path"].replace("\\", "/")
-            if not os.path.exists(tmpDir + "/" + library + "/" + path):
+            if not package.hasFile(library + "/" + path.lstrip("/")):
                 print(
                     "The file %s is missing from library: %s" % (path, library))
                 return False
@@ -599,14 +615,14 @@ class H5PStorage:
     ##
     # Saves a H5P file
     ##
-    def savePackage(self, content=None, contentMainId=None, skipContent=False, options=dict()):
+    def savePackage(self, content=None, contentMainId=None, skipContent=False, options=dict(), upload=None):
+        if upload != None:
+            self.h5pC.package = upload.package
+
         if self.h5pF.mayUpdateLibraries():
             # Save the libraries we processed during validation
             self.saveLibraries()
         if not skipContent:
-            basePath = self.h5pF.getUploadedH5pFolderPath()
-            current_path = basePath + "/content"
-
             # Save content
             if content == None:
                 content = dict()
@@ -621,8 +637,7 @@ class H5PStorage:
                     content["library"] = dep
                     break
 
-            content["params"] = file_get_contents(
-                current_path + "/" + "content.json")
+            content["params"] = self.h5pC.package.read("content/content.json")
 
             if "disable" in options:
                 content["disable"] = options["disable"]
@@ -634,89 +649,128 @@ class H5PStorage:
 
             self.contentId = contentId
 
-            if not self.h5pC.fs.saveContent(current_path, contentId):
+            if not self.h5pC.fs.saveContent("content", contentId, self.h5pC.package):
+                self.deletePackageFile()
                 return False
 
-            # Remove temp content folder
-            self.h5pC.deleteFileTree(basePath)
-
+        self.deletePackageFile()
         return True
 
+    ##
+    # Remove the uploaded package once it is installed
+    ##
+    def deletePackageFile(self):
+        if self.h5pC.package != None:
+            self.h5pC.package.delete()
+            self.h5pC.package = None
+
     ##
     # Helps savePackage.
     ##
     def saveLibraries(self):
+        global libraryIdMap
+
         # Keep track of the number of libraries that have been saved
         newOnes = 0
         oldOnes = 0
+
+        # Load the installed versions of the libraries and of their
+        # dependencies with a single query
+        machineNames = set()
+        for library in self.h5pC.librariesJsonData.itervalues():
+            machineNames.add(library["machineName"])
+            for dependencyType in ("preloaded", "dynamic", "editor"):
+                for dependency in library.get(dependencyType + "Dependencies", list()):
+                    machineNames.add(dependency["machineName"])
+        installed = self.h5pF.getLibraryVersions(machineNames)
+        devMode = self.h5pF.isInDevMode()
+
         # Go through libraries that came with self package
+        libraries = list()
         for libString, library in self.h5pC.librariesJsonData.iteritems():
-            # Find local library identifier
-            libraryId = self.h5pC.getLibraryId(library, libString)
-
-            # Assume new library
-            new = True
-            if libraryId != None:
+            library["saveDependencies"] = False
+            if libString in installed:
                 # Found old library
-                library["libraryId"] = libraryId
-
-                if self.h5pF.isPatchedLibrary(library):
-                    # self is a newer version than ours. Upgrade !
-                    new = False
-                else:
-                    library["saveDependencies"] = False
-                    # self is an older version, no need to save.
-                    self.h5pC.deleteFileTree(library['uploadDirectory'])
+                library["libraryId"] = installed[libString]["library_id"]
+                patchVersion = installed[libString]["patch_version"]
+                if not (patchVersion < library["patchVersion"] or (devMode and patchVersion == library["patchVersion"])):
+                    # self is an older version, no need to save nor extract.
                     continue
-
             else:
                 print("Ajout de : " + libString)
+
             # Indicate that the dependencies of self library should be saved.
             library["saveDependencies"] = True
-            # Save library meta data
-            self.h5pF.saveLibraryData(library, new)
-            # Save library folder
-            self.h5pC.fs.saveLibrary(library)
-
-            # Remove cached assets that uses self library
-            if self.h5pC.aggregateAssets and library["libraryId"]:
-                removedKeys = self.h5pF.deleteCachedAssets(
-                    library["libraryId"])
-                self.h5pC.fs.deleteCachedAssets(removedKeys)
-
-            # Remove tmp folder
-            print(library['uploadDirectory'])
-            self.h5pC.deleteFileTree(library["uploadDirectory"])
-
-            if new:
-                newOnes += 1
-            else:
-                oldOnes += 1
+            libraries.append((libString, library))
 
-        # Go through the libraries again to save dependencies.
-        for libstring, library in self.h5pC.librariesJsonData.iteritems():
-            if not library["saveDependencies"]:
-                continue
+        if len(libraries) == 0:
+            return
 
-            # TODO: Should the table be locked for self operation ?
+        # The library folders are extracted to staging folders by a pool of
+        # threads while the meta data is saved. The database is only used by
+        # this thread. The folders replace the installed ones once the meta
+        # data is committed, and are removed if it is rolled back.
+        self.h5pC.fs.dirReady(os.path.join(self.h5pC.fs.path, "libraries"))
+        pool = ThreadPool(max(1, min(len(libraries), int(
+            self.h5pF.getOption("H5P_INSTALL_THREADS", 4)))))
+        extraction = pool.map_async(self.stageLibraryFolder, [library for libString, library in libraries])
+        pool.close()
+
+        removedKeys = list()
+        committed = False
+        try:
+            with transaction.atomic():
+                for libString, library in libraries:
+                    new = not "libraryId" in library
+                    # Save library meta data
+                    self.h5pF.saveLibraryData(library, new)
+                    installed[libString] = {"library_id": library["libraryId"]}
+
+                    # Remove cached assets that uses self library
+                    if self.h5pC.aggregateAssets and library["libraryId"]:
+                        removedKeys.extend(self.h5pF.deleteCachedAssets(
+                            library["libraryId"]))
+
+                    if new:
+                        newOnes += 1
+                    else:
+                        oldOnes += 1
 
-            # Remove any old dependencies
-            self.h5pF.deleteLibraryDependencies(library["libraryId"])
+                # Replace the dependencies of the saved libraries, resolved
+                # with the ids loaded above
+                libraryIds = [library["libraryId"] for libString, library in libraries]
+                self.h5pF.deleteLibrariesDependencies(libraryIds)
+                dependencies = list()
+                for libString, library in libraries:
+                    for dependencyType in ("preloaded", "dynamic", "editor"):
+                        for dependency in library.get(dependencyType + "Dependencies", list()):
+                            dependencies.append((library["libraryId"], installed[
+                                                self.h5pC.libraryToString(dependency)]["library_id"], dependencyType))
+                self.h5pF.saveLibrariesDependencies(dependencies)
+
+                # Make sure libraries dependencies, parameter filtering and export
+                # files get regenerated for all content who uses self library.
+                self.h5pF.clearFilteredParameters(libraryIds)
+
+                # The meta data is only committed once all the files are there
+                extraction.get()
+            committed = True
+        finally:
+            pool.join()
+            if not committed:
+                for libString, library in libraries:
+                    if "stagingPath" in library:
+                        self.h5pC.fs.deleteFileTree(library.pop("stagingPath"))
 
-            # Insert the different new ones
-            if "preloadedDependencies" in library:
-                self.h5pF.saveLibraryDependencies(library["libraryId"], library[
-                                                  "preloadedDependencies"], "preloaded")
-            if "dynamicDependencies" in library:
-                self.h5pF.saveLibraryDependencies(library["libraryId"], library[
-                                                  "dynamicDependencies"], "dynamic")
-            if "editorDependencies" in library:
-                self.h5pF.saveLibraryDependencies(library["libraryId"], library[
-                                                  "editorDependencies"], "editor")
+        for libString, library in libraries:
+            self.h5pC.fs.commitLibrary(library, library.pop("stagingPath"))
+            libraryIdMap[libString] = library["libraryId"]
+        if len(removedKeys) > 0:
+            self.h5pC.fs.deleteCachedAssets(removedKeys)
 
-            # Make sure libraries dependencies, parameter filtering and export
-            # files get regenerated for all content who uses self library.
-            self.h5pF.clearFilteredParameters(library["libraryId"])
+        # Cached library metadata and semantics are now outdated
+        if self.h5pC.libraryCache != None:
+            self.h5pC.libraryCache.invalidate()
 
         # Tell the user what we"ve done.
         message = ''
@@ -731,6 +785,14 @@ class H5PStorage:
         if message != '':
             print(message)
 
+    ##
+    # Extract the folder of a library to a staging folder, run by the
+    # threads of saveLibraries
+    ##
+    def stageLibraryFolder(self, library):
+        library["stagingPath"] = self.h5pC.fs.stageLibrary(
+            library, self.h5pC.package)
+
     ##
     # Delete an H5P package
     ##
@@ -757,6 +819,11 @@ class H5PStorage:
 
 class H5PExport:
 
+    # Extensions of the files which would not get smaller in the package
+    storedExtensions = frozenset(['mp4', 'webm', 'ogg', 'ogv', 'oga', 'mp3', 'm4a', 'jpg', 'jpeg', 'png',
+                                  'gif', 'webp', 'woff', 'woff2', 'zip', 'gz', 'pdf', 'docx', 'xlsx', 'pptx',
+                                  'odt', 'ods', 'odp'])
+
     ##
     # Constructor for the H5PExport
     ##
@@ -767,26 +834,54 @@ class H5PExport:
     ##
     # Return path to h5p package.
     #
-    # Creates package if not already created
+    # Creates package if not already created. The files are streamed from
+    # the content and library folders into the package, which is written
+    # next to the exports and moved in place once complete.
     ##
     def createExportFile(self, content):
 
-        # Get path to temporary folder, where export will be contained
-        tmpPath = self.h5pC.fs.getTmpPath()
-        os.mkdir(tmpPath, 0777)
+        # Get path to temporary export target file
+        tmpFile = self.h5pC.fs.getExportTmpPath()
 
         try:
-            # Create content folder and populate with files
-            self.h5pC.fs.exportContent(content["id"], tmpPath + "/content")
-        except:
+            zipf = zipfile.ZipFile(tmpFile, 'w', zipfile.ZIP_DEFLATED, True)
+            try:
+                for name, path, data, compressType in self.getExportEntries(content):
+                    if path == None:
+                        zipf.writestr(name, data)
+                    else:
+                        zipf.write(path, name, compressType)
+            finally:
+                zipf.close()
+
+            # Save export
+            self.h5pC.fs.saveExport(
+                tmpFile, content["slug"] + "-" + content["id"] + ".h5p")
+        except Exception as e:
             print(
-                "Error during the creation of content folder !")
-            self.h5pC.deleteFileTree(tmpPath)
+                "Error during the creation of the export file : %s" % e)
+            if os.path.exists(tmpFile):
+                os.remove(tmpFile)
             return False
 
-        # Update content.json with content from database
-        with open(tmpPath + "/content/content.json", "w") as f:
-            f.write(content["params"].encode("utf-8"))
+        self.h5pF.afterExportCreated()
+
+        return True
+
+    ##
+    # Generate the h5p package of a content without writing it, as chunks
+    # to send while it is built.
+    ##
+    def streamExportFile(self, content):
+        return H5PZipStream().stream(self.getExportEntries(content))
+
+    ##
+    # Get the entries of the h5p package of a content: h5p.json and
+    # content.json from the database, and the files of the content and
+    # library folders. Each entry is a tuple of the name in the package,
+    # the path of the file or the data, and the compression to use.
+    ##
+    def getExportEntries(self, content):
 
         # Make embedType into an array
         embedTypes = content["embedType"].split(", ")
@@ -800,31 +895,27 @@ class H5PExport:
         }
 
         # Add dependencies to h5p
+        libraryFiles = list()
         for key, dependency in content["dependencies"].iteritems():
             library = dependency["library"]
 
-            try:
-                exportFolder = None
-
-                # Determine path of export library
-                if self.h5pC in locals() and self.h5pC.h5pD in locals():
-                    # Tries to find library in development folder
-                    isDevLibrary = self.h5pC.h5pD.getLibrary(
-                        library["machineName"],
-                        library["majorVersion"],
-                        library["minorVersion"]
-                    )
-
-                    if isDevLibrary == None:
-                        exportFolder = "/" + library["path"]
-
-                # Export required libraries
-                self.h5pC.fs.exportLibrary(library, tmpPath, exportFolder)
-            except:
-                print(
-                    "Error during export the required libraries !")
-                self.h5pC.deleteFileTree(tmpPath)
-                return False
+            exportFolder = None
+
+            # Determine path of export library
+            if self.h5pC in locals() and self.h5pC.h5pD in locals():
+                # Tries to find library in development folder
+                isDevLibrary = self.h5pC.h5pD.getLibrary(
+                    library["machineName"],
+                    library["majorVersion"],
+                    library["minorVersion"]
+                )
+
+                if isDevLibrary == None:
+                    exportFolder = "/" + library["path"]
+
+            # Export required libraries
+            libraryFiles.append(
+                self.h5pC.fs.getLibraryFiles(library, exportFolder))
 
             # Do not add editor dependencies to h5p json.
             if dependency["type"] == "editor":
@@ -839,44 +930,31 @@ class H5PExport:
                 "minorVersion": library["minor_version"]
             })
 
-        # Save h5p.json
-        results = json.dumps(h5pJson)
-        with open(tmpPath + "/h5p.json", "w") as f:
-            f.write(results)
+        yield ("h5p.json", None, json.dumps(h5pJson), zipfile.ZIP_DEFLATED)
 
-        # Get a complete file list from our tmp dir
-        files = list()
-        self.populateFileList(tmpPath, files)
-
-        # Get path to temporary export target file
-        tmpFile = self.h5pC.fs.getTmpPath()
-
-        # Create new zip instance
-        zipf = zipfile.ZipFile(tmpFile, 'w')
+        # Update content.json with content from database
+        yield ("content/content.json", None, content["params"].encode("utf-8"), zipfile.ZIP_DEFLATED)
 
-        # Add all the files from the tmp dir.
-        for f in files:
-            # Please not that the zip format has no concept of folders, we must
-            # use forward slashes to separate our directories.
-            zipf.write(f['absolutePath'], f['relativePath'])
+        # Please not that the zip format has no concept of folders, we must
+        # use forward slashes to separate our directories. The image variants
+        # are left out, the site importing the file generates its own.
+        skipped = set(["content.json", "derivatives.json"])
+        for image in self.h5pC.fs.getImageVariants(content["id"]).values():
+            skipped.update(variant["path"] for variant in image["variants"])
+        for absolutePath, relativePath in self.h5pC.fs.getContentFiles(content["id"]):
+            if not relativePath in skipped:
+                yield ("content/" + relativePath, absolutePath, None, self.getCompressType(relativePath))
 
-        # Close zip and remove tmp dir
-        zipf.close()
-        self.h5pC.deleteFileTree(tmpPath)
+        for files in libraryFiles:
+            for absolutePath, relativePath in files:
+                yield (relativePath, absolutePath, None, self.getCompressType(relativePath))
 
-        try:
-            # Save export
-            self.h5pC.fs.saveExport(
-                tmpFile, content["slug"] + "-" + content["id"] + ".h5p")
-        except:
-            print(
-                "Error during export save !")
-            return False
-
-        os.remove(tmpFile)
-        self.h5pF.afterExportCreated()
-
-        return True
+    ##
+    # Files which are already compressed are stored as they are.
+    ##
+    def getCompressType(self, path):
+        extension = os.path.splitext(path)[1][1:].lower()
+        return zipfile.ZIP_STORED if extension in self.storedExtensions else zipfile.ZIP_DEFLATED
 
     ##
     # Recursive function the will add the files of the given directory to the
@@ -968,8 +1046,9 @@ class H5PCore:
     ##
     # Constructor for the H5PCore
     ##
-    def __init__(self, H5PFramework, path, url, language="en", export=False, development_mode=H5PDevelopment.MODE_NONE):
+    def __init__(self, H5PFramework, path, url, language="en", export=False, development_mode=H5PDevelopment.MODE_NONE, libraryCache=None):
         self.h5pF = H5PFramework
+        self.libraryCache = libraryCache
 
         self.fs = H5PDefaultStorage(path)
 
@@ -978,7 +1057,8 @@ class H5PCore:
         self.development_mode = development_mode
         self.disableFileCheck = False
 
-        self.aggregateAssets = False  # Off by default.. for now
+        # Off by default, concatenates the assets of each set of dependencies
+        self.aggregateAssets = bool(self.h5pF.getOption("H5P_AGGREGATE_ASSETS", False))
 
         if development_mode and H5PDevelopment.MODE_LIBRARY:
             self.h5pD = H5PDevelopment(self.h5pF, path + "/", language)
@@ -990,6 +1070,8 @@ class H5PCore:
         self.relativePathRegExp = "^((\.\.\/){1,2})(.*content\/)?(\d+|editor)\/(.+)$"
 
         self.librariesJsonData = None
+        # Uploaded package being installed, see H5PValidator.isValidPackage
+        self.package = None
         self.contentJsonData = None
         self.mainJsonData = None
 
@@ -1040,13 +1122,20 @@ class H5PCore:
 
     ##
     # Filter content run parameters, rebuild content dependency cache and export file.
+    # Without export, the export file is left to the filter job, the views
+    # only need the parameters.
     ##
-    def filterParameters(self, content):
-        if not empty(content["filtered"]) and (not self.exportEnabled or (content["slug"] and self.fs.hasExport(content["slug"] + "-" + content["id"] + ".h5p"))):
+    def filterParameters(self, content, export=True):
+        export = export and self.exportEnabled
+        if not empty(content["filtered"]) and (not export or (content["slug"] and self.fs.hasExport(content["slug"] + "-" + content["id"] + ".h5p"))):
             return content["filtered"]
 
-        # Validate and filter against main library semantics.
+        # Validate and filter against main library semantics. The
+        # subcontents which did not change are reused.
         validator = H5PContentValidator(self.h5pF, self)
+        if not empty(content.get("filtered_subcontents")):
+            validator.cachedSubContents = json.loads(
+                content["filtered_subcontents"])
         params = {
             "library": self.libraryToString(content["library"]),
             "params": json.loads(content["params"])
@@ -1065,26 +1154,31 @@ class H5PCore:
         # Sometimes the parameters are filtered before content has been
         # created
         if content["id"]:
-            self.h5pF.deleteLibraryUsage(content["id"])
-            self.h5pF.saveLibraryUsage(
-                content["id"], content["dependencies"])
-
             if not content["slug"]:
                 content["slug"] = self.generateContentSlug(content)
 
                 # Remove old export file
                 self.fs.deleteExport(content["id"] + ".h5p")
 
-            if self.exportEnabled:
+            with transaction.atomic():
+                # Cache. Nothing is written when the content was saved again
+                # since its parameters were loaded, the filtering of the new
+                # parameters does it.
+                if not self.h5pF.updateContentFields(content["id"], {
+                    "filtered": params,
+                    "filtered_subcontents": json.dumps(validator.filteredSubContents),
+                    "slug": content["slug"]
+                }, content["params"]):
+                    return params
+
+                self.h5pF.deleteLibraryUsage(content["id"])
+                self.h5pF.saveLibraryUsage(
+                    content["id"], content["dependencies"])
+
+            if export:
                 # Recreate export file
                 exporter = H5PExport(self.h5pF, self)
                 exporter.createExportFile(content)
-
-            # Cache.
-            self.h5pF.updateContentFields(content["id"], {
-                "filtered": params,
-                "slug": content["slug"]
-            })
         return params
 
     ##
@@ -1187,7 +1281,7 @@ class H5PCore:
                 return dict(files, **cachedAssets)  # Using cached assets
 
         # Using content dependencies
-        for key, dependency in dependencies.iteritems():
+        for dependency in dependencies.itervalues():
             if not 'path' in dependency:
                 dependency['path'] = '/libraries/' + \
                     self.libraryToString(dependency, True)
@@ -1226,8 +1320,8 @@ class H5PCore:
         toHash = list()
         # Use unique identifier for each library version
         for dep, lib in dependencies.iteritems():
-            toHash.append(lib["machineName"] + "-" + str(lib["majorVersion"]) +
-                          "." + str(lib["minorVersion"]) + "." + str(lib["patchVersion"]))
+            toHash.append(self.libraryToString(lib, True) + "." + str(
+                lib["patchVersion"] if "patchVersion" in lib else lib["patch_version"]))
 
         # Sort in case the same dependencies comes in a different order
         toHash.sort()
@@ -1247,6 +1341,13 @@ class H5PCore:
             semantics = self.h5pD.getSemantics(
                 name, majorVersion, minorVersion)
 
+        if semantics == None and self.libraryCache != None:
+            # Try to load already parsed semantics from cache
+            semantics = self.libraryCache.get(
+                "semantics", self.libraryCacheKey(name, majorVersion, minorVersion))
+            if semantics != None:
+                return semantics
+
         if semantics == None:
             # Try to load from DB.
             semantics = self.h5pF.loadLibrarySemantics(
@@ -1254,6 +1355,9 @@ class H5PCore:
 
         if semantics != None:
             semantics = json.loads(semantics['semantics'])
+            if self.libraryCache != None:
+                self.libraryCache.set("semantics", self.libraryCacheKey(
+                    name, majorVersion, minorVersion), semantics)
 
         return semantics
 
@@ -1269,24 +1373,58 @@ class H5PCore:
             if library != None:
                 library["semantics"] = self.h5pD.getSemantics(
                     name, majorVersion, minorVersion)
+        if library == None and self.libraryCache != None:
+            # Try to load from cache
+            library = self.libraryCache.get(
+                "library", self.libraryCacheKey(name, majorVersion, minorVersion))
+            if library != None:
+                return library
+
         if library == None:
             # Try to load from DB
             library = self.h5pF.loadLibrary(
                 name, majorVersion, minorVersion)
+            if library and self.libraryCache != None:
+                self.libraryCache.set("library", self.libraryCacheKey(
+                    name, majorVersion, minorVersion), library)
 
         return library
 
+    ##
+    # Key of a library in the library cache
+    ##
+    def libraryCacheKey(self, name, majorVersion, minorVersion):
+        return name + " " + str(majorVersion) + "." + str(minorVersion)
+
     ##
     # Deletes a library
     ##
-    def deleteLibrary(libraryId):
+    def deleteLibrary(self, libraryId):
         self.h5pF.deleteLibrary(libraryId)
+        if self.libraryCache != None:
+            self.libraryCache.invalidate()
+
+    ##
+    # Get the dependency graph of the installed libraries, built once per
+    # version of the library cache. None without cache or in development
+    # mode, the libraries are then loaded one by one.
+    ##
+    def getDependencyGraph(self):
+        if self.libraryCache == None or (self.development_mode and H5PDevelopment.MODE_LIBRARY):
+            return None
+
+        return self.libraryCache.getGraph(
+            lambda: H5PDependencyGraph(*self.h5pF.loadDependencyGraph()))
 
     ##
     # Recursive. Goes through the dependency tree for the given library and
     # adds all the dependencies to the given array in a flat format.
     ##
     def findLibraryDependencies(self, dependencies, library, nextWeight=0, editor=False):
+        graph = self.getDependencyGraph()
+        if graph != None:
+            return graph.findDependencies(dependencies, library, nextWeight, editor)
+
         for ptype in ["dynamic", "preloaded", "editor"]:
             pproperty = ptype + "Dependencies"
             if not pproperty in library:
@@ -1612,24 +1750,33 @@ class H5PCore:
 class H5PContentValidator:
     allowed_styleable_tags = ["span", "p", "div"]
 
+    # Compiled library semantics shared by all the validators of the
+    # process. They are dropped when the version of the library cache changes.
+    compiledLibraries = dict()
+    compiledVersion = None
+    compiledCopyright = None
+
+    subContentIdRegExp = re.compile(
+        '(?i)^\{?[a-f0-9]{8}-[a-f0-9]{4}-[a-f0-9]{4}-[a-f0-9]{4}-[a-f0-9]{12}\}?$')
+
     ##
     # Constructor for the H5PContentValidator
     ##
     def __init__(self, H5PFramework, H5PCore):
         self.h5pF = H5PFramework
         self.h5pC = H5PCore
-        self.typeMap = {
-            "text": "validateText",
-            "number": "validateNumber",
-            "boolean": "validateBoolean",
-            "list": "validateList",
-            "group": "validateGroup",
-            "file": "validateFile",
-            "image": "validateImage",
-            "video": "validateVideo",
-            "audio": "validateAudio",
-            "select": "validateSelect",
-            "library": "validateLibrary"
+        self.compilers = {
+            "text": self.compileText,
+            "number": self.compileNumber,
+            "boolean": self.compileBoolean,
+            "list": self.compileList,
+            "group": self.compileGroup,
+            "file": self.compileFile,
+            "image": self.compileImage,
+            "video": self.compileVideo,
+            "audio": self.compileAudio,
+            "select": self.compileSelect,
+            "library": self.compileLibrary
         }
         self.nextWeight = 1
 
@@ -1640,6 +1787,19 @@ class H5PContentValidator:
         # Keep track of all dependencies for the given content.
         self.dependencies = dict()
 
+        # Compiled library semantics when no library cache is used
+        self.localCompiled = dict()
+
+        # Subcontents filtered the previous time, keyed by subContentId, and
+        # the ones filtered this time. Each one holds the hash of its raw
+        # parameters, its filtered value, the libraries it uses and the ids
+        # of the subcontents it contains.
+        self.cachedSubContents = dict()
+        self.filteredSubContents = dict()
+
+        # Libraries and subcontents used by the subcontents being validated
+        self.subContentStack = list()
+
     ##
     # Get the flat dependency tree.
     ##
@@ -1647,26 +1807,38 @@ class H5PContentValidator:
         return self.dependencies
 
     ##
-    # Validate given text value against text semantics.
+    # Compile a semantics field into a function validating a value.
+    # Compiled functions are called with the validator and the value, and
+    # return the validated value, or None if the value must be removed.
+    # They only use the validator given at call time, so they can be shared.
     ##
-    def validateText(self, text, semantics):
-        if not isinstance(text, basestring):
-            text = ''
+    def compileField(self, semantics):
+        compiler = self.compilers.get(semantics.get('type'))
+        if compiler == None:
+            print('H5P internal error: unknown content type "%s" in semantics. Removing content !' % semantics.get('type'))
+            return lambda validator, value: None
 
+        return compiler(semantics)
+
+    ##
+    # Compile text semantics. The allowed tags and styles are computed once.
+    ##
+    def compileText(self, semantics):
+        htmlFilter = None
         if 'tags' in semantics:
-            tags = ['div', 'span', 'p', 'br'] + semantics['tags']
+            tags = set(['div', 'span', 'p', 'br'] + semantics['tags'])
 
             if 'table' in tags:
-                tags = tags + ['tr', 'td', 'th',
-                               'colgroup', 'thead', 'tbody', 'tfoot']
-            if 'b' in tags and not 'strong' in tags:
-                tags.append('strong')
-            if 'i' in tags and not 'em' in tags:
-                tags.append('em')
-            if 'ul' in tags or 'ol' in tags and not 'li' in tags:
-                tags.append('li')
-            if 'del' in tags or 'strike' in tags and not 's' in tags:
-                tags.append('s')
+                tags.update(['tr', 'td', 'th', 'colgroup',
+                             'thead', 'tbody', 'tfoot'])
+            if 'b' in tags:
+                tags.add('strong')
+            if 'i' in tags:
+                tags.add('em')
+            if 'ul' in tags or 'ol' in tags:
+                tags.add('li')
+            if 'del' in tags or 'strike' in tags:
+                tags.add('s')
 
             stylePatterns = list()
             if 'font' in semantics:
@@ -1689,313 +1861,418 @@ class H5PContentValidator:
                         '(?i)^line-height: *[0-9.]+(em|px|%|) *;?$')
 
             stylePatterns.append('(?i)^text-align: *(center|left|right);?$')
+            htmlFilter = H5PXssFilter(
+                tags, stylePatterns, self.allowed_styleable_tags)
 
-            text = self.filterXss(text, tags, stylePatterns)
-        else:
-            text = cgi.escape(text, True)
-
-        if 'maxLength' in semantics:
-            text = text[0:semantics['maxLength']]
+        maxLength = semantics.get('maxLength')
+        regexp = None
+        if 'regexp' in semantics:
+            flags = re.I if 'i' in semantics['regexp'].get('modifiers', '') else 0
+            regexp = re.compile(semantics['regexp']['pattern'], flags)
 
-        if not text == '' and 'optional' in semantics and 'regexp' in semantics:
-            pattern = semantics['regexp'][
-                'modifiers'] if 'modifiers' in semantics['regexp'] else ''
-            if not re.search(pattern, text):
-                print('Provided string is not valid according to regexp in semantics. (value: %s, regexp: %s)' % (
-                    text, pattern))
+        def validateText(validator, text):
+            if not isinstance(text, basestring):
                 text = ''
 
-    ##
-    # Validates content files
-    ##
-    def validateContentFiles(self, contentPath, isLibrary=False):
-        if self.h5pC.disableFileCheck == True:
-            return True
+            if htmlFilter != None:
+                text = htmlFilter.filter(text)
+            else:
+                text = cgi.escape(text, True)
 
-        # Scan content directory for files, recurse into sub directories.
-        files = list(set(os.listdir(contentPath)).difference([".", ".."]))
-        valid = True
-        whitelist = self.h5pF.getWhitelist(
-            isLibrary, H5PCore.defaultContentWhitelist, H5PCore.defaultLibraryWhitelistExtras)
+            if maxLength != None:
+                text = text[0:maxLength]
 
-        wl_regex = "^.*\.(" + re.sub(" ", "|", whitelist) + ")$"
+            if text != '' and regexp != None and not regexp.search(text):
+                print('Provided string is not valid according to regexp in semantics. (value: %s, regexp: %s)' % (
+                    text, regexp.pattern))
+                text = ''
 
-        for f in files:
-            filePath = contentPath + "/" + f
-            if os.path.isdir(filePath):
-                valid = self.validateContentFiles(
-                    filePath, isLibrary) and valid
-            else:
-                if not re.search(wl_regex, f.lower()):
-                    print(
-                        "File \"%s\" not allowed. Only files with the following extension are allowed : %s" % (f, whitelist))
-                    valid = False
+            return text
 
-        return valid
+        return validateText
 
     ##
-    # Validate given value against number semantics
+    # Compile number semantics
     ##
-    def validateNumber(self, number, semantics):
-        # Validate that number is indeed a number
-        if not isinstance(number, int):
-            number = 0
+    def compileNumber(self, semantics):
+        minimum = semantics.get('min')
+        maximum = semantics.get('max')
+        step = semantics.get('step')
+        decimals = semantics.get('decimals')
+
+        def validateNumber(validator, number):
+            # Validate that number is indeed a number
+            if isinstance(number, bool) or not isinstance(number, (int, long, float)):
+                number = 0
+
+            # Check if number is within valid bounds. Move withing bounds if
+            # not.
+            if minimum != None and number < minimum:
+                number = minimum
+            if maximum != None and number > maximum:
+                number = maximum
+
+            # Check if number if withing allowed bounds even if step value is
+            # set.
+            if step:
+                rest = (number - (minimum if minimum != None else 0)) % step
+                if rest != 0:
+                    number = number - rest
 
-        # Check if number is within valid bounds. Move withing bounds if not.
-        if 'min' in semantics and number < semantics['min']:
-            number = semantics['min']
-        if 'max' in semantics and number > semantics['max']:
-            number = semantics['max']
+            # Check if number has proper number of decimals.
+            if decimals != None:
+                number = round(number, decimals)
 
-        # Check if number if withing allowed bounds even if step value is set.
-        if 'step' in semantics:
-            textNumber = number - \
-                (semantics['min'] if 'min' in semantics else 0)
-            rest = textNumber % semantics['step']
-            if rest != 0:
-                number = number - rest
+            return number
 
-        # Check if number has proper number of decimals.
-        if 'decimals' in semantics:
-            number = round(number, semantics['decimals'])
+        return validateNumber
 
     ##
-    # Validate given value against boolean semantics
+    # Compile boolean semantics
     ##
-    def validateBoolean(self, boolean, semantics):
-        return isinstance(boolean, bool)
+    def compileBoolean(self, semantics):
+        def validateBoolean(validator, boolean):
+            return boolean if isinstance(boolean, bool) else False
+
+        return validateBoolean
 
     ##
-    # Validate select values
+    # Compile select semantics. The set of options is built once.
     ##
-    def validateSelect(self, select, semantics):
-        optional = semantics['optional'] if 'optional' in semantics else False
-        strict = False
-        if 'options' in semantics and not empty(semantics['options']):
+    def compileSelect(self, semantics):
+        optional = semantics.get('optional', False)
+        multiple = semantics.get('multiple', False)
+        options = None
+        allowed = None
+        if not empty(semantics.get('options')):
             # We have a strict set of options to choose from.
-            strict = True
-            options = dict()
-            for option in semantics['options']:
-                options[option['value']] = True
-
-        if 'multiple' in semantics and semantics['multiple']:
-            # Multi-choice generates array of values. Test each one against valid
-            # options, if we are strict. First make sure we are working on an
-            # array.
-            if not isinstance(select, list):
-                select = list(select)
-
-            for key, value in select:
-                if strict and not optional and not options[value]:
-                    print(
-                        "Invalid selected option in multi-select.")
-                    del select[key]
-                else:
-                    select[key] = cgi.escape(value, True)
-        else:
+            options = [option['value'] for option in semantics['options']]
+            allowed = frozenset(options)
+
+        def validateSelect(validator, select):
+            if multiple:
+                # Multi-choice generates array of values. Test each one against
+                # valid options, if we are strict.
+                if not isinstance(select, list):
+                    select = [select]
+
+                values = list()
+                for value in select:
+                    if allowed != None and not optional and value not in allowed:
+                        print('Invalid selected option in multi-select.')
+                    else:
+                        values.append(escapeValue(value))
+                return values
+
             # Single mode. If we get an array in here, we chop off the first
             # element and use that instead.
             if isinstance(select, list):
-                select = select[0]
+                select = select[0] if len(select) > 0 else None
 
-            if strict and not optional and not options[select]:
-                print(
-                    "Invalid selected option in select.")
-                select = semantics[options[0]['value']]
+            if allowed != None and not optional and select not in allowed:
+                print('Invalid selected option in select.')
+                select = options[0]
+
+            return escapeValue(select)
 
-            select = cgi.escape(select, True)
+        return validateSelect
 
     ##
-    # Validate given list value against list semantics.
-    # Will recurse into validating each item in the list according to the type.
+    # Compile list semantics, the items are validated by the compiled field.
     ##
-    def validateList(self, plist, semantics):
-        field = semantics
-        function = self.typeMap[field['type']]
+    def compileList(self, semantics):
+        if 'field' in semantics:
+            validateItem = self.compileField(semantics['field'])
+        else:
+            validateItem = lambda validator, value: None
 
-        if not isinstance(plist, list):
-            plist = list()
+        def validateList(validator, plist):
+            if not isinstance(plist, list):
+                plist = list()
 
-        # Validate each element in list.
-        for value in plist:
-            eval('self.' + function + '(value, field)')
+            # Validate each element in list.
+            values = list()
+            for value in plist:
+                value = validateItem(validator, value)
+                if value != None:
+                    values.append(value)
 
-        if len(plist) == 0:
-            plist = None
+            return values if len(values) > 0 else None
+
+        return validateList
 
     ##
-    # Validate a file like object, such as video, image, audio and file.
+    # Compile file like semantics, such as video, image, audio and file.
     ##
-    def validateFilelike(self, f, semantics, typeValidKeys=[]):
-        # Do not allow to use files from other content folders.
-        matches = re.search(self.h5pC.relativePathRegExp, f['path'])
-        if matches:
-            f['path'] = matches.group(4)
+    def compileFilelike(self, semantics, typeValidKeys=[]):
+        relativePathRegExp = re.compile(self.h5pC.relativePathRegExp)
+        validateCopyright = self.getCompiledCopyright()
 
-        # Make sure path and mime does not have any special chars
-        f['path'] = cgi.escape(f['path'], True)
-        if 'mime' in f:
-            f['mime'] = cgi.escape(f['mime'], True)
+        # Remove attributes that should not exist, they may contain JSON
+        # escape code.
+        validKeys = frozenset(["path", "mime", "copyright"] + typeValidKeys +
+                              semantics.get('extraAttributes', list()))
 
-        # Remove attributes that should not exist, they may contain JSON escape
-        # code.
-        validKeys = ["path", "mime", "copyright"] + typeValidKeys
-        if 'extraAttributes' in semantics:
-            validKeys = validKeys + semantics['extraAttributes']
+        def validateFilelike(validator, f):
+            if not isinstance(f, dict) or not isinstance(f.get('path'), basestring):
+                return None
 
-        self.filterParams(f, validKeys)
+            # Do not allow to use files from other content folders.
+            matches = relativePathRegExp.search(f['path'])
+            if matches:
+                f['path'] = matches.group(5)
 
-        if 'width' in f:
-            f['width'] = int(f['width'])
+            # Make sure path and mime does not have any special chars
+            f['path'] = cgi.escape(f['path'], True)
+            if 'mime' in f:
+                f['mime'] = escapeValue(f['mime'])
 
-        if 'height' in f:
-            f['height'] = int(f['height'])
+            for key in f.keys():
+                if not key in validKeys:
+                    del f[key]
 
-        if 'codecs' in f:
-            f['codecs'] = cgi.escape(f['codecs'], True)
+            if 'width' in f:
+                f['width'] = intValue(f['width'])
 
-        if 'quality' in f:
-            if not isinstance(f['quality'], object) or not 'level' in f['quality'] or not 'label' in f['quality']:
-                del f['quality']
-            else:
-                self.filterParams(f['quality'], ["level", "label"])
-                f['quality']['level'] = int(f['quality']['level'])
-                f['quality']['label'] = cgi.escape(f['equality']['label'], True)
+            if 'height' in f:
+                f['height'] = intValue(f['height'])
 
-        if 'copyright' in f:
-            self.validateGroup(f['copyright'], self.getCopyrightSemantics())
+            if 'codecs' in f:
+                f['codecs'] = escapeValue(f['codecs'])
 
-    ##
-    # Validate given file data
-    ##
-    def validateFile(self, f, semantics):
-        self.validateFilelike(f, semantics)
+            if 'quality' in f:
+                if not isinstance(f['quality'], dict) or not 'level' in f['quality'] or not 'label' in f['quality']:
+                    del f['quality']
+                else:
+                    f['quality'] = {
+                        'level': intValue(f['quality']['level']),
+                        'label': escapeValue(f['quality']['label'])
+                    }
 
-    ##
-    # Validate given image data
-    ##
-    def validateImage(self, image, semantics):
-        self.validateFilelike(
-            image, semantics, ["width", "height", "originalImage"])
+            if 'copyright' in f:
+                f['copyright'] = validateCopyright(validator, f['copyright'])
+                if f['copyright'] == None:
+                    del f['copyright']
 
-    ##
-    # Validate given video data
-    ##
-    def validateVideo(self, video, semantics):
-        for variant in video:
-            self.validateFilelike(variant, semantics, [
-                                   "width", "height", "codecs", "quality"])
+            return f
+
+        return validateFilelike
+
+    def compileFile(self, semantics):
+        return self.compileFilelike(semantics)
+
+    def compileImage(self, semantics):
+        return self.compileFilelike(semantics, ["width", "height", "originalImage"])
+
+    def compileVideo(self, semantics):
+        return self.compileVariants(self.compileFilelike(
+            semantics, ["width", "height", "codecs", "quality"]))
+
+    def compileAudio(self, semantics):
+        return self.compileVariants(self.compileFilelike(semantics))
 
     ##
-    # Validate given audio data
+    # Video and audio values are lists of file variants
     ##
-    def validateAudio(self, audio, semantics):
-        for variant in audio:
-            self.validateFilelike(variant, semantics)
+    def compileVariants(self, validateVariant):
+        def validateVariants(validator, variants):
+            if not isinstance(variants, list):
+                return None
+
+            return [variant for variant in (validateVariant(validator, variant) for variant in variants) if variant != None]
+
+        return validateVariants
 
     ##
-    # Validate given group value against group semantics
+    # Compile group semantics
     ##
-    def validateGroup(self, group, semantics, flatten=True):
-        # Groups with just one field are compressed in the editor to only output
-        # the child content. (Exemption for fake groups created by
-        # "validateBySemantics" above)
-        function = None
-        field = None
-        isSubContent = True if 'isSubContent' in semantics and semantics[
-            'isSubContent'] == True else False
-
-        if len(semantics['fields']) == 1 and flatten and not isSubContent:
-            field = semantics['fields'][0]
-            function = self.typeMap[field['type']]
-            eval('self.' + function + '(group, field)')
-        else:
-            for key, value in group.iteritems():
+    def compileGroup(self, semantics, flatten=True):
+        fields = semantics.get('fields') or list()
+        isSubContent = semantics.get('isSubContent') == True
+
+        # Groups with just one field are compressed in the editor to only
+        # output the child content.
+        if len(fields) == 1 and flatten and not isSubContent:
+            return self.compileField(fields[0])
+
+        validators = dict()
+        for field in fields:
+            validators[field['name']] = self.compileField(field)
+
+        def validateGroup(validator, group):
+            if not isinstance(group, dict):
+                return None
+
+            for key in group.keys():
                 if isSubContent and key == 'subContentId':
                     continue
 
-                found = False
-                for field in semantics['fields']:
-                    if field['name'] == key:
-                        if 'optional' in semantics:
-                            field['optional'] = True
-                        function = self.typeMap[field['type']]
-                        found = True
-                        break
-                if found:
-                    if function:
-                        eval('self.' + function + '(value, field)')
-                        if value == None:
-                            del(key)
-                    else:
-                        print('H5P internal error: unknown content type "%s" in semantics. Removing content !' % field[
-                              'type'])
-                        del(key)
+                validateField = validators.get(key)
+                value = validateField(
+                    validator, group[key]) if validateField != None else None
+                if value == None:
+                    del group[key]
                 else:
-                    del(key)
+                    group[key] = value
 
-        if not 'optional' in semantics:
-            if group == None:
-                return
+            return group
 
-            for field in semantics['fields']:
-                if not 'optional' in field:
-                    if not hasattr(group, field['name']):
-                        continue
-                        #No message for the moment
+        return validateGroup
 
     ##
-    # Validate given library value against library semantics.
-    # Check if provided library is withing allowed options.
-    #
-    # Will recurse into validating the library"s semantics too.
+    # Compile library semantics. The semantics of the library used by the
+    # value are compiled on first use by getCompiledLibrary.
     ##
+    def compileLibrary(self, semantics):
+        options = semantics.get('options') or list()
+        if isinstance(options, basestring):
+            options = [options]
+        allowed = frozenset(options)
+        validKeys = frozenset(['library', 'params', 'subContentId'] +
+                              semantics.get('extraAttributes', list()))
 
-    def validateLibrary(self, value, semantics):
-        if not 'library' in value:
-            value = None
-            return
+        def validateLibrary(validator, value):
+            if not isinstance(value, dict) or not 'library' in value:
+                return None
 
-        if not value['library'] in semantics['options']:
-            message = None
-            machineNameArray = value['library'].split(' ')
-            machineName = machineNameArray[0]
-            for semanticsLibrary in semantics['options']:
-                semanticsMachineNameArray = semanticsLibrary.split(' ')
-                semanticsMachineName = semanticsMachineNameArray[0]
-                if machineName == semanticsMachineName:
-                    message = 'The version of the H5P library %s used in the content is not valid. Content contains %s, but it should be %s.' % (
-                        machineName, value['library'], semanticsLibrary)
-
-            if message == None:
+            if not value['library'] in allowed:
                 message = 'The H5P library %s used in the content is not valid.' % value[
                     'library']
+                machineName = value['library'].split(' ')[0]
+                for semanticsLibrary in options:
+                    if machineName == semanticsLibrary.split(' ')[0]:
+                        message = 'The version of the H5P library %s used in the content is not valid. Content contains %s, but it should be %s.' % (
+                            machineName, value['library'], semanticsLibrary)
                 print(message)
-                value = None
-                return
+                return None
+
+            return validator.validateLibraryParams(value, validKeys)
+
+        return validateLibrary
+
+    ##
+    # Get the compiled semantics of a library, compiling them on first use
+    ##
+    def getCompiledLibrary(self, libraryString, semantics):
+        cache = getattr(self.h5pC, 'libraryCache', None)
+        if cache == None:
+            compiled = self.localCompiled
+        else:
+            version = cache.getVersion()
+            if H5PContentValidator.compiledVersion != version:
+                H5PContentValidator.compiledLibraries = dict()
+                H5PContentValidator.compiledVersion = version
+            compiled = H5PContentValidator.compiledLibraries
+
+        validate = compiled.get(libraryString)
+        if validate == None:
+            validate = self.compileGroup({
+                'type': 'group',
+                'fields': semantics
+            }, False)
+            compiled[libraryString] = validate
+
+        return validate
+
+    def getCompiledCopyright(self):
+        if H5PContentValidator.compiledCopyright == None:
+            H5PContentValidator.compiledCopyright = self.compileGroup(
+                self.getCopyrightSemantics())
+        return H5PContentValidator.compiledCopyright
+
+    ##
+    # Validate the parameters of an allowed library value, and collect
+    # the library in the dependencies. Subcontents whose parameters did not
+    # change since the previous filtering are taken from the cache.
+    ##
+    def validateLibraryParams(self, value, validKeys):
+        subContentId = value.get('subContentId')
+        if subContentId == None or not self.subContentIdRegExp.search(unicode(subContentId)):
+            return self.validateLibraryValue(value, validKeys)
+
+        subContentId = unicode(subContentId)
+        hash = hashlib.sha1(json.dumps(value, sort_keys=True)).hexdigest()
+        cached = self.cachedSubContents.get(subContentId)
+        if cached != None and cached['hash'] == hash:
+            libraries = [self.loadValueLibrary(library)
+                         for library in cached['libraries']]
+            if not None in libraries:
+                for library in libraries:
+                    self.addDependency(library)
+                self.filteredSubContents[subContentId] = cached
+                for childId in cached['subContents']:
+                    if childId in self.cachedSubContents:
+                        self.filteredSubContents[childId] = self.cachedSubContents[childId]
+                self.addToParentSubContent(
+                    subContentId, cached['libraries'], cached['subContents'])
+                return cached['value']
+
+        self.subContentStack.append((set(), set()))
+        try:
+            value = self.validateLibraryValue(value, validKeys)
+        finally:
+            libraries, subContents = self.subContentStack.pop()
+
+        if value != None:
+            self.filteredSubContents[subContentId] = {
+                'hash': hash,
+                'value': value,
+                'libraries': sorted(libraries),
+                'subContents': sorted(subContents)
+            }
+            self.addToParentSubContent(subContentId, libraries, subContents)
+        return value
+
+    def addToParentSubContent(self, subContentId, libraries, subContents):
+        if len(self.subContentStack) > 0:
+            parentLibraries, parentSubContents = self.subContentStack[-1]
+            parentLibraries.update(libraries)
+            parentSubContents.add(subContentId)
+            parentSubContents.update(subContents)
+
+    def validateLibraryValue(self, value, validKeys):
+        library = self.loadValueLibrary(value['library'])
+        if not library:
+            return None
+
+        if len(self.subContentStack) > 0:
+            self.subContentStack[-1][0].add(value['library'])
+
+        params = self.getCompiledLibrary(value['library'], library['semantics'])(
+            self, value.get('params'))
+        value['params'] = params if params != None else dict()
+
+        for key in value.keys():
+            if not key in validKeys:
+                del value[key]
+
+        if 'subContentId' in value and not self.subContentIdRegExp.search(unicode(value['subContentId'])):
+            del value['subContentId']
+
+        self.addDependency(library)
+        return value
 
-        if not value['library'] in self.libraries:
-            libSpec = self.h5pC.libraryFromString(value['library'])
+    ##
+    # Load a library with its semantics from its library string
+    ##
+    def loadValueLibrary(self, libraryString):
+        if not libraryString in self.libraries:
+            libSpec = self.h5pC.libraryFromString(libraryString)
             library = self.h5pC.loadLibrary(libSpec['machineName'], libSpec[
                                             'majorVersion'], libSpec['minorVersion'])
+            if not library:
+                print('The H5P library %s used in the content is not installed.' % libraryString)
+                return None
             library['semantics'] = self.h5pC.loadLibrarySemantics(
                 libSpec['machineName'], libSpec['majorVersion'], libSpec['minorVersion'])
-            self.libraries[value['library']] = library
-        else:
-            library = self.libraries[value['library']]
+            self.libraries[libraryString] = library
 
-        self.validateGroup(value['params'], {
-            'type': 'group',
-            'fields': library['semantics'],
-        }, False)
-        validKeys = ['library', 'params', 'subContentId']
-        if 'extraAttributes' in semantics:
-            validKeys = validKeys + semantics['extraAttributes']
-        self.filterParams(value, validKeys)
-
-        if 'subContentId' in value and not re.search('(?i)^\{?[a-f0-9]{8}-[a-f0-9]{4}-[a-f0-9]{4}-[a-f0-9]{4}-[a-f0-9]{12}\}?$', value['subContentId']):
-            del(value['subContentId'])
+        return self.libraries[libraryString]
 
+    ##
+    # Add a library and the libraries it requires to the dependencies
+    ##
+    def addDependency(self, library):
         depKey = 'preloaded-' + library['machine_name']
         if not depKey in self.dependencies:
             self.dependencies[depKey] = {
@@ -2008,95 +2285,147 @@ class H5PContentValidator:
             self.dependencies[depKey]['weight'] = self.nextWeight
 
     ##
-    # Check params for a whitelist of allowed properties
+    # Validate given text value against text semantics.
     ##
-    def filterParams(self, params, whitelist):
-        for key, value in params.iteritems():
-            if not key in whitelist:
-                del params[key]
+    def validateText(self, text, semantics):
+        return self.compileText(semantics)(self, text)
 
     ##
-    # Prevent cross-site-scripting (XSS) vulnerabilities
+    # Validates content files
     ##
-    def filterXss(self, string, allowedTags=['a', 'em', 'strong', 'cite', 'blockquote', 'code', 'ul', 'ol', 'li', 'dl', 'dt', 'dd'], allowedStyles=False):
-        if len(string) == 0:
-            return string
+    def validateContentFiles(self, contentPath, isLibrary=False, whitelistRegExp=None):
+        if self.h5pC.disableFileCheck == True:
+            return True
 
-        # Only operate on valid UTF-8 strings
-        if not re.search('(?us)^.', string):
-            return ''
+        whitelist = self.h5pF.getWhitelist(
+            isLibrary, H5PCore.defaultContentWhitelist, H5PCore.defaultLibraryWhitelistExtras)
+        if whitelistRegExp == None:
+            whitelistRegExp = self.getWhitelistRegExp(whitelist)
 
-        self.allowedStyles = allowedStyles
-        # Store the text format
-        self.filterXssSplit(allowedTags, True)
-        # Remove NULL characters (ignored by some browsers)
-        string = string.replace(chr(0), '')
-        # Remove Netscape 4 JS entities
-        string = re.sub('%&\s*\{[^}]*(\)\s*;?|$)%', '', string)
+        # Scan content directory for files, recurse into sub directories.
+        files = list(set(os.listdir(contentPath)).difference([".", ".."]))
+        valid = True
 
-        # Defuse all HTML entities
-        string = string.replace('&', '&amp;')
-        # Change back only well-formed entities in our whitelist
-        # Deciman numeric entities
-        string = re.sub('&amp;#([0-9]+;)', '&#\1', string)
-        # Hexadecimal numeric entities
-        string = re.sub('&amp;#[Xx]0*((?:[0-9A-Fa-f]{2})+;)', '&#x\1', string)
-        # Named entities
-        string = re.sub('&amp;([A-Za-z][A-Za-z0-9]*;)', '&\1', string)
+        for f in files:
+            filePath = contentPath + "/" + f
+            if os.path.isdir(filePath):
+                valid = self.validateContentFiles(
+                    filePath, isLibrary, whitelistRegExp) and valid
+            else:
+                if not whitelistRegExp.search(f.lower()):
+                    print(
+                        "File \"%s\" not allowed. Only files with the following extension are allowed : %s" % (f, whitelist))
+                    valid = False
 
-        return re.sub('%(<(?=[^a-zA-Z!/])|<!--.*?-->|<[^>]*(>|$)|>)%x', self.filterXssSplit, string)
+        return valid
 
     ##
-    # Process an HTML tag
+    # Validates the names of content files, like the ones listed in a package
     ##
-    def filterXssSplit(self, m, store=False):
-        if store:
-            self.allowedHtml = m
-            return self.allowedHtml
+    def validateContentFileNames(self, names, isLibrary=False):
+        if self.h5pC.disableFileCheck == True:
+            return True
+
+        whitelist = self.h5pF.getWhitelist(
+            isLibrary, H5PCore.defaultContentWhitelist, H5PCore.defaultLibraryWhitelistExtras)
+        whitelistRegExp = self.getWhitelistRegExp(whitelist)
 
-        string = m[1]
+        valid = True
+        for name in names:
+            f = name.split("/")[-1]
+            if not whitelistRegExp.search(f.lower()):
+                print(
+                    "File \"%s\" not allowed. Only files with the following extension are allowed : %s" % (f, whitelist))
+                valid = False
+
+        return valid
 
-        if string[0:1] != '<':
-            # We matched a lone ">" character
-            return '&gt;'
-        elif len(string) == 1:
-            # We matched a lone "<" character
-            return '&lt;'
+    def getWhitelistRegExp(self, whitelist):
+        return re.compile("^.*\.(" + re.sub(" ", "|", whitelist) + ")$")
 
-        matches = re.search('%^<\s*(/\s*)?([a-zA-Z0-9\-]+)([^>]*)>?|(<!--.*?-->)$%', string)
-        if not matches:
-            # Seriously malformed
-            return ''
+    ##
+    # Validate given value against number semantics
+    ##
+    def validateNumber(self, number, semantics):
+        return self.compileNumber(semantics)(self, number)
+
+    ##
+    # Validate given value against boolean semantics
+    ##
+    def validateBoolean(self, boolean, semantics):
+        return self.compileBoolean(semantics)(self, boolean)
+
+    ##
+    # Validate select values
+    ##
+    def validateSelect(self, select, semantics):
+        return self.compileSelect(semantics)(self, select)
+
+    ##
+    # Validate given list value against list semantics.
+    # Will recurse into validating each item in the list according to the type.
+    ##
+    def validateList(self, plist, semantics):
+        return self.compileList(semantics)(self, plist)
 
-        slash = matches.group(0).strip()
-        elem = matches.group(1)
-        attrList = matches.group(2)
-        comment = matches.group(3)
+    ##
+    # Validate a file like object, such as video, image, audio and file.
+    ##
+    def validateFilelike(self, f, semantics, typeValidKeys=[]):
+        return self.compileFilelike(semantics, typeValidKeys)(self, f)
 
-        if comment:
-            elem = '!--'
+    ##
+    # Validate given file data
+    ##
+    def validateFile(self, f, semantics):
+        return self.compileFile(semantics)(self, f)
 
-        if not elem.lower() in self.allowedHtml:
-            # Disallowed HTML element
-            return ''
+    ##
+    # Validate given image data
+    ##
+    def validateImage(self, image, semantics):
+        return self.compileImage(semantics)(self, image)
 
-        if comment:
-            return comment
+    ##
+    # Validate given video data
+    ##
+    def validateVideo(self, video, semantics):
+        return self.compileVideo(semantics)(self, video)
 
-        if slash != '':
-            return '</' + elem + '>'
+    ##
+    # Validate given audio data
+    ##
+    def validateAudio(self, audio, semantics):
+        return self.compileAudio(semantics)(self, audio)
 
-        # Is there a closing XHTML slash at the end of the attributes ?
-        attrList = re.sub('%(\s?)/\s*$%', '\1', attrList, -1)
-        xhtmlSlash = '/' if attrList else ''
+    ##
+    # Validate given group value against group semantics
+    ##
+    def validateGroup(self, group, semantics, flatten=True):
+        return self.compileGroup(semantics, flatten)(self, group)
 
-        # Clean up attributes
-        attr2 = ' '.join(self.filterXssAttributes(attrList, self.allowedStyles if elem in self.allowed_styleable_tags else False))
-        attr2 = re.sub('[<>]', '', attr2)
-        attr2 = ' ' + attr2 if len(attr2) else ''
+    ##
+    # Validate given library value against library semantics.
+    # Check if provided library is withing allowed options.
+    #
+    # Will recurse into validating the library"s semantics too.
+    ##
+    def validateLibrary(self, value, semantics):
+        return self.compileLibrary(semantics)(self, value)
 
-        return '<' + elem + attr2 + xhtmlSlash + '>'
+    ##
+    # Check params for a whitelist of allowed properties
+    ##
+    def filterParams(self, params, whitelist):
+        for key in params.keys():
+            if not key in whitelist:
+                del params[key]
 
+    ##
+    # Prevent cross-site-scripting (XSS) vulnerabilities
+    ##
+    def filterXss(self, string, allowedTags=['a', 'em', 'strong', 'cite', 'blockquote', 'code', 'ul', 'ol', 'li', 'dl', 'dt', 'dd'], allowedStyles=False):
+        return H5PXssFilter(allowedTags, allowedStyles, self.allowed_styleable_tags).filter(string)
 
     def getCopyrightSemantics(self):
 
@@ -9,8 +9,16 @@ import glob
 import hashlib
 import cgi
 import uuid
+import gzip
 import shutil
+import StringIO
 from django.conf import settings
+from h5pblobstore import H5PBlobStore
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 is_array = lambda var: isinstance(var, (list, tuple))
 
@@ -50,32 +58,84 @@ class H5PDefaultStorage:
     ##
     def __init__(self, path):
         self.path = path
+        # Media files of the contents, see H5PBlobStore
+        self.blobs = H5PBlobStore(os.path.join(path, 'blobs'))
+        # Resized images, keyed by the hash of their source, see H5PImageDerivatives
+        self.derivatives = H5PBlobStore(os.path.join(path, 'derivatives'))
 
     ##
-    # Store the library folder.
+    # Store the library folder. With a package, the folder is extracted
+    # from it.
     ##
-    def saveLibrary(self, library):
-        dest = os.path.join(self.path, 'libraries',
-                            self.libraryToString(library, True))
+    def saveLibrary(self, library, package=None):
+        self.commitLibrary(library, self.stageLibrary(library, package))
 
-        # Make sure destination dir doesn't exist
-        self.deleteFileTree(dest)
+    ##
+    # Write the library folder to a staging folder next to the libraries,
+    # where it is not used until commitLibrary. Returns the staging folder.
+    ##
+    def stageLibrary(self, library, package=None):
+        staging = os.path.join(self.path, 'libraries', '.' + self.libraryToString(
+            library, True) + '.' + str(uuid.uuid1()) + '.tmp')
+        if not self.dirReady(staging):
+            raise Exception('Unable to create directory for H5P library.')
+
+        if package != None:
+            package.extract(library['packageFolder'], staging)
+        else:
+            # Move library folder
+            self.copyFileTree(library['uploadDirectory'], staging)
 
-        # Move library folder
-        self.copyFileTree(library['uploadDirectory'], dest)
+        return staging
 
     ##
-    # Store the content folder.
+    # Replace the library folder by a staged one
     ##
-    def saveContent(self, source, pid):
+    def commitLibrary(self, library, staging):
+        dest = os.path.join(self.path, 'libraries',
+                            self.libraryToString(library, True))
+        old = staging + '.old'
+        if os.path.isdir(dest):
+            os.rename(dest, old)
+        os.rename(staging, dest)
+        self.deleteFileTree(old)
+
+    ##
+    # Store the content folder. With a package, source is the name of
+    # the folder in the package.
+    ##
+    def saveContent(self, source, pid, package=None):
         dest = os.path.join(self.path, 'content', str(pid))
         # Remove any old content
         self.deleteFileTree(dest)
 
-        self.copyFileTree(source, dest)
+        if package != None:
+            package.extract(source, dest, self.blobs)
+        else:
+            self.copyFileTree(source, dest)
 
         return True
 
+    ##
+    # Get the variants of the images of a content, by path of the
+    # original image. Empty until they are generated.
+    ##
+    def getImageVariants(self, pid):
+        path = os.path.join(self.path, 'content', str(pid), 'derivatives.json')
+        if not os.path.exists(path):
+            return dict()
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except ValueError:
+            return dict()
+
+    def saveImageVariants(self, pid, variants):
+        folder = os.path.join(self.path, 'content', str(pid))
+        if not self.dirReady(folder):
+            raise Exception('Unable to create directory for H5P content.')
+        self.writeFile(os.path.join(folder, 'derivatives.json'), json.dumps(variants))
+
     ##
     # Remove content folder.
     ##
@@ -83,7 +143,8 @@ class H5PDefaultStorage:
         self.deleteFileTree(os.path.join(self.path, 'content', str(pid)))
 
     ##
-    # Creates a stored copy of the content folder.
+    # Creates a stored copy of the content folder. The files are linked,
+    # not copied.
     ##
     def cloneContent(self, pid, newId):
         path = os.path.join(self.path, 'content')
@@ -114,18 +175,45 @@ class H5PDefaultStorage:
                           os.path.join(target, folder))
 
     ##
-    # Save export in file system
+    # List the files of a content folder, as tuples of the absolute path
+    # and the path relative to the folder.
     ##
-    def saveExport(self, source, filename):
-        self.deleteExport(filename)
+    def getContentFiles(self, pid):
+        return self.getFileTree(os.path.join(self.path, 'content', str(pid)))
+
+    ##
+    # List the files of a library folder, as tuples of the absolute path
+    # and the path in an export file.
+    ##
+    def getLibraryFiles(self, library, developmentPath=None):
+        folder = self.libraryToString(library, True)
+        srcPath = os.path.join(
+            'libraries', folder if developmentPath == None else developmentPath)
+        return self.getFileTree(os.path.join(self.path, srcPath), folder + '/')
 
+    ##
+    # Get a temporary path next to the export files. An export written
+    # there can be moved in place atomically by saveExport.
+    ##
+    def getExportTmpPath(self):
         if not self.dirReady(os.path.join(self.path, 'exports')):
             raise Exception('Unable to create directory for H5P export file.')
+        return os.path.join(self.path, 'exports', '.' + str(uuid.uuid1()) + '.tmp')
 
+    ##
+    # Save export in file system. The source file is moved, replacing the
+    # previous export at once when it is on the same file system.
+    ##
+    def saveExport(self, source, filename):
+        if not self.dirReady(os.path.join(self.path, 'exports')):
+            raise Exception('Unable to create directory for H5P export file.')
+
+        target = os.path.join(self.path, 'exports', filename)
         try:
-            shutil.copy(source, os.path.join(self.path, 'exports', filename))
-        except IOError, e:
-            print('Unable to copy %s' % e)
+            os.rename(source, target)
+        except OSError:
+            self.deleteExport(filename)
+            shutil.move(source, target)
 
         return True
 
@@ -147,8 +235,13 @@ class H5PDefaultStorage:
     ##
     # Will concatenate all JavaScripts and Stylesheets into two files in order
     # to improve page performance.
+    #
+    # Files are named after their content hash so they can be served with
+    # far-future cache headers, and are written with .gz and .br variants
+    # (the latter if brotli is installed) for gzip_static / brotli_static.
     ##
     def cacheAssets(self, files, key):
+        manifest = dict()
 
         for dtype, assets in files.iteritems():
             if empty(assets):
@@ -157,61 +250,117 @@ class H5PDefaultStorage:
             content = ''
             for asset in assets:
                 # Get content form asset file
-                assetContent = open(self.path + asset['path']).read()
-                cssRelPath = re.sub('/[^\/]+$/', '', asset['path'])
+                with open(self.path + asset['path'], 'rb') as f:
+                    assetContent = f.read()
+                cssRelPath = os.path.dirname(asset['path']).lstrip('/') + '/'
 
                 # Get file content and concatenate
                 if dtype == 'scripts':
                     content = content + assetContent + ';\n'
                 else:
                     # Rewrite relative URLs used inside Stylesheets
-                    content = content + re.sub('/url\([\'"]?([^"\')]+)[\'"]?\)/i', lambda matches:
-                                               matches[0] if re.search('/^(data:|([a-z0-9]+:)?\/)/i', matches[1] == 1) else 'url("../' + cssRelPath + matches[1] + '")', assetContent) + '\n'
+                    content = content + re.sub('(?i)url\([\'"]?([^"\')]+)[\'"]?\)', lambda matches:
+                                               matches.group(0) if re.search('(?i)^(data:|([a-z0-9]+:)?\/)', matches.group(1)) else 'url("../' + cssRelPath + matches.group(1) + '")', assetContent) + '\n'
 
             self.dirReady(os.path.join(self.path, 'cachedassets'))
             ext = 'js' if dtype == 'scripts' else 'css'
-            outputfile = '/cachedassets/' + key + '.' + ext
+            digest = hashlib.sha1(content).hexdigest()[0:16]
+            outputfile = '/cachedassets/' + key + '-' + digest + '.' + ext
+
+            # Compressed variants first, the plain file signals completion
+            self.writeFile(self.path + outputfile + '.gz', self.gzipData(content))
+            if brotli != None:
+                self.writeFile(self.path + outputfile + '.br', brotli.compress(content))
+            self.writeFile(self.path + outputfile, content)
 
-            with open(self.path + outputfile, 'w') as f:
-                f.write(content)
+            manifest[dtype] = outputfile
             files[dtype] = [{
                 'path': outputfile,
                 'version': ''
             }]
 
+        if not empty(manifest):
+            self.writeFile(self.getCachedAssetsManifest(key), json.dumps(manifest))
+
     ##
     # Will check if there are cache assets available for content.
     ##
     def getCachedAssets(self, key):
+        manifestPath = self.getCachedAssetsManifest(key)
+        if not os.path.exists(manifestPath):
+            return None
+
         files = {
             'scripts': [],
             'styles': []
         }
-        js = '/cachedassets/' + key + '.js'
-        if os.path.exists(self.path + js):
-            files['scripts'].append({
-                'path': js,
-                'version': ''
-            })
-
-        css = '/cachedassets/' + key + '.css'
-        if os.path.exists(self.path + css):
-            files['styles'].append({
-                'path': css,
+        with open(manifestPath) as f:
+            manifest = json.load(f)
+        for dtype, path in manifest.iteritems():
+            if not os.path.exists(self.path + path):
+                return None
+            files[dtype].append({
+                'path': str(path),
                 'version': ''
             })
 
-        return None if empty(files) else files
+        return None if empty(files['scripts']) and empty(files['styles']) else files
 
     ##
     # Remove the aggregated cache files.
     ##
     def deleteCachedAssets(self, keys):
         for hhash in keys:
-            for ext in ['js', 'css']:
-                path = os.path.join(self.path, 'cachedassets', hhash, ext)
-                if os.path.exists(path):
-                    os.remove(path)
+            manifestPath = self.getCachedAssetsManifest(hhash)
+            if not os.path.exists(manifestPath):
+                continue
+
+            with open(manifestPath) as f:
+                manifest = json.load(f)
+            os.remove(manifestPath)
+            for path in manifest.itervalues():
+                for variant in ['', '.gz', '.br']:
+                    if os.path.exists(self.path + path + variant):
+                        os.remove(self.path + path + variant)
+
+    ##
+    # Path to the file listing the aggregated files of a dependencies set
+    ##
+    def getCachedAssetsManifest(self, key):
+        return os.path.join(self.path, 'cachedassets', key + '.json')
+
+    ##
+    # Gzip data at maximum compression with a fixed timestamp
+    ##
+    def gzipData(self, data):
+        buf = StringIO.StringIO()
+        f = gzip.GzipFile(filename='', mode='wb', compresslevel=9, fileobj=buf, mtime=0)
+        f.write(data)
+        f.close()
+        return buf.getvalue()
+
+    ##
+    # Write a file through a tmp file so no request sees a partial file
+    ##
+    def writeFile(self, path, data):
+        tmpfile = path + '.' + str(uuid.uuid1())
+        with open(tmpfile, 'wb') as f:
+            f.write(data)
+        os.rename(tmpfile, path)
+
+    ##
+    # Recursive generator of the files of a directory, as tuples of the
+    # absolute path and the path relative to the directory.
+    ##
+    def getFileTree(self, source, relative=''):
+        for f in sorted(os.listdir(source)):
+            if f != '.git' and f != '.gitignore':
+                path = os.path.join(source, f)
+                if os.path.isdir(path):
+                    for item in self.getFileTree(path, relative + f + '/'):
+                        yield item
+                else:
+                    yield (path, relative + f)
 
     ##
     # Recursive function for copying directories.
@@ -226,8 +375,18 @@ class H5PDefaultStorage:
                     self.copyFileTree(os.path.join(source, f),
                                       os.path.join(destination, f))
                 else:
-                    shutil.copy(os.path.join(source, f),
-                                os.path.join(destination, f))
+                    self.copyFile(os.path.join(source, f),
+                                  os.path.join(destination, f))
+
+    ##
+    # Copy a file, as a hard link sharing the bytes of the source when
+    # the file system allows it
+    ##
+    def copyFile(self, source, destination):
+        if self.blobs.isEnabled():
+            self.blobs.link(source, destination)
+        else:
+            shutil.copy(source, destination)
 
     ##
     # Recursive function that makes sure the specified directory exists and
@@ -280,38 +439,22 @@ class H5PDefaultStorage:
     # Save files uploaded through the editor.
     ##
     def saveFile(self, files, contentid, pid=None):
-        filedata = files.getData()
-        path = os.path.join(settings.MEDIA_ROOT, 'h5pp')
-        if filedata != None and contentid == '0':
-            path = os.path.join(path, 'editor', files.getType() + 's')
-            if not os.path.exists(path):
-                os.makedirs(path)
-            with open(os.path.join(path, files.getName()), 'w+') as f:
-                f.write(filedata)
-        elif filedata != None and contentid != '0':
-            path = os.path.join(path, 'content', str(
-                contentid), files.getType() + 's')
-            if not os.path.exists(path):
-                os.makedirs(path)
-            with open(os.path.join(path, files.getName()), 'w+') as f:
-                f.write(filedata)
-        elif contentid == '0':
-            path = os.path.join(path, 'editor', files.getType() + 's')
-            content = files.getFile()
-            if not os.path.exists(path):
-                os.makedirs(path)
-            with open(os.path.join(path, files.getName()), 'w+') as f:
-                for chunk in content.chunks():
-                    f.write(chunk)
+        if contentid == '0':
+            path = os.path.join(self.path, 'editor', files.getType() + 's')
         else:
-            path = os.path.join(path, 'content', str(
+            path = os.path.join(self.path, 'content', str(
                 contentid), files.getType() + 's')
-            content = files.getFile()
-            if not os.path.exists(path):
-                os.makedirs(path)
-            with open(os.path.join(path, files.getName()), 'w+') as f:
-                for chunk in content.chunks():
-                    f.write(chunk)
+
+        filedata = files.getData()
+        destination = os.path.join(path, files.getName())
+        if filedata != None:
+            self.blobs.saveFile([filedata], destination)
+        elif hasattr(files.getFile(), 'temporary_file_path'):
+            # Large uploads are already written to disk, they are moved
+            self.blobs.saveFilePath(
+                files.getFile().temporary_file_path(), destination)
+        else:
+            self.blobs.saveFile(files.getFile().chunks(), destination)
 
     ##
     # Recursive function for removing directories.
@@ -0,0 +1,125 @@
+##
+# In memory graph of the dependencies between the installed libraries.
+# Every library and every dependency is loaded at once, and the ordered
+# dependencies of each library are resolved once and memoized, instead of
+# loading each library of the tree with its own queries.
+##
+import threading
+
+
+class H5PDependencyGraph:
+
+    ##
+    # Constructor for the H5PDependencyGraph
+    #
+    # libraries are the rows of the libraries, without their semantics,
+    # dependencies are tuples of the library id, the required library id
+    # and the type of the dependency.
+    ##
+    def __init__(self, libraries, dependencies):
+        self.libraries = dict()
+        self.ids = dict()
+        for library in libraries:
+            self.libraries[library['library_id']] = library
+            self.ids[self.libraryKey(library['machine_name'], library[
+                'major_version'], library['minor_version'])] = library['library_id']
+
+        for libraryId, requiredLibraryId, dependencyType in dependencies:
+            library = self.libraries.get(libraryId)
+            required = self.libraries.get(requiredLibraryId)
+            if library == None or required == None:
+                continue
+            library.setdefault(dependencyType + 'Dependencies', list()).append({
+                'machineName': required['machine_name'],
+                'majorVersion': required['major_version'],
+                'minorVersion': required['minor_version']
+            })
+
+        # Ordered dependencies by library id and editor flag
+        self.resolved = dict()
+        self.lock = threading.Lock()
+
+    def libraryKey(self, name, majorVersion, minorVersion):
+        return name + ' ' + str(majorVersion) + '.' + str(minorVersion)
+
+    ##
+    # Get a copy of a library, None if it is not installed
+    ##
+    def getLibrary(self, name, majorVersion, minorVersion):
+        libraryId = self.ids.get(self.libraryKey(
+            name, majorVersion, minorVersion))
+        return None if libraryId == None else dict(self.libraries[libraryId])
+
+    ##
+    # Add the dependencies of a library to the given dependencies, like
+    # H5PCore.findLibraryDependencies. Returns the next weight.
+    ##
+    def findDependencies(self, dependencies, library, nextWeight=0, editor=False):
+        if len(dependencies) == 0 and nextWeight == 0 and library.get('library_id') in self.libraries:
+            # The whole tree of the library, resolved once
+            for dependencyKey, ptype, weight, libraryId in self.resolve(library['library_id'], editor):
+                dependencies[dependencyKey] = {
+                    'library': dict(self.libraries[libraryId]),
+                    'type': ptype,
+                    'weight': weight
+                }
+            return len(dependencies)
+
+        return self.walk(dependencies, library, nextWeight, editor)
+
+    ##
+    # Ordered dependencies of a library, as tuples of the dependency key,
+    # the type, the weight and the library id
+    ##
+    def resolve(self, libraryId, editor):
+        key = (libraryId, editor)
+        resolved = self.resolved.get(key)
+        if resolved != None:
+            return resolved
+
+        dependencies = dict()
+        self.walk(dependencies, self.libraries[libraryId], 0, editor)
+        resolved = sorted([(dependencyKey, dependency['type'], dependency['weight'], dependency['library']['library_id'])
+                           for dependencyKey, dependency in dependencies.iteritems()], key=lambda item: item[2])
+        with self.lock:
+            self.resolved[key] = resolved
+
+        return resolved
+
+    ##
+    # Depth first walk of the dependencies, the weights are the order in
+    # which the libraries must be loaded
+    ##
+    def walk(self, dependencies, library, nextWeight, editor):
+        for ptype in ['dynamic', 'preloaded', 'editor']:
+            pproperty = ptype + 'Dependencies'
+            if not pproperty in library:
+                continue
+
+            if ptype == 'preloaded' and editor == True:
+                # All preloaded dependencies of an editor library is set to
+                # editor.
+                ptype = 'editor'
+
+            for dependency in library[pproperty]:
+                dependencyKey = ptype + '-' + dependency['machineName']
+                if dependencyKey in dependencies:
+                    continue
+
+                dependencyLibrary = self.getLibrary(dependency['machineName'], dependency[
+                                                    'majorVersion'], dependency['minorVersion'])
+                if dependencyLibrary == None:
+                    print('Missing dependency %s %s.%s required by %s' % (
+                        dependency['machineName'], dependency['majorVersion'], dependency['minorVersion'], library['machine_name']))
+                    continue
+
+                dependencies[dependencyKey] = {
+                    'library': dependencyLibrary,
+                    'type': ptype
+                }
+                nextWeight = self.walk(
+                    dependencies, dependencyLibrary, nextWeight, ptype == 'editor')
+                nextWeight = nextWeight + 1
+                dependencies[dependencyKey]['weight'] = nextWeight
+
+        return nextWeight
@@ -0,0 +1,217 @@
+##
+# Responsive variants of the images used by the contents. Each JPEG or
+# PNG image of the parameters is resized to the widths of
+# H5P_IMAGE_WIDTHS, in its own format and in WebP, and the variants are
+# written beside the original in the content folder, as
+# <name>.<ext>-<width>w.<format>. A variant is generated once per source
+# file and kept in the derivatives store under the hash of the source, so
+# the clones and the other contents using the same image only link it. Nothing is done when Pillow is not installed.
+##
+from django.conf import settings
+import StringIO
+import hashlib
+import uuid
+import os
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+# Formats of the source images, with the extension of their variants
+FORMATS = {
+    'JPEG': 'jpg',
+    'PNG': 'png'
+}
+
+MIME_TYPES = {
+    'jpg': 'image/jpeg',
+    'png': 'image/png',
+    'webp': 'image/webp'
+}
+
+
+class H5PImageDerivatives:
+
+    ##
+    # Constructor for the H5PImageDerivatives, fs is the H5PDefaultStorage
+    ##
+    def __init__(self, fs, widths=None, quality=None):
+        self.fs = fs
+        self.widths = sorted(widths or getattr(
+            settings, 'H5P_IMAGE_WIDTHS', [320, 640, 1280, 1920]))
+        self.quality = quality or getattr(settings, 'H5P_IMAGE_QUALITY', 80)
+
+    def isEnabled(self):
+        return Image != None
+
+    ##
+    # Paths of the images found in the parameters of a content
+    ##
+    def findImages(self, params, images=None):
+        if images == None:
+            images = list()
+
+        if isinstance(params, dict):
+            path = params.get('path')
+            mime = params.get('mime')
+            if isinstance(path, basestring) and isinstance(mime, basestring) and mime.startswith('image/'):
+                if self.isLocalPath(path) and not path in images:
+                    images.append(path)
+            for value in params.values():
+                self.findImages(value, images)
+        elif isinstance(params, list):
+            for value in params:
+                self.findImages(value, images)
+
+        return images
+
+    ##
+    # Only the files of the content folder are processed, not the URLs
+    # or the files of the editor (path#tmp)
+    ##
+    def isLocalPath(self, path):
+        parts = path.split('/')
+        return not (':' in path or '#' in path or path.startswith('/') or '..' in parts)
+
+    ##
+    # Generate the variants of the images of a content, and remove the
+    # ones of the images it does not use anymore. Returns True when the
+    # variants changed.
+    ##
+    def update(self, contentId, params):
+        folder = os.path.join(self.fs.path, 'content', str(contentId))
+        previous = self.fs.getImageVariants(contentId)
+        variants = dict()
+
+        for path in self.findImages(params):
+            source = os.path.join(folder, *path.split('/'))
+            if not os.path.isfile(source):
+                continue
+            try:
+                image = self.generate(source, path)
+            except (IOError, ValueError) as e:
+                # Not an image, or one Pillow cannot read
+                print('Unable to resize the image %s of content %s : %s' %
+                      (path, contentId, e))
+                continue
+            if image != None:
+                variants[path] = image
+
+        # Variants which are not used anymore
+        kept = set(variant['path']
+                   for image in variants.values() for variant in image['variants'])
+        for image in previous.values():
+            for variant in image['variants']:
+                if not variant['path'] in kept and self.isLocalPath(variant['path']):
+                    target = os.path.join(folder, *variant['path'].split('/'))
+                    if os.path.exists(target):
+                        os.remove(target)
+
+        if variants == previous:
+            return False
+        self.fs.saveImageVariants(contentId, variants)
+        return True
+
+    ##
+    # Generate the variants of an image, None when it is not resized
+    ##
+    def generate(self, source, path):
+        sha = hashlib.sha256()
+        with open(source, 'rb') as f:
+            for chunk in iter(lambda: f.read(65536), ''):
+                sha.update(chunk)
+        key = sha.hexdigest()
+
+        image = Image.open(source)
+        if not image.format in FORMATS:
+            # GIF may be animated, SVG is not resized
+            return None
+        width, height = image.size
+
+        # The largest variant is the image recompressed at its own size
+        targets = sorted(set(min(w, width) for w in self.widths))
+        variants = list()
+        for targetWidth in targets:
+            for extension in [FORMATS[image.format], 'webp']:
+                if extension == 'webp' and not self.hasWebP():
+                    continue
+                # The extension of the source is kept, a.jpg and a.png
+                # do not share their variants
+                variant = '%s-%dw.%s' % (path, targetWidth, extension)
+                self.saveVariant(image, key, targetWidth, extension,
+                                 os.path.join(os.path.dirname(source), os.path.basename(variant)))
+                variants.append({
+                    'path': variant,
+                    'width': targetWidth,
+                    'height': self.getHeight(width, height, targetWidth),
+                    'mime': MIME_TYPES[extension]
+                })
+
+        return {
+            'hash': key,
+            'width': width,
+            'height': height,
+            'variants': variants
+        }
+
+    ##
+    # Link a variant from the derivatives store to destination, and
+    # render it first when the store does not have it yet
+    ##
+    def saveVariant(self, image, key, width, extension, destination):
+        store = self.fs.derivatives
+        blob = store.getBlobPath(
+            '%s-%dw-q%d.%s' % (key, width, self.quality, extension))
+        if os.path.exists(blob):
+            # Keeps the garbage collector from removing it before it is linked
+            os.utime(blob, None)
+        else:
+            store.makeDirs(os.path.dirname(blob))
+            tmpPath = os.path.join(store.path, '.' + str(uuid.uuid1()) + '.tmp')
+            try:
+                with open(tmpPath, 'wb') as f:
+                    f.write(self.render(image, width, extension))
+                os.rename(tmpPath, blob)
+            finally:
+                if os.path.exists(tmpPath):
+                    os.remove(tmpPath)
+
+        store.link(blob, destination)
+
+    ##
+    # Resize and compress an image, returns the bytes of the variant
+    ##
+    def render(self, image, width, extension):
+        if width < image.size[0]:
+            height = self.getHeight(image.size[0], image.size[1], width)
+            resample = getattr(Image, 'LANCZOS', Image.ANTIALIAS)
+            image = image.resize((width, height), resample)
+
+        output = StringIO.StringIO()
+        if extension == 'jpg':
+            if not image.mode in ('RGB', 'L'):
+                image = image.convert('RGB')
+            image.save(output, 'JPEG', quality=self.quality,
+                       optimize=True, progressive=True)
+        elif extension == 'png':
+            image.save(output, 'PNG', optimize=True)
+        else:
+            if not image.mode in ('RGB', 'RGBA'):
+                image = image.convert('RGBA')
+            image.save(output, 'WEBP', quality=self.quality)
+
+        return output.getvalue()
+
+    ##
+    # Height of a variant, the aspect ratio of the source is kept
+    ##
+    def getHeight(self, width, height, targetWidth):
+        return max(1, int(round(height * targetWidth / float(width))))
+
+    ##
+    # Pillow can be built without the WebP encoder
+    ##
+    def hasWebP(self):
+        Image.init()
+        return 'WEBP' in Image.SAVE
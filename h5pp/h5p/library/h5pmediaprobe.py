@@ -0,0 +1,502 @@
+##
+# Reads the size, duration and codecs of the media files from their
+# headers. Nothing is decoded, the parsers only read the few bytes they
+# need and seek over the rest, so probing a large video costs the same
+# as probing a small image.
+##
+import struct
+import os
+
+# Size of the end of an Ogg file searched for its last page
+OGG_TAIL_SIZE = 65536
+
+MP3_BITRATES = {
+    1: [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320],
+    2: [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160]
+}
+MP3_SAMPLE_RATES = [44100, 48000, 32000]
+
+MATROSKA_CODECS = {
+    'V_VP8': 'vp8',
+    'V_VP9': 'vp9',
+    'V_AV1': 'av01',
+    'A_VORBIS': 'vorbis',
+    'A_OPUS': 'opus'
+}
+
+##
+# Probe a seekable file object. Returns a dict with the format of the
+# file and, when they are found, its width, height, duration in seconds
+# and codecs, or None if the format is not recognized.
+##
+
+
+def probeMedia(f):
+    f.seek(0)
+    head = f.read(16)
+    if len(head) < 12:
+        return None
+
+    try:
+        if head.startswith('\x89PNG\r\n\x1a\n'):
+            return probePng(f)
+        elif head.startswith('\xff\xd8'):
+            return probeJpeg(f)
+        elif head.startswith('GIF87a') or head.startswith('GIF89a'):
+            return probeGif(f)
+        elif head.startswith('RIFF') and head[8:12] == 'WEBP':
+            return probeWebp(f)
+        elif head.startswith('RIFF') and head[8:12] == 'WAVE':
+            return probeWav(f)
+        elif head[4:8] == 'ftyp':
+            return probeMp4(f)
+        elif head.startswith('\x1a\x45\xdf\xa3'):
+            return probeMatroska(f)
+        elif head.startswith('OggS'):
+            return probeOgg(f)
+        elif head.startswith('ID3') or (ord(head[0]) == 0xff and ord(head[1]) & 0xe0 == 0xe0):
+            return probeMp3(f)
+    except (struct.error, ValueError, IndexError):
+        # Truncated or corrupted header
+        return None
+    finally:
+        f.seek(0)
+
+    return None
+
+
+def readAt(f, offset, size):
+    f.seek(offset)
+    data = f.read(size)
+    if len(data) < size:
+        raise ValueError('Unexpected end of file')
+    return data
+
+
+def getFileSize(f):
+    f.seek(0, os.SEEK_END)
+    return f.tell()
+
+##
+# Images
+##
+
+
+def probePng(f):
+    width, height = struct.unpack('>II', readAt(f, 16, 8))
+    return {'format': 'png', 'width': width, 'height': height}
+
+
+def probeGif(f):
+    width, height = struct.unpack('<HH', readAt(f, 6, 4))
+    return {'format': 'gif', 'width': width, 'height': height}
+
+
+def probeWebp(f):
+    chunk = readAt(f, 12, 4)
+    if chunk == 'VP8 ':
+        width, height = struct.unpack('<HH', readAt(f, 26, 4))
+        width, height = width & 0x3fff, height & 0x3fff
+    elif chunk == 'VP8L':
+        bits = struct.unpack('<I', readAt(f, 21, 4))[0]
+        width, height = (bits & 0x3fff) + 1, ((bits >> 14) & 0x3fff) + 1
+    elif chunk == 'VP8X':
+        data = readAt(f, 24, 6)
+        width = struct.unpack('<I', data[0:3] + '\0')[0] + 1
+        height = struct.unpack('<I', data[3:6] + '\0')[0] + 1
+    else:
+        return None
+    return {'format': 'webp', 'width': width, 'height': height}
+
+
+def probeJpeg(f):
+    offset = 2
+    while True:
+        marker = readAt(f, offset, 2)
+        if ord(marker[0]) != 0xff:
+            return None
+        code = ord(marker[1])
+        if code == 0xff:
+            # Fill byte
+            offset += 1
+            continue
+        if code == 0x01 or 0xd0 <= code <= 0xd9:
+            # Markers without payload
+            offset += 2
+            continue
+
+        length = struct.unpack('>H', readAt(f, offset + 2, 2))[0]
+        if 0xc0 <= code <= 0xcf and not code in (0xc4, 0xc8, 0xcc):
+            # Start of frame
+            height, width = struct.unpack('>HH', readAt(f, offset + 5, 4))
+            return {'format': 'jpeg', 'width': width, 'height': height}
+        offset += 2 + length
+
+##
+# MP4 and QuickTime
+##
+
+
+def readMp4Boxes(f, start, end):
+    offset = start
+    while offset + 8 <= end:
+        size, typ = struct.unpack('>I4s', readAt(f, offset, 8))
+        header = 8
+        if size == 1:
+            size = struct.unpack('>Q', readAt(f, offset + 8, 8))[0]
+            header = 16
+        elif size == 0:
+            size = end - offset
+        if size < header:
+            raise ValueError('Invalid box size')
+        yield typ, offset + header, offset + size
+        offset += size
+
+
+def probeMp4(f):
+    result = {'format': 'mp4'}
+    codecs = list()
+    for typ, moovStart, moovEnd in readMp4Boxes(f, 0, getFileSize(f)):
+        if typ != 'moov':
+            # The media data is skipped, wherever the index is
+            continue
+
+        for typ, start, end in readMp4Boxes(f, moovStart, moovEnd):
+            if typ == 'mvhd':
+                version = ord(readAt(f, start, 1))
+                if version == 1:
+                    timescale, duration = struct.unpack('>IQ', readAt(f, start + 20, 12))
+                else:
+                    timescale, duration = struct.unpack('>II', readAt(f, start + 12, 8))
+                if timescale:
+                    result['duration'] = float(duration) / timescale
+            elif typ == 'trak':
+                probeMp4Track(f, start, end, result, codecs)
+        break
+
+    if len(codecs) > 0:
+        result['codecs'] = ', '.join(codecs)
+    return result
+
+
+def probeMp4Track(f, start, end, result, codecs):
+    boxes = dict()
+    for typ, boxStart, boxEnd in readMp4Boxes(f, start, end):
+        boxes[typ] = (boxStart, boxEnd)
+
+    if 'tkhd' in boxes:
+        boxStart = boxes['tkhd'][0]
+        version = ord(readAt(f, boxStart, 1))
+        width, height = struct.unpack('>II', readAt(f, boxStart + (88 if version == 1 else 76), 8))
+        if width and height and not 'width' in result:
+            # 16.16 fixed point
+            result['width'], result['height'] = width >> 16, height >> 16
+
+    # mdia > minf > stbl > stsd holds the sample description
+    path = boxes.get('mdia')
+    for name in ('minf', 'stbl', 'stsd'):
+        if path == None:
+            return
+        path = dict((typ, (s, e)) for typ, s, e in readMp4Boxes(f, path[0], path[1])).get(name)
+    if path == None:
+        return
+
+    for typ, entryStart, entryEnd in readMp4Boxes(f, path[0] + 8, path[1]):
+        codecs.append(getMp4Codec(f, typ, entryStart, entryEnd))
+        break
+
+
+def getMp4Codec(f, typ, start, end):
+    if typ in ('avc1', 'avc3'):
+        # Visual sample entry, then the avcC box
+        for child, childStart, childEnd in readMp4Boxes(f, start + 78, end):
+            if child == 'avcC':
+                profile, compatibility, level = struct.unpack('>BBB', readAt(f, childStart + 1, 3))
+                return '%s.%02X%02X%02X' % (typ, profile, compatibility, level)
+    elif typ == 'mp4a':
+        # Audio sample entry, then the esds box
+        for child, childStart, childEnd in readMp4Boxes(f, start + 28, end):
+            if child == 'esds':
+                codec = getEsdsCodec(readAt(f, childStart + 4, min(childEnd - childStart - 4, 64)))
+                if codec:
+                    return codec
+    return typ
+
+
+def getEsdsCodec(data):
+    offset = 0
+    objectType = None
+    while offset < len(data):
+        tag = ord(data[offset])
+        offset += 1
+        # Expandable size on up to 4 bytes
+        size = 0
+        for i in range(4):
+            byte = ord(data[offset])
+            offset += 1
+            size = (size << 7) | (byte & 0x7f)
+            if not byte & 0x80:
+                break
+
+        if tag == 0x03:
+            flags = ord(data[offset + 2])
+            offset += 3
+            if flags & 0x80:
+                offset += 2
+            if flags & 0x40:
+                offset += 1 + ord(data[offset])
+            if flags & 0x20:
+                offset += 2
+        elif tag == 0x04:
+            objectType = ord(data[offset])
+            offset += 13
+        elif tag == 0x05 and objectType != None:
+            audioType = ord(data[offset]) >> 3
+            return 'mp4a.%x.%d' % (objectType, audioType)
+        else:
+            offset += size
+
+    return 'mp4a.%x' % objectType if objectType != None else None
+
+##
+# WebM and Matroska
+##
+
+
+def readVint(f, offset, keepMarker=False):
+    first = ord(readAt(f, offset, 1))
+    length = 1
+    while length <= 8 and not first & (0x80 >> (length - 1)):
+        length += 1
+    if length > 8:
+        raise ValueError('Invalid EBML number')
+
+    value = first if keepMarker else first & ((0x80 >> (length - 1)) - 1)
+    unknown = value == (0x80 >> (length - 1)) - 1
+    for byte in readAt(f, offset + 1, length - 1):
+        value = (value << 8) | ord(byte)
+        unknown = unknown and ord(byte) == 0xff
+    return value, length, unknown
+
+
+def readEbmlElements(f, start, end):
+    offset = start
+    while offset < end:
+        elementId, idLength, unknown = readVint(f, offset, True)
+        size, sizeLength, unknown = readVint(f, offset + idLength)
+        dataStart = offset + idLength + sizeLength
+        dataEnd = end if unknown else min(dataStart + size, end)
+        yield elementId, dataStart, dataEnd
+        offset = dataEnd
+
+
+def readEbmlUint(f, start, end):
+    value = 0
+    for byte in readAt(f, start, end - start):
+        value = (value << 8) | ord(byte)
+    return value
+
+
+def probeMatroska(f):
+    fileSize = getFileSize(f)
+    result = {'format': 'webm'}
+    codecs = list()
+    for elementId, start, end in readEbmlElements(f, 0, fileSize):
+        if elementId == 0x1a45dfa3:
+            for childId, childStart, childEnd in readEbmlElements(f, start, end):
+                if childId == 0x4282 and readAt(f, childStart, childEnd - childStart) == 'matroska':
+                    result['format'] = 'matroska'
+        elif elementId == 0x18538067:
+            probeMatroskaSegment(f, start, end, result, codecs)
+            break
+
+    if len(codecs) > 0:
+        result['codecs'] = ', '.join(codecs)
+    return result
+
+
+def probeMatroskaSegment(f, segmentStart, segmentEnd, result, codecs):
+    scale = 1000000
+    duration = None
+    for elementId, start, end in readEbmlElements(f, segmentStart, segmentEnd):
+        if elementId == 0x1549a966:
+            # Info
+            for childId, childStart, childEnd in readEbmlElements(f, start, end):
+                if childId == 0x2ad7b1:
+                    scale = readEbmlUint(f, childStart, childEnd)
+                elif childId == 0x4489:
+                    data = readAt(f, childStart, childEnd - childStart)
+                    duration = struct.unpack('>f' if len(data) == 4 else '>d', data)[0]
+        elif elementId == 0x1654ae6b:
+            # Tracks
+            for entryId, entryStart, entryEnd in readEbmlElements(f, start, end):
+                if entryId == 0xae:
+                    probeMatroskaTrack(f, entryStart, entryEnd, result, codecs)
+        elif elementId == 0x1f43b675:
+            # The clusters only hold the media data
+            break
+
+    if duration != None:
+        result['duration'] = duration * scale / 1000000000.0
+
+
+def probeMatroskaTrack(f, trackStart, trackEnd, result, codecs):
+    for elementId, start, end in readEbmlElements(f, trackStart, trackEnd):
+        if elementId == 0x86:
+            codec = readAt(f, start, end - start).rstrip('\0')
+            codecs.append(MATROSKA_CODECS.get(codec, codec))
+        elif elementId == 0xe0 and not 'width' in result:
+            for childId, childStart, childEnd in readEbmlElements(f, start, end):
+                if childId == 0xb0:
+                    result['width'] = readEbmlUint(f, childStart, childEnd)
+                elif childId == 0xba:
+                    result['height'] = readEbmlUint(f, childStart, childEnd)
+
+##
+# MP3
+##
+
+
+def probeMp3(f):
+    fileSize = getFileSize(f)
+    offset = 0
+    header = readAt(f, 0, 10)
+    if header.startswith('ID3'):
+        # Syncsafe size of the ID3v2 tag
+        size = 0
+        for byte in header[6:10]:
+            size = (size << 7) | (ord(byte) & 0x7f)
+        offset = 10 + size + (10 if ord(header[5]) & 0x10 else 0)
+
+    # The first frame may be preceded by padding
+    data = readAt(f, offset, min(4096, fileSize - offset))
+    for i in range(len(data) - 4):
+        bits = struct.unpack('>I', data[i:i + 4])[0]
+        if bits >> 21 == 0x7ff and (bits >> 17) & 0x3 == 1:
+            offset += i
+            break
+    else:
+        return None
+
+    version = (bits >> 19) & 0x3
+    mpeg = 1 if version == 3 else 2
+    bitrate = MP3_BITRATES[mpeg][(bits >> 12) & 0xf] * 1000
+    sampleRate = MP3_SAMPLE_RATES[(bits >> 10) & 0x3] / (1 if version == 3 else 2 if version == 2 else 4)
+    samples = 1152 if mpeg == 1 else 576
+    mono = (bits >> 6) & 0x3 == 3
+    result = {'format': 'mp3', 'codecs': 'mp3'}
+
+    # Xing or Info header of the variable bitrate files
+    xing = offset + 4 + (17 if mono else 32) if mpeg == 1 else offset + 4 + (9 if mono else 17)
+    tag = readAt(f, xing, 12)
+    if tag[0:4] in ('Xing', 'Info') and struct.unpack('>I', tag[4:8])[0] & 0x1:
+        frames = struct.unpack('>I', tag[8:12])[0]
+        result['duration'] = float(frames) * samples / sampleRate
+        return result
+    tag = readAt(f, offset + 36, 18)
+    if tag[0:4] == 'VBRI':
+        frames = struct.unpack('>I', tag[14:18])[0]
+        result['duration'] = float(frames) * samples / sampleRate
+        return result
+
+    # Constant bitrate
+    if bitrate:
+        end = fileSize
+        if fileSize > 128 and readAt(f, fileSize - 128, 3) == 'TAG':
+            end -= 128
+        result['duration'] = (end - offset) * 8.0 / bitrate
+    return result
+
+##
+# WAV
+##
+
+
+def probeWav(f):
+    fileSize = getFileSize(f)
+    result = {'format': 'wav'}
+    byteRate = None
+    offset = 12
+    while offset + 8 <= fileSize:
+        chunk, size = struct.unpack('<4sI', readAt(f, offset, 8))
+        if chunk == 'fmt ':
+            audioFormat, channels, sampleRate, byteRate = struct.unpack('<HHII', readAt(f, offset + 8, 12))
+            result['codecs'] = '%d' % audioFormat
+        elif chunk == 'data':
+            if byteRate:
+                result['duration'] = float(min(size, fileSize - offset - 8)) / byteRate
+            break
+        # Chunks are padded to an even size
+        offset += 8 + size + (size & 1)
+
+    return result
+
+##
+# Ogg (Vorbis, Opus and Theora)
+##
+
+
+def readOggPage(f, offset):
+    header = readAt(f, offset, 27)
+    if header[0:4] != 'OggS':
+        return None
+    headerType, granule, serial = struct.unpack('<BqI', header[5:18])
+    segments = ord(header[26])
+    bodySize = sum(ord(byte) for byte in readAt(f, offset + 27, segments))
+    bodyStart = offset + 27 + segments
+    return headerType, granule, serial, bodyStart, bodyStart + bodySize
+
+
+def probeOgg(f):
+    fileSize = getFileSize(f)
+    result = {'format': 'ogg'}
+    codecs = list()
+    streams = dict()
+
+    # The first page of each stream comes before any other page
+    offset = 0
+    while offset < fileSize:
+        page = readOggPage(f, offset)
+        if page == None or not page[0] & 0x02:
+            break
+        headerType, granule, serial, bodyStart, bodyEnd = page
+        body = readAt(f, bodyStart, min(bodyEnd - bodyStart, 64))
+        if body.startswith('\x80theora'):
+            width = struct.unpack('>I', '\0' + body[14:17])[0]
+            height = struct.unpack('>I', '\0' + body[17:20])[0]
+            rateNumerator, rateDenominator = struct.unpack('>II', body[22:30])
+            shift = ((ord(body[40]) & 0x03) << 3) | (ord(body[41]) >> 5)
+            result['width'], result['height'] = width, height
+            streams[serial] = ('theora', rateNumerator, rateDenominator, shift)
+            codecs.append('theora')
+        elif body.startswith('\x01vorbis'):
+            streams[serial] = ('vorbis', struct.unpack('<I', body[12:16])[0])
+            codecs.append('vorbis')
+        elif body.startswith('OpusHead'):
+            streams[serial] = ('opus', struct.unpack('<H', body[10:12])[0])
+            codecs.append('opus')
+        offset = bodyEnd
+
+    if len(codecs) > 0:
+        result['codecs'] = ', '.join(codecs)
+
+    # The duration is given by the position of the last page of a stream
+    tailStart = max(0, fileSize - OGG_TAIL_SIZE)
+    tail = readAt(f, tailStart, fileSize - tailStart)
+    position = tail.rfind('OggS')
+    while position >= 0 and len(tail) - position >= 27:
+        granule, serial = struct.unpack('<qI', tail[position + 6:position + 18])
+        stream = streams.get(serial)
+        if stream != None and granule >= 0:
+            if stream[0] == 'theora' and stream[1]:
+                frames = (granule >> stream[3]) + (granule & ((1 << stream[3]) - 1))
+                result['duration'] = float(frames) * stream[2] / stream[1]
+            elif stream[0] == 'vorbis' and stream[1]:
+                result['duration'] = float(granule) / stream[1]
+            elif stream[0] == 'opus':
+                result['duration'] = float(granule - stream[1]) / 48000
+            if 'duration' in result:
+                break
+        position = tail.rfind('OggS', 0, position)
+
+    return result
@@ -0,0 +1,108 @@
+##
+# Read access to an uploaded .h5p file without extracting it. The files
+# are listed from the central directory of the zip, and each folder is
+# extracted once, straight to its final location.
+##
+import zipfile
+import shutil
+import json
+import os
+
+
+class H5PPackage:
+
+    ##
+    # Constructor for the H5PPackage. Raises zipfile.BadZipfile if the
+    # file is not a zip, and ValueError if a file name is not safe.
+    ##
+    def __init__(self, path):
+        self.path = path
+        self.zipf = zipfile.ZipFile(path, 'r')
+        self.entries = dict()
+        self.folders = dict()
+
+        for info in self.zipf.infolist():
+            name = info.filename.replace('\\', '/')
+            if name.endswith('/'):
+                # Folder entry
+                continue
+            parts = name.split('/')
+            if name.startswith('/') or '..' in parts or ':' in parts[0]:
+                self.zipf.close()
+                raise ValueError('Unsafe file name %s' % info.filename)
+
+            self.entries[name] = info
+            if len(parts) > 1:
+                self.folders.setdefault(parts[0], list()).append(
+                    '/'.join(parts[1:]))
+
+    ##
+    # Names of the files at the root of the package
+    ##
+    def getRootFiles(self):
+        return [name for name in self.entries if not '/' in name]
+
+    ##
+    # Names of the folders at the root of the package
+    ##
+    def getFolders(self):
+        return self.folders.keys()
+
+    ##
+    # Paths of the files of a folder, relative to the folder
+    ##
+    def getFiles(self, folder):
+        return self.folders.get(folder, list())
+
+    def hasFile(self, name):
+        return name in self.entries
+
+    def read(self, name):
+        return self.zipf.read(self.entries[name])
+
+    ##
+    # Parse a JSON file of the package, False if it is missing or invalid
+    ##
+    def getJsonData(self, name, returnAsString=False):
+        if not name in self.entries:
+            return False
+
+        data = self.read(name)
+        try:
+            jsonData = json.loads(data)
+        except ValueError:
+            return False
+        if jsonData == None:
+            return False
+
+        return data if returnAsString else jsonData
+
+    ##
+    # Extract the files of a folder of the package into a directory,
+    # through the given H5PBlobStore if any
+    ##
+    def extract(self, folder, destination, blobs=None):
+        for name in self.getFiles(folder):
+            parts = name.split('/')
+            if '.git' in parts or parts[-1] == '.gitignore':
+                continue
+            target = os.path.join(destination, *parts)
+            if not os.path.isdir(os.path.dirname(target)):
+                os.makedirs(os.path.dirname(target))
+            source = self.zipf.open(self.entries[folder + '/' + name])
+            try:
+                if blobs != None:
+                    blobs.saveFileObject(source, target)
+                else:
+                    with open(target, 'wb') as f:
+                        shutil.copyfileobj(source, f, 65536)
+            finally:
+                source.close()
+
+    ##
+    # Close the package and remove the uploaded file
+    ##
+    def delete(self):
+        self.zipf.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
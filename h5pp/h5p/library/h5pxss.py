@@ -0,0 +1,218 @@
+##
+# Single pass HTML filter preventing cross-site-scripting (XSS).
+# Based on the rules of the Drupal filter used by H5P: only the allowed
+# tags are kept, event handler attributes are removed, URLs with a
+# dangerous protocol are neutralised and styles must match the patterns
+# given by the semantics.
+##
+import re
+
+# One token per tag, comment, lone bracket, entity or NULL character.
+# Everything between two tokens is plain text and is kept as it is.
+TOKEN_REGEXP = re.compile(r"""
+    (?P<comment><!--.*?(?:-->|$))
+  | (?P<tag><(?P<slash>/\s*)?(?P<elem>[a-zA-Z][a-zA-Z0-9\-]*)(?P<attributes>[^>]*)(?:>|$))
+  | (?P<malformed><[!/][^>]*(?:>|$))
+  | (?P<lt><)
+  | (?P<gt>>)
+  | (?P<netscape>&\s*\{[^}]*(?:\}\s*;?|$))
+  | (?P<entity>&(?:\#[0-9]+;|\#[xX]0*(?:[0-9A-Fa-f]{2})+;|[A-Za-z][A-Za-z0-9]*;))
+  | (?P<amp>&)
+  | (?P<null>\x00)
+""", re.S | re.X)
+
+ATTRIBUTE_REGEXP = re.compile(r"""
+    (?P<name>[a-zA-Z_:][-a-zA-Z0-9_:.]*)
+    (?:\s*=\s*(?:"(?P<double>[^"]*)"?|'(?P<single>[^']*)'?|(?P<bare>[^\s"'>]+)))?
+""", re.X)
+
+ENTITY_REGEXP = re.compile(
+    r'&(?!#[0-9]+;|#[xX]0*(?:[0-9A-Fa-f]{2})+;|[A-Za-z][A-Za-z0-9]*;)')
+
+XHTML_SLASH_REGEXP = re.compile(r'\s?/\s*$')
+
+PROTOCOL_REGEXP = re.compile(r'^\s*([^/:?#]+):')
+
+ALLOWED_PROTOCOLS = frozenset(['http', 'https', 'ftp', 'news', 'nntp', 'tel', 'telnet',
+                               'mailto', 'irc', 'ssh', 'sftp', 'webcal', 'rtsp'])
+
+URL_ATTRIBUTES = frozenset(['href', 'src', 'cite', 'action', 'background', 'longdesc',
+                            'poster', 'formaction', 'data', 'xlink:href'])
+
+
+class H5PXssFilter:
+
+    ##
+    # Constructor for the H5PXssFilter
+    #
+    # allowedStyles are the patterns a style declaration must match, they
+    # are only used on the styleableTags.
+    ##
+    def __init__(self, allowedTags, allowedStyles=None, styleableTags=None):
+        self.allowedTags = frozenset(tag.lower() for tag in allowedTags)
+        self.allowComments = '!--' in self.allowedTags
+        self.allowedStyles = [re.compile(pattern) if isinstance(pattern, basestring) else pattern
+                              for pattern in allowedStyles] if allowedStyles else None
+        self.styleableTags = frozenset(styleableTags) if styleableTags else frozenset()
+
+    ##
+    # Filter an HTML string
+    ##
+    def filter(self, string):
+        if len(string) == 0:
+            return string
+
+        # Only operate on valid UTF-8 strings
+        if isinstance(string, str):
+            try:
+                string = string.decode('utf-8')
+            except UnicodeDecodeError:
+                return ''
+            return TOKEN_REGEXP.sub(self.filterToken, string).encode('utf-8')
+
+        return TOKEN_REGEXP.sub(self.filterToken, string)
+
+    def filterToken(self, m):
+        kind = m.lastgroup
+        if kind == 'tag':
+            return self.filterTag(m)
+        elif kind == 'entity':
+            return m.group(0)
+        elif kind == 'amp':
+            # Defuse the HTML entities which are not well-formed
+            return '&amp;'
+        elif kind == 'lt':
+            # We matched a lone "<" character
+            return '&lt;'
+        elif kind == 'gt':
+            # We matched a lone ">" character
+            return '&gt;'
+        elif kind == 'comment':
+            return m.group(0) if self.allowComments else ''
+
+        # Remove NULL characters (ignored by some browsers), Netscape 4 JS
+        # entities and seriously malformed tags
+        return ''
+
+    ##
+    # Process an HTML tag
+    ##
+    def filterTag(self, m):
+        elem = m.group('elem')
+        if not elem.lower() in self.allowedTags:
+            # Disallowed HTML element
+            return ''
+
+        if m.group('slash') != None:
+            return '</' + elem + '>'
+
+        attributes = m.group('attributes').replace('\x00', '')
+
+        # Is there a closing XHTML slash at the end of the attributes ?
+        xhtmlSlash = ''
+        if XHTML_SLASH_REGEXP.search(attributes):
+            attributes = XHTML_SLASH_REGEXP.sub('', attributes)
+            xhtmlSlash = ' /'
+
+        styles = self.allowedStyles if elem.lower() in self.styleableTags else None
+        attributes = self.filterAttributes(attributes, styles)
+
+        return '<' + elem + attributes + xhtmlSlash + '>'
+
+    ##
+    # Keep the safe attributes of a tag
+    ##
+    def filterAttributes(self, attributes, styles):
+        result = ''
+        seen = set()
+        for m in ATTRIBUTE_REGEXP.finditer(attributes):
+            name = m.group('name').lower()
+            if name in seen or name.startswith('on'):
+                # Skip duplicates and event handlers
+                continue
+            seen.add(name)
+
+            value = m.group('double')
+            if value == None:
+                value = m.group('single')
+            if value == None:
+                value = m.group('bare')
+
+            if name == 'style':
+                value = self.filterStyle(value, styles)
+                if value == None:
+                    continue
+            elif value != None and name in URL_ATTRIBUTES:
+                value = self.filterProtocol(value)
+
+            if value == None:
+                result = result + ' ' + name
+            else:
+                value = ENTITY_REGEXP.sub('&amp;', value)
+                result = result + ' ' + name + '="' + \
+                    value.replace('"', '&quot;').replace('<', '&lt;').replace('>', '&gt;') + '"'
+
+        return result
+
+    ##
+    # Keep the style declarations matching one of the allowed patterns
+    ##
+    def filterStyle(self, value, styles):
+        if not styles or not value:
+            return None
+
+        declarations = list()
+        for declaration in value.split(';'):
+            declaration = declaration.strip()
+            if declaration == '':
+                continue
+            for pattern in styles:
+                if pattern.search(declaration):
+                    declarations.append(declaration)
+                    break
+
+        return '; '.join(declarations) if len(declarations) > 0 else None
+
+    ##
+    # Remove dangerous protocols (like javascript:) from an URL
+    ##
+    def filterProtocol(self, value):
+        # Entities could hide the protocol
+        value = decodeEntities(value)
+        while True:
+            m = PROTOCOL_REGEXP.search(value)
+            if not m or m.group(1).strip().lower() in ALLOWED_PROTOCOLS:
+                return value
+            value = value[m.end():]
+
+##
+# Decode the numeric entities and the basic named ones
+##
+
+
+NUMERIC_ENTITY_REGEXP = re.compile(r'&#(?:([0-9]+)|[xX]([0-9A-Fa-f]+));?')
+
+NAMED_ENTITIES = {
+    'amp': '&',
+    'lt': '<',
+    'gt': '>',
+    'quot': '"',
+    'apos': "'",
+    'colon': ':',
+    'tab': '\t',
+    'newline': '\n'
+}
+
+NAMED_ENTITY_REGEXP = re.compile(r'&(' + '|'.join(NAMED_ENTITIES) + r');', re.I)
+
+
+def decodeEntities(value):
+    def decodeNumeric(m):
+        try:
+            code = int(m.group(1)) if m.group(1) else int(m.group(2), 16)
+            return unichr(code)
+        except (ValueError, OverflowError):
+            return ''
+
+    value = NUMERIC_ENTITY_REGEXP.sub(decodeNumeric, value)
+    return NAMED_ENTITY_REGEXP.sub(lambda m: NAMED_ENTITIES[m.group(1).lower()], value)
@@ -0,0 +1,147 @@
+##
+# Zip archive writer producing the archive as a stream of chunks, so it
+# can be sent while it is built without a seekable file. Deflated entries
+# are followed by a data descriptor, stored entries have their CRC read
+# beforehand so they are readable by any unzip tool.
+##
+import zipfile
+import struct
+import zlib
+import time
+import os
+
+# Sizes and offsets above this need the Zip64 extensions
+ZIP64_LIMIT = (1 << 31) - 1
+
+
+class H5PZipStream:
+
+    ##
+    # Constructor for the H5PZipStream
+    ##
+    def __init__(self, chunkSize=65536, compressLevel=6):
+        self.chunkSize = chunkSize
+        self.compressLevel = compressLevel
+        self.offset = 0
+        self.central = list()
+
+    ##
+    # Generate the archive of the given entries. Each entry is a tuple of
+    # the name in the archive, the path of the file or None, the data when
+    # there is no file, and zipfile.ZIP_STORED or zipfile.ZIP_DEFLATED.
+    ##
+    def stream(self, entries):
+        for name, path, data, compressType in entries:
+            for chunk in self.streamEntry(name, path, data, compressType):
+                self.offset += len(chunk)
+                yield chunk
+
+        yield self.centralDirectory()
+
+    def streamEntry(self, name, path, data, compressType):
+        if path != None:
+            size = os.path.getsize(path)
+            dateTime = time.localtime(os.path.getmtime(path))[0:6]
+        else:
+            size = len(data)
+            dateTime = time.localtime()[0:6]
+
+        if isinstance(name, unicode):
+            name = name.encode('utf-8')
+            flags = 0x800
+        else:
+            flags = 0
+        dosTime = (dateTime[3] << 11) | (dateTime[4] << 5) | (dateTime[5] // 2)
+        dosDate = ((max(dateTime[0], 1980) - 1980) << 9) | (dateTime[1] << 5) | dateTime[2]
+        zip64 = size > ZIP64_LIMIT
+        headerOffset = self.offset
+
+        if compressType == zipfile.ZIP_STORED:
+            # The CRC is needed in the header of the entries without descriptor
+            crc = 0
+            for chunk in self.readChunks(path, data):
+                crc = zlib.crc32(chunk, crc)
+            crc = crc & 0xffffffff
+            yield self.localHeader(name, flags, compressType, dosTime, dosDate, crc, size, size, zip64)
+            for chunk in self.readChunks(path, data):
+                yield chunk
+            compressSize = size
+        else:
+            flags = flags | 0x08
+            yield self.localHeader(name, flags, compressType, dosTime, dosDate, 0, 0, 0, zip64)
+            crc = 0
+            compressSize = 0
+            compressor = zlib.compressobj(self.compressLevel, zlib.DEFLATED, -15)
+            for chunk in self.readChunks(path, data):
+                crc = zlib.crc32(chunk, crc)
+                chunk = compressor.compress(chunk)
+                if chunk:
+                    compressSize += len(chunk)
+                    yield chunk
+            chunk = compressor.flush()
+            compressSize += len(chunk)
+            yield chunk
+            crc = crc & 0xffffffff
+            yield struct.pack('<4sL' + ('QQ' if zip64 else 'LL'), 'PK\x07\x08', crc, compressSize, size)
+
+        self.central.append((name, flags, compressType, dosTime, dosDate, crc, compressSize, size, headerOffset))
+
+    def readChunks(self, path, data):
+        if path == None:
+            for start in range(0, len(data), self.chunkSize):
+                yield data[start:start + self.chunkSize]
+            return
+
+        with open(path, 'rb') as f:
+            while True:
+                chunk = f.read(self.chunkSize)
+                if not chunk:
+                    break
+                yield chunk
+
+    def localHeader(self, name, flags, compressType, dosTime, dosDate, crc, compressSize, size, zip64):
+        extra = ''
+        if zip64:
+            extra = struct.pack('<HHQQ', 1, 16, size, compressSize)
+            size = compressSize = 0xffffffff
+        return struct.pack('<4sHHHHHLLLHH', 'PK\x03\x04', 45 if zip64 else 20, flags, compressType,
+                           dosTime, dosDate, crc, compressSize, size, len(name), len(extra)) + name + extra
+
+    ##
+    # Build the central directory and the end records
+    ##
+    def centralDirectory(self):
+        records = list()
+        for name, flags, compressType, dosTime, dosDate, crc, compressSize, size, headerOffset in self.central:
+            extraFields = list()
+            if size > ZIP64_LIMIT:
+                extraFields.append(size)
+                size = 0xffffffff
+            if compressSize > ZIP64_LIMIT:
+                extraFields.append(compressSize)
+                compressSize = 0xffffffff
+            if headerOffset > ZIP64_LIMIT:
+                extraFields.append(headerOffset)
+                headerOffset = 0xffffffff
+            extra = ''
+            if len(extraFields) > 0:
+                extra = struct.pack('<HH' + 'Q' * len(extraFields), 1, 8 * len(extraFields), *extraFields)
+
+            version = 45 if extra else 20
+            records.append(struct.pack('<4sBBBBHHHHLLLHHHHHLL', 'PK\x01\x02', version, 3, version, 0, flags,
+                                       compressType, dosTime, dosDate, crc, compressSize, size, len(name),
+                                       len(extra), 0, 0, 0, 0o100644 << 16, headerOffset) + name + extra)
+
+        directory = ''.join(records)
+        count = len(self.central)
+        directoryOffset = self.offset
+        if count > 0xffff or len(directory) > ZIP64_LIMIT or directoryOffset > ZIP64_LIMIT:
+            end64Offset = directoryOffset + len(directory)
+            directory += struct.pack('<4sQHHLLQQQQ', 'PK\x06\x06', 44, 45, 45, 0, 0, count, count,
+                                     len(directory), directoryOffset)
+            directory += struct.pack('<4sLQL', 'PK\x06\x07', 0, end64Offset, 1)
+            return directory + struct.pack('<4sHHHHLLH', 'PK\x05\x06', 0, 0, min(count, 0xffff),
+                                           min(count, 0xffff), 0xffffffff, 0xffffffff, 0)
+
+        return directory + struct.pack('<4sHHHHLLH', 'PK\x05\x06', 0, 0, count, count,
+                                       len(directory), directoryOffset, 0)
@@ -0,0 +1,143 @@
+##
+# Benchmark of the hot lookups with and without the indexes of the
+# 0004_indexes migration, on a seeded dataset rolled back at the end.
+##
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from h5pp.models import h5p_libraries, h5p_contents, h5p_contents_libraries, h5p_content_user_data, h5p_events
+import random
+import time
+
+
+class Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = 'Show the query plans and timings of the hot lookups with and without indexes'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--libraries', type=int, default=300)
+        parser.add_argument('--contents', type=int, default=20000)
+        parser.add_argument('--users', type=int, default=2000)
+        parser.add_argument('--events', type=int, default=100000)
+        parser.add_argument('--repeat', type=int, default=200)
+
+    def handle(self, *args, **options):
+        if connection.vendor == 'mysql':
+            raise CommandError(
+                'MySQL commits schema changes, the benchmark cannot be rolled back.')
+
+        try:
+            with transaction.atomic():
+                self.seed(options)
+                self.stdout.write('==== With indexes ====')
+                self.run(options['repeat'])
+                self.dropIndexes()
+                self.stdout.write('==== Without indexes ====')
+                self.run(options['repeat'])
+                raise Rollback()
+        except Rollback:
+            pass
+
+    ##
+    # Fill the tables with a dataset of the given size
+    ##
+    def seed(self, options):
+        random.seed(0)
+        now = int(time.time())
+        self.libraries = [('H5P.Library%s' % i, i % 3 + 1, i % 7)
+                          for i in range(options['libraries'])]
+        h5p_libraries.objects.bulk_create([
+            h5p_libraries(machine_name=name, title=name, major_version=major, minor_version=minor,
+                          patch_version=0, semantics='', preloaded_js='', preloaded_css='')
+            for name, major, minor in self.libraries
+        ], batch_size=500)
+        libraryIds = list(h5p_libraries.objects.values_list('library_id', flat=True))
+
+        h5p_contents.objects.bulk_create([
+            h5p_contents(title='Content %s' % i, json_contents='{}', main_library_id=random.choice(libraryIds),
+                         filtered='', slug='content-%s' % i)
+            for i in range(options['contents'])
+        ], batch_size=500)
+        self.contentIds = list(h5p_contents.objects.values_list('content_id', flat=True))
+
+        h5p_contents_libraries.objects.bulk_create([
+            h5p_contents_libraries(content_id=contentId, library_id=libraryId, weight=weight)
+            for contentId in self.contentIds
+            for weight, libraryId in enumerate(random.sample(libraryIds, min(8, len(libraryIds))))
+        ], batch_size=500)
+
+        h5p_content_user_data.objects.bulk_create([
+            h5p_content_user_data(user_id=userId, content_main_id=contentId, sub_content_id=0,
+                                  data_id='state', timestamp=now, data='{}', preloaded=1)
+            for userId in range(1, options['users'] + 1)
+            for contentId in random.sample(self.contentIds, min(10, len(self.contentIds)))
+        ], batch_size=500)
+
+        h5p_events.objects.bulk_create([
+            h5p_events(user_id=random.randint(1, options['users']), created_at=now - i * 60, type='content',
+                       sub_type='create', content_id=0, content_title='', library_name='', library_version='')
+            for i in range(options['events'])
+        ], batch_size=500)
+        self.users = options['users']
+        self.now = now
+
+    ##
+    # The lookups done by the application, built with the same querysets
+    ##
+    def queries(self):
+        name, major, minor = random.choice(self.libraries)
+        return [
+            ('library by name and version', h5p_libraries.objects.filter(
+                machine_name=name, major_version=major, minor_version=minor)),
+            ('content slug probe', h5p_contents.objects.filter(
+                slug='content-%s' % random.randint(0, len(self.contentIds))).values('slug')),
+            ('content dependencies', h5p_contents_libraries.objects.filter(
+                content_id=random.choice(self.contentIds)).order_by('weight')),
+            ('preloaded user data', h5p_content_user_data.objects.filter(
+                user_id=random.randint(1, self.users), content_main_id=random.choice(self.contentIds),
+                preloaded=1).values('sub_content_id', 'data_id', 'data')),
+            ('events by date', h5p_events.objects.filter(
+                created_at__lt=self.now - 2592000).order_by('created_at')[0:50]),
+            ('contents list page', h5p_contents.objects.order_by('title', 'content_id')[0:50])
+        ]
+
+    def run(self, repeat):
+        for label, queryset in self.queries():
+            sql, params = queryset.query.sql_with_params()
+            self.stdout.write('-- %s' % label)
+            for line in self.explain(sql, params):
+                self.stdout.write('   %s' % line)
+
+        timings = dict()
+        for i in range(repeat):
+            for label, queryset in self.queries():
+                start = time.time()
+                list(queryset)
+                timings[label] = timings.get(label, 0) + time.time() - start
+
+        for label, query in self.queries():
+            self.stdout.write('%-30s %8.3f ms' % (label, timings[label] * 1000 / repeat))
+
+    def explain(self, sql, params):
+        prefix = 'EXPLAIN QUERY PLAN ' if connection.vendor == 'sqlite' else 'EXPLAIN '
+        cursor = connection.cursor()
+        cursor.execute(prefix + sql, params)
+        return [' | '.join(unicode(column) for column in row) for row in cursor.fetchall()]
+
+    ##
+    # Remove the indexes added by the 0004_indexes migration
+    ##
+    def dropIndexes(self):
+        with connection.schema_editor() as editor:
+            for model in [h5p_libraries, h5p_contents, h5p_contents_libraries, h5p_content_user_data]:
+                editor.alter_index_together(
+                    model, model._meta.index_together, [])
+
+            for model, name in [(h5p_contents, 'slug'), (h5p_events, 'created_at')]:
+                old = model._meta.get_field(name)
+                new = old.clone()
+                new.set_attributes_from_name(name)
+                new.db_index = False
+                editor.alter_field(model, old, new)
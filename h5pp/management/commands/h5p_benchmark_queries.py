@@ -0,0 +1,97 @@
+##
+# Micro-benchmark of the hot raw queries: interpolated SQL as it used to
+# be built, parameterised statements and PostgreSQL prepared statements,
+# run by several concurrent clients like pgbench does.
+##
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from h5pp.models import h5p_contents, h5p_libraries
+from h5pp.h5p.h5pqueries import QUERIES, executeQuery
+import threading
+import random
+import time
+
+
+class Command(BaseCommand):
+    help = 'Compare the latency of interpolated, parameterised and prepared queries'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--clients', type=int, default=8)
+        parser.add_argument('--transactions', type=int, default=500,
+                            help='Number of queries run by each client')
+
+    def handle(self, *args, **options):
+        contentIds = list(h5p_contents.objects.values_list('content_id', flat=True)[0:1000])
+        libraries = list(h5p_libraries.objects.values_list(
+            'library_id', 'machine_name', 'major_version', 'minor_version')[0:1000])
+        if len(contentIds) == 0 or len(libraries) == 0:
+            raise CommandError('The benchmark needs contents and libraries in the database.')
+
+        self.contentIds = contentIds
+        self.libraries = libraries
+        modes = ['interpolated', 'parameterised']
+        if connection.vendor == 'postgresql':
+            modes.append('prepared')
+
+        self.stdout.write('%-15s %-28s %10s %10s %10s' %
+                          ('mode', 'query', 'mean ms', 'p95 ms', 'qps'))
+        for mode in modes:
+            timings = dict()
+            lock = threading.Lock()
+            clients = [threading.Thread(target=self.client, args=(mode, options['transactions'], timings, lock))
+                       for i in range(options['clients'])]
+            start = time.time()
+            for client in clients:
+                client.start()
+            for client in clients:
+                client.join()
+            elapsed = time.time() - start
+
+            for name in sorted(timings):
+                durations = sorted(timings[name])
+                self.stdout.write('%-15s %-28s %10.3f %10.3f %10.1f' % (
+                    mode, name,
+                    sum(durations) * 1000 / len(durations),
+                    durations[int(len(durations) * 0.95)] * 1000,
+                    len(durations) / elapsed))
+
+    ##
+    # One client running random hot queries on its own connection
+    ##
+    def client(self, mode, transactions, timings, lock):
+        local = dict()
+        try:
+            for i in range(transactions):
+                name, params = self.pick()
+                start = time.time()
+                if mode == 'interpolated':
+                    cursor = connection.cursor()
+                    cursor.execute(QUERIES[name] % tuple(
+                        self.literal(param) for param in params))
+                else:
+                    cursor = executeQuery(name, params, mode == 'prepared')
+                cursor.fetchall()
+                local.setdefault(name, list()).append(time.time() - start)
+        finally:
+            connection.close()
+
+        with lock:
+            for name, durations in local.iteritems():
+                timings.setdefault(name, list()).extend(durations)
+
+    def pick(self):
+        contentId = random.choice(self.contentIds)
+        libraryId, machineName, major, minor = random.choice(self.libraries)
+        return random.choice([
+            ('content', [contentId]),
+            ('contentDependencies', [contentId]),
+            ('contentDependenciesByType', [contentId, 'preloaded']),
+            ('libraryDependencies', [libraryId]),
+            ('libraryUsage', [libraryId]),
+            ('libraryLanguage', [machineName, major, minor, 'fr'])
+        ])
+
+    def literal(self, value):
+        if isinstance(value, basestring):
+            return "'" + value.replace("'", "''") + "'"
+        return str(value)
@@ -0,0 +1,64 @@
+##
+# Benchmark of the HTML filter on the rich text fields of the installed
+# contents, or on a corpus previously dumped with --dump.
+##
+from django.core.management.base import BaseCommand, CommandError
+from h5pp.models import h5p_contents
+from h5pp.h5p.library.h5pxss import H5PXssFilter
+import json
+import time
+
+# Tags allowed by the common H5P html fields
+DEFAULT_TAGS = ['p', 'br', 'strong', 'em', 'del', 'u', 'sub', 'sup', 'a', 'span', 'div', 'ul', 'ol', 'li',
+                'h2', 'h3', 'hr', 'pre', 'code', 'table', 'tr', 'td', 'th', 'thead', 'tbody', 'caption']
+
+
+class Command(BaseCommand):
+    help = 'Measure the throughput of the HTML filter on a corpus of rich text fields'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--corpus', help='JSON list of strings to filter')
+        parser.add_argument('--dump', help='Write the corpus found in the contents to this file')
+        parser.add_argument('--repeat', type=int, default=10)
+
+    def handle(self, *args, **options):
+        if options['corpus']:
+            with open(options['corpus']) as f:
+                corpus = [field.encode('utf-8') for field in json.load(f)]
+        else:
+            corpus = list()
+            for params in h5p_contents.objects.values_list('json_contents', flat=True).iterator():
+                self.collect(json.loads(params), corpus)
+
+        if len(corpus) == 0:
+            raise CommandError('No rich text field found.')
+
+        if options['dump']:
+            with open(options['dump'], 'w') as f:
+                json.dump([field.decode('utf-8') for field in corpus], f)
+
+        htmlFilter = H5PXssFilter(DEFAULT_TAGS, ['(?i)^text-align: *(center|left|right);?$'], [
+                                  'p', 'h2', 'h3', 'div'])
+        size = sum(len(field) for field in corpus)
+        start = time.time()
+        for i in range(options['repeat']):
+            for field in corpus:
+                htmlFilter.filter(field)
+        elapsed = time.time() - start
+
+        count = len(corpus) * options['repeat']
+        self.stdout.write('%d fields, %d bytes' % (len(corpus), size))
+        self.stdout.write('total %.3f s, %.3f ms per field, %.1f kB/s' % (
+            elapsed, elapsed * 1000 / count, size * options['repeat'] / elapsed / 1024))
+
+    ##
+    # Gather the strings holding HTML in the parameters of a content
+    ##
+    def collect(self, params, corpus):
+        if isinstance(params, dict):
+            params = params.values()
+        if isinstance(params, list):
+            for value in params:
+                self.collect(value, corpus)
+        elif isinstance(params, basestring) and '<' in params:
+            corpus.append(params.encode('utf-8'))
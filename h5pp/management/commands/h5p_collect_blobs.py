@@ -0,0 +1,30 @@
+##
+# Garbage collector of the media store. Removes the blobs and the image
+# variants which are no longer linked from any content or editor folder.
+##
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from h5pp.h5p.library.h5pdefaultstorage import H5PDefaultStorage
+import os
+
+
+class Command(BaseCommand):
+    help = 'Remove the H5P media files which are not used by any content anymore'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--min-age', type=int, default=3600,
+                            help='Only remove the files older than this number of seconds')
+        parser.add_argument('--dry-run', action='store_true', default=False,
+                            help='Only count the files which would be removed')
+
+    def handle(self, *args, **options):
+        storage = H5PDefaultStorage(os.path.join(settings.MEDIA_ROOT, 'h5pp'))
+        count, size = storage.blobs.collectGarbage(
+            options['min_age'], options['dry_run'])
+        derivatives = storage.derivatives.collectGarbage(
+            options['min_age'], options['dry_run'])
+        count += derivatives[0]
+        size += derivatives[1]
+
+        self.stdout.write('%s %d unused files, %.1f MB' % (
+            'Found' if options['dry_run'] else 'Removed', count, size / 1048576.0))
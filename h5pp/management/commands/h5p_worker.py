@@ -0,0 +1,62 @@
+##
+# Worker running the background jobs queued in the h5p_jobs table.
+# Several workers, threads or processes can run at the same time, each
+# job is only claimed by one of them.
+##
+from django.core.management.base import BaseCommand
+from django.db import connection, close_old_connections
+from h5pp.h5p.h5pjobs import runPendingJobs
+# Registers the job handlers
+import h5pp.h5p.h5pmodule
+import multiprocessing
+import threading
+import time
+
+
+class Command(BaseCommand):
+    help = 'Run the queued H5P jobs (parameters filtering, library usage, export files, image variants)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', default=False,
+                            help='Exit when the queue is empty')
+        parser.add_argument('--threads', type=int, default=1)
+        parser.add_argument('--processes', type=int, default=1)
+        parser.add_argument('--sleep', type=float, default=5,
+                            help='Seconds to wait when the queue is empty')
+
+    def handle(self, *args, **options):
+        if options['processes'] > 1:
+            # The forked processes must not share the database connection
+            connection.close()
+            processes = [multiprocessing.Process(target=self.work, args=(options,))
+                         for i in range(options['processes'])]
+            for process in processes:
+                process.start()
+            for process in processes:
+                process.join()
+        else:
+            self.work(options)
+
+    def work(self, options):
+        threads = [threading.Thread(target=self.loop, args=(options,))
+                   for i in range(options['threads'] - 1)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        self.loop(options)
+        for thread in threads:
+            thread.join()
+
+    def loop(self, options):
+        try:
+            while True:
+                close_old_connections()
+                count = runPendingJobs()
+                if count > 0:
+                    self.stdout.write('%d H5P jobs run' % count)
+                elif options['once']:
+                    break
+                else:
+                    time.sleep(options['sleep'])
+        finally:
+            connection.close()
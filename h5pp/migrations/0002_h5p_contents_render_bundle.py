@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('h5pp', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='h5p_contents',
+            name='render_bundle',
+            field=models.TextField(default='', help_text='Precomputed settings and assets used to display the content', blank=True),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('h5pp', '0002_h5p_contents_render_bundle'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='h5p_libraries_cachedassets',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('library_id', models.PositiveIntegerField()),
+                ('hash', models.CharField(help_text='Hash of the dependencies set, name of the cached files', max_length=64)),
+            ],
+            options={
+                'db_table': 'h5p_libraries_cachedassets',
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='h5p_libraries_cachedassets',
+            unique_together=set([('library_id', 'hash')]),
+        ),
+    ]
@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('h5pp', '0003_h5p_libraries_cachedassets'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='h5p_contents',
+            name='slug',
+            field=models.CharField(help_text='Human readable content identifier that is unique', max_length=127, db_index=True),
+        ),
+        migrations.AlterField(
+            model_name='h5p_events',
+            name='created_at',
+            field=models.IntegerField(db_index=True),
+        ),
+        migrations.AlterIndexTogether(
+            name='h5p_content_user_data',
+            index_together=set([('user_id', 'content_main_id', 'preloaded')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='h5p_contents',
+            index_together=set([('title', 'content_id')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='h5p_contents_libraries',
+            index_together=set([('content_id', 'weight')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='h5p_libraries',
+            index_together=set([('machine_name', 'major_version', 'minor_version')]),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('h5pp', '0004_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='h5p_contents',
+            name='filtered_subcontents',
+            field=models.TextField(default='', help_text='Filtered subcontents with the hash of their parameters, reused when they do not change', blank=True),
+        ),
+    ]
@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('h5pp', '0005_h5p_contents_filtered_subcontents'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='h5p_jobs',
+            fields=[
+                ('job_id', models.AutoField(serialize=False, primary_key=True)),
+                ('type', models.CharField(help_text='Name of the job handler', max_length=63)),
+                ('content_id', models.PositiveIntegerField(help_text='Identifier of the content the job works on')),
+                ('created_at', models.IntegerField()),
+                ('started_at', models.IntegerField(help_text='Timestamp. Set when a worker takes the job, empty while it is pending', null=True, blank=True)),
+                ('attempts', models.PositiveSmallIntegerField(default=0)),
+                ('error', models.TextField(default='', help_text='Error of the last failed attempt', blank=True)),
+            ],
+            options={
+                'ordering': ['job_id'],
+                'db_table': 'h5p_jobs',
+                'verbose_name': 'Job',
+                'verbose_name_plural': 'Jobs',
+            },
+        ),
+        migrations.AlterIndexTogether(
+            name='h5p_jobs',
+            index_together=set([('type', 'content_id', 'started_at')]),
+        ),
+    ]
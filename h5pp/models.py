@@ -15,6 +15,7 @@ class h5p_contents_libraries(models.Model):
     class Meta:
         db_table = 'h5p_contents_libraries'
         unique_together = (('content_id', 'library_id', 'dependency_type'))
+        index_together = (('content_id', 'weight'))
 
 # Stores information about libraries
 
@@ -50,6 +51,7 @@ class h5p_libraries(models.Model):
     class Meta:
         db_table = 'h5p_libraries'
         ordering = ['machine_name', 'major_version', 'minor_version']
+        index_together = (('machine_name', 'major_version', 'minor_version'))
         verbose_name = 'Library'
         verbose_name_plural = 'Libraries'
 
@@ -72,6 +74,18 @@ class h5p_libraries_libraries(models.Model):
         db_table = 'h5p_libraries_libraries'
         unique_together = (('library_id', 'required_library_id'))
 
+# Stores which libraries are included in the aggregated assets files
+
+
+class h5p_libraries_cachedassets(models.Model):
+    library_id = models.PositiveIntegerField(null=False)
+    hash = models.CharField(null=False, max_length=64,
+        help_text='Hash of the dependencies set, name of the cached files')
+
+    class Meta:
+        db_table = 'h5p_libraries_cachedassets'
+        unique_together = (('library_id', 'hash'))
+
 # Stores translations for the languages
 
 
@@ -115,12 +129,17 @@ class h5p_contents(models.Model):
     meta_description = models.TextField(null=True, blank=True)
     filtered = models.TextField(null=False,
         help_text='Filtered version of json_contents')
-    slug = models.CharField(null=False, max_length=127,
+    filtered_subcontents = models.TextField(null=False, blank=True, default='',
+        help_text='Filtered subcontents with the hash of their parameters, reused when they do not change')
+    slug = models.CharField(null=False, max_length=127, db_index=True,
         help_text='Human readable content identifier that is unique')
+    render_bundle = models.TextField(null=False, blank=True, default='',
+        help_text='Precomputed settings and assets used to display the content')
 
     class Meta:
         db_table = 'h5p_contents'
         ordering = ['title', 'author', 'content_id']
+        index_together = (('title', 'content_id'))
         verbose_name = 'Content'
         verbose_name_plural = 'Contents'
 
@@ -174,6 +193,7 @@ class h5p_content_user_data(models.Model):
         db_table = 'h5p_content_user_data'
         unique_together = (('user_id', 'content_main_id',
                             'sub_content_id', 'data_id'))
+        index_together = (('user_id', 'content_main_id', 'preloaded'))
 
 # Keeps track of what happens in the H5p system
 
@@ -181,7 +201,7 @@ class h5p_content_user_data(models.Model):
 class h5p_events(models.Model):
     user_id = models.PositiveIntegerField(null=False,
         help_text='Identifier of the user who caused this event')
-    created_at = models.IntegerField(null=False)
+    created_at = models.IntegerField(null=False, db_index=True)
     type = models.CharField(null=False, max_length=63,
         help_text='Type of the event. If it concerns a library, a content or a user')
     sub_type = models.CharField(null=False, max_length=63,
@@ -201,6 +221,29 @@ class h5p_events(models.Model):
         verbose_name = 'Event'
         verbose_name_plural = 'Events'
 
+# Queue of the work done in background after a content is saved
+
+
+class h5p_jobs(models.Model):
+    job_id = models.AutoField(primary_key=True)
+    type = models.CharField(null=False, max_length=63,
+        help_text='Name of the job handler')
+    content_id = models.PositiveIntegerField(null=False,
+        help_text='Identifier of the content the job works on')
+    created_at = models.IntegerField(null=False)
+    started_at = models.IntegerField(null=True, blank=True,
+        help_text='Timestamp. Set when a worker takes the job, empty while it is pending')
+    attempts = models.PositiveSmallIntegerField(null=False, default=0)
+    error = models.TextField(null=False, blank=True, default='',
+        help_text='Error of the last failed attempt')
+
+    class Meta:
+        db_table = 'h5p_jobs'
+        ordering = ['job_id']
+        index_together = (('type', 'content_id', 'started_at'))
+        verbose_name = 'Job'
+        verbose_name_plural = 'Jobs'
+
 # Global counters for the H5P system
 
 
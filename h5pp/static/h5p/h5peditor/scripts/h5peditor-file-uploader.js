@@ -110,12 +110,116 @@ H5PEditor.FileUploader = (function ($, EventDispatcher) {
 
       // Trigger upload event and submit upload form
       self.trigger('upload');
-      $form.submit();
+      var file = ($file[0].files !== undefined ? $file[0].files[0] : undefined);
+      var chunkSize = H5PIntegration.editor.uploadChunkSize;
+      if (file !== undefined && chunkSize && file.size > chunkSize && window.FormData !== undefined) {
+        uploadChunks(file, chunkSize);
+      }
+      else {
+        $form.submit();
+      }
 
       // This iframe is used, we must add another for the next upload
       nextIframe = new Iframe();
     };
 
+    /**
+     * Upload a large file in parts. When a part fails, the upload resumes
+     * from the offset the server has received.
+     *
+     * @private
+     * @param {File} file
+     * @param {number} chunkSize
+     */
+    var uploadChunks = function (file, chunkSize) {
+      var uploadId;
+      var retries = 0;
+
+      var fail = function () {
+        $iframe.remove();
+        self.trigger('uploadComplete', {
+          error: H5PEditor.t('core', 'unknownFileUploadError'),
+          data: null
+        });
+      };
+
+      var retry = function (result) {
+        if (retries >= 5) {
+          return fail();
+        }
+        retries++;
+        if (result !== undefined && result.offset !== undefined) {
+          // Refused part, the server tells where to resume from
+          uploadId = result.uploadId;
+          return send(result.offset);
+        }
+        if (uploadId === undefined) {
+          return setTimeout(function () {
+            send(0);
+          }, 1000 * retries);
+        }
+        setTimeout(function () {
+          $.ajax({
+            url: H5PEditor.getAjaxUrl('files', {chunk: 1, uploadId: uploadId}),
+            dataType: 'json'
+          }).done(function (result) {
+            send(result.offset);
+          }).fail(function () {
+            retry();
+          });
+        }, 1000 * retries);
+      };
+
+      var send = function (offset) {
+        var data = new FormData();
+        data.append('file', file.slice(offset, offset + chunkSize), file.name);
+        data.append('field', $field.val());
+        data.append('contentId', H5PEditor.contentId ? H5PEditor.contentId : 0);
+        data.append('name', file.name);
+        data.append('type', file.type);
+        data.append('size', file.size);
+        data.append('offset', offset);
+        if (uploadId !== undefined) {
+          data.append('uploadId', uploadId);
+        }
+
+        $.ajax({
+          url: H5PEditor.getAjaxUrl('files', {chunk: 1}),
+          type: 'POST',
+          data: data,
+          processData: false,
+          contentType: false,
+          dataType: 'text'
+        }).done(function (response) {
+          var result;
+          try {
+            result = JSON.parse(response);
+          }
+          catch (err) {
+            // Reported by processResult
+          }
+          if (result !== undefined && result.uploadId !== undefined && result.offset !== undefined) {
+            // More parts to send
+            retries = 0;
+            uploadId = result.uploadId;
+            return send(result.offset);
+          }
+          processResult(response);
+        }).fail(function (xhr) {
+          var result;
+          try {
+            result = JSON.parse(xhr.responseText);
+          }
+          catch (err) {
+            // Connection lost
+          }
+          retry(result);
+        });
+      };
+
+      send(0);
+    };
+
     /**
      * Create and insert iframe into the DOM.
      *
@@ -195,8 +299,16 @@ H5PEditor.FileUploader = (function ($, EventDispatcher) {
     var processResponse = function () {
       // Upload complete, get response text
       var $body = $iframe.contents().find('body');
-      var response = $body.text();
+      processResult($body.text());
+    };
 
+    /**
+     * Process the server response of an upload.
+     *
+     * @private
+     * @param {string} response
+     */
+    var processResult = function (response) {
       // Clean up all our DOM elements
       $iframe.remove();
 
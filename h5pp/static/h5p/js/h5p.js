@@ -1655,18 +1655,83 @@ H5P.setFinished = function (contentId, score, maxScore, time) {
       return Math.round(date.getTime() / 1000);
     };
 
-    // Post the results
-    H5P.jQuery.post(H5PIntegration.ajax.setFinished, {
+    var result = {
       contentId: contentId,
       score: score,
       maxScore: maxScore,
       opened: toUnix(H5P.opened[contentId]),
       finished: toUnix(new Date()),
       time: time
-    });
+    };
+
+    if (H5PIntegration.ajax.batch !== undefined) {
+      result.type = 'finished';
+      H5P.queueBatchRecord(result);
+      return;
+    }
+
+    // Post the results
+    H5P.jQuery.post(H5PIntegration.ajax.setFinished, result);
   }
 };
 
+/**
+ * Records waiting to be sent to the batch endpoint.
+ *
+ * @type {Object[]}
+ */
+H5P.batchRecords = [];
+
+/**
+ * Queue a finished or state record. Queued records are sent together
+ * after H5PIntegration.ajax.batchInterval milliseconds. A newer record
+ * replaces the queued one for the same content (and data type for states).
+ *
+ * @param {Object} record
+ * @param {boolean} [sync=false] Send the queue right away and wait for it.
+ */
+H5P.queueBatchRecord = function (record, sync) {
+  H5P.batchRecords = H5P.batchRecords.filter(function (queued) {
+    return queued.type !== record.type || queued.contentId !== record.contentId ||
+      queued.subContentId !== record.subContentId || queued.dataType !== record.dataType;
+  });
+  H5P.batchRecords.push(record);
+
+  if (sync) {
+    H5P.sendBatchRecords(false);
+  }
+  else if (H5P.batchTimer === undefined) {
+    H5P.batchTimer = setTimeout(function () {
+      H5P.sendBatchRecords(true);
+    }, H5PIntegration.ajax.batchInterval);
+  }
+};
+
+/**
+ * Send the queued records in one request.
+ *
+ * @param {boolean} [async=true]
+ */
+H5P.sendBatchRecords = function (async) {
+  clearTimeout(H5P.batchTimer);
+  H5P.batchTimer = undefined;
+  if (!H5P.batchRecords.length) {
+    return;
+  }
+
+  var records = H5P.batchRecords;
+  H5P.batchRecords = [];
+  H5P.jQuery.ajax({
+    url: H5PIntegration.ajax.batch,
+    type: 'POST',
+    dataType: 'json',
+    async: async === undefined ? true : async,
+    data: {
+      records: JSON.stringify(records)
+    }
+  });
+};
+
 // Add indexOf to browsers that lack them. (IEs)
 if (!Array.prototype.indexOf) {
   Array.prototype.indexOf = function (needle) {
@@ -1801,6 +1866,21 @@ H5P.createTitle = function (rawTitle, maxLength) {
       dataType: 'json',
       async: async === undefined ? true : async
     };
+    if (data !== undefined && H5PIntegration.ajax.batch !== undefined) {
+      H5P.queueBatchRecord({
+        type: 'state',
+        contentId: contentId,
+        dataType: dataType,
+        subContentId: subContentId ? subContentId : 0,
+        data: (data === null ? 0 : data),
+        preload: (preload ? 1 : 0),
+        invalidate: (invalidate ? 1 : 0)
+      }, async === false);
+      if (done !== undefined) {
+        done();
+      }
+      return;
+    }
     if (data !== undefined) {
       options.type = 'POST';
       options.data = {
@@ -2043,6 +2123,13 @@ H5P.createTitle = function (rawTitle, maxLength) {
       // pagehide is used on iPad when tabs are switched
       H5P.$window.on('pagehide', storeCurrentState);
     }
+
+    if (H5PIntegration.ajax.batch !== undefined) {
+      // Send the queued results and states before leaving the page
+      H5P.$window.on('pagehide beforeunload unload', function () {
+        H5P.sendBatchRecords(false);
+      });
+    }
   });
 
 })(H5P.jQuery);
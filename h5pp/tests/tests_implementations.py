@@ -2,7 +2,10 @@ from django.test import TestCase
 from django.conf import settings
 from django.contrib.auth.models import User
 from h5pp.h5p.h5pmodule import *
+import h5pp.h5p.h5pmodule
 from h5pp.h5p.h5pclasses import H5PDjango
+from h5pp.h5p.h5pbuffer import H5PWriteBuffer
+from h5pp.h5p.h5pjobs import *
 from h5pp.h5p.library.h5pclasses import *
 from h5pp.h5p.editor.h5peditorclasses import H5PDjangoEditor
 import django
@@ -85,6 +88,129 @@ class H5pModuleTestCase(TestCase):
         self.assertTrue('user' in core)
         print('test_get_core_settings ---- Check')
 
+    def test_get_contents_scores(self):
+        user = User.objects.get(username='titi')
+        other = User.objects.create(username='toto')
+        h5p_points.objects.create(
+            content_id=1, uid=user.id, started=10, finished=20, points=3, max_points=5)
+        h5p_points.objects.create(
+            content_id=1, uid=other.id, started=10, finished=0)
+        h5p_points.objects.create(
+            content_id=2, uid=other.id, started=10, finished=15, points=1, max_points=1)
+
+        scores = getContentsScores([1, 2])
+        self.assertEqual(2, len(scores[1]))
+        self.assertEqual('titi', scores[1][0]['uid'])
+        self.assertTrue(scores[1][0]['has_finished'])
+        self.assertEqual('..', scores[1][1]['points'])
+        self.assertFalse(scores[1][1]['has_finished'])
+
+        scores = getContentsScores([1, 2], user, [2])
+        self.assertEqual(1, len(scores[1]))
+        self.assertEqual('toto', scores[2][0]['uid'])
+
+        summaries = getContentsScoreSummary([1, 2])
+        self.assertEqual({'users': 2, 'finished': 1}, summaries[1])
+        self.assertEqual({'users': 1, 'finished': 1}, summaries[2])
+
+        # Buffered started timestamps are counted
+        buffer = H5PWriteBuffer(saveStartedBatch, 3600)
+        buffer.put((2, other.id), 30)
+        buffer.put((2, user.id), 30)
+        with self.settings(H5P_STARTED_MAX_STALENESS=3600):
+            h5pp.h5p.h5pmodule.startedBuffer = buffer
+            try:
+                summaries = getContentsScoreSummary([1, 2])
+            finally:
+                h5pp.h5p.h5pmodule.startedBuffer = None
+        self.assertEqual({'users': 2, 'finished': 1}, summaries[1])
+        self.assertEqual({'users': 2, 'finished': 0}, summaries[2])
+        print('test_get_contents_scores ---- Check')
+
+    def test_export_score(self):
+        user = User.objects.get(username='titi')
+        h5p_contents.objects.create(
+            content_id=1, title='Test content', json_contents='{}', embed_type='div',
+            main_library_id=1, content_type='H5P.Test', author='titi')
+        h5p_points.objects.create(
+            content_id=1, uid=user.id, started=10, finished=20, points=3, max_points=5)
+
+        self.assertEqual([
+            '[Content] : Test content - [Users] : 1\n',
+            '[Username] : titi | [Current] : 3 | [Max] : 5 | [Progression] : Completed\n'
+        ], list(exportScore('1')))
+
+        lines = list(exportScore(None, 'csv'))
+        self.assertEqual(2, len(lines))
+        self.assertEqual('1,Test content,titi,3,5,10,20,1\r\n', lines[1])
+
+        lines = list(exportScore(None, 'jsonl'))
+        self.assertEqual('titi', json.loads(lines[0])['username'])
+        print('test_export_score ---- Check')
+
+    def test_save_batch(self):
+        user = User.objects.get(username='titi')
+        h5p_points.objects.create(content_id=1, uid=user.id, started=10)
+
+        saveFinishedBatch(user.id, collections.OrderedDict([
+            (1, {'points': 2, 'max_points': 4}),
+            (2, {'points': 1, 'max_points': 1})
+        ]))
+        self.assertEqual(2, h5p_points.objects.get(content_id=1, uid=user.id).points)
+        self.assertEqual(1, h5p_points.objects.get(content_id=2, uid=user.id).max_points)
+
+        saveUserDataBatch(user.id, {
+            (1, 0, 'state'): {'data': '{"a":1}', 'preload': 1, 'invalidate': 1}
+        })
+        saveUserDataBatch(user.id, {
+            (1, 0, 'state'): {'data': '{"a":2}', 'preload': 1, 'invalidate': 1},
+            (2, 0, 'state'): {'data': '{"b":1}', 'preload': 0, 'invalidate': 0}
+        })
+        self.assertEqual('{"a":2}', h5p_content_user_data.objects.get(
+            user_id=user.id, content_main_id=1).data)
+        self.assertEqual(0, h5p_content_user_data.objects.get(
+            user_id=user.id, content_main_id=2).preloaded)
+
+        saveUserDataBatch(user.id, {(2, 0, 'state'): {'data': '0'}})
+        self.assertFalse(h5p_content_user_data.objects.filter(
+            user_id=user.id, content_main_id=2).exists())
+        print('test_save_batch ---- Check')
+
+    def test_set_started(self):
+        user = User.objects.get(username='titi')
+        h5pSetStarted(user, 1)
+        h5p_points.objects.filter(content_id=1, uid=user.id).update(
+            started=5, finished=10, points=1)
+
+        h5pSetStarted(user, 1)
+        points = h5p_points.objects.get(content_id=1, uid=user.id)
+        self.assertTrue(points.started > 10)
+        self.assertEqual(10, points.finished)
+        self.assertEqual(1, points.points)
+        self.assertEqual(1, h5p_points.objects.count())
+        print('test_set_started ---- Check')
+
+    def test_started_buffer(self):
+        user = User.objects.get(username='titi')
+        h5p_points.objects.create(content_id=1, uid=user.id, started=5, finished=10)
+
+        buffer = H5PWriteBuffer(saveStartedBatch, 3600)
+        buffer.put((1, user.id), 20)
+        buffer.put((2, user.id), 30)
+        self.assertEqual(20, buffer.get((1, user.id)))
+        self.assertEqual(5, h5p_points.objects.get(content_id=1, uid=user.id).started)
+
+        buffer.flush([(2, user.id)])
+        self.assertEqual(30, h5p_points.objects.get(content_id=2, uid=user.id).started)
+        self.assertEqual(None, buffer.get((2, user.id)))
+
+        buffer.flush()
+        points = h5p_points.objects.get(content_id=1, uid=user.id)
+        self.assertEqual(20, points.started)
+        self.assertEqual(10, points.finished)
+        self.assertEqual(0, len(buffer.items()))
+        print('test_started_buffer ---- Check')
+
     ##
     # TODO
     # Place request-based test
@@ -171,6 +297,20 @@ class H5PClassesTestCase(TestCase):
         self.assertTrue(interface.getLibraryId('H5P.Test') == None)
         print('test_get_library_id ---- Check')
 
+    def test_parameterised_queries(self):
+        user = User.objects.get(username='titi')
+        interface = H5PDjango(user)
+        h5p_libraries_languages.objects.create(
+            library_id=1, language_code='fr', language_json='{"fr":1}')
+
+        self.assertEqual('{"fr":1}', interface.h5pGetInstance(
+            'editor').storage.getLanguage('H5P.Test', 1, 1, 'fr'))
+        self.assertFalse(interface.h5pGetInstance('editor').storage.getLanguage(
+            "H5P.Test' OR '1'='1", 1, 1, 'fr'))
+        self.assertEqual(dict(), interface.loadContentDependencies(
+            1, "preloaded' OR '1'='1"))
+        print('test_parameterised_queries ---- Check')
+
     def test_is_patched_library(self):
         user = User.objects.get(username='titi')
         interface = H5PDjango(user)
@@ -377,6 +517,76 @@ class H5PClassesTestCase(TestCase):
 
         self.assertTrue(len(result) > 0)
         print('test_load_all_contents ---- Check')
+
+    def test_clear_filtered_parameters(self):
+        user = User.objects.get(username='titi')
+        interface = H5PDjango(user)
+        h5p_contents.objects.create(
+            content_id=1,
+            title='ContentTest',
+            json_contents='{}',
+            main_library_id=1,
+            filtered='{}',
+            render_bundle='{}',
+            slug='contenttest'
+        )
+        h5p_contents_libraries.objects.create(
+            content_id=1,
+            library_id=1,
+            dependency_type='preloaded'
+        )
+
+        interface.clearFilteredParameters(1)
+        result = h5p_contents.objects.filter(content_id=1).values()[0]
+
+        self.assertEqual('', result['filtered'])
+        self.assertEqual('', result['render_bundle'])
+        self.assertTrue(h5p_jobs.objects.filter(type='filter', content_id=1).exists())
+        print('test_clear_filtered_parameters ---- Check')
+
+    def test_jobs(self):
+        handled = list()
+
+        def failing(contentId):
+            raise Exception('Failure')
+
+        registerJobHandler('test', handled.append)
+        registerJobHandler('failing', failing)
+        enqueueJob('test', 1)
+        enqueueJobs('test', [1, 2])
+        enqueueJob('failing', 3)
+        self.assertEqual(3, h5p_jobs.objects.count())
+
+        self.assertEqual(3, runPendingJobs())
+        self.assertEqual([1, 2], sorted(handled))
+
+        # The failed job stays with its error until its last attempt
+        job = h5p_jobs.objects.get()
+        self.assertEqual('failing', job.type)
+        self.assertEqual(1, job.attempts)
+        self.assertTrue('Failure' in job.error)
+        self.assertEqual(None, claimJob())
+        self.assertEqual(job.job_id, claimJob(-1).job_id)
+
+        # Given up after its last attempt
+        self.assertEqual(0, pruneFailedJobs())
+        h5p_jobs.objects.filter(job_id=job.job_id).update(attempts=3, started_at=1)
+        self.assertEqual(1, pruneFailedJobs())
+        self.assertEqual(0, h5p_jobs.objects.count())
+        print('test_jobs ---- Check')
+
+    def test_jobs_after_request(self):
+        handled = list()
+        registerJobHandler('test', handled.append)
+        with self.settings(H5P_JOBS_THREADS=0, H5P_JOBS_WORKER=False):
+            enqueueJob('test', 5)
+        self.assertEqual([], handled)
+
+        # Run once the response is sent
+        runJobsAfterRequest()
+        self.assertEqual([5], handled)
+        self.assertEqual(0, h5p_jobs.objects.count())
+        print('test_jobs_after_request ---- Check')
     ##
     # TODO
     # Place libraries dependencies test
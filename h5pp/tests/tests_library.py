@@ -1,10 +1,24 @@
 from django.test import TestCase
 from django.conf import settings
 from django.contrib.auth.models import User
+from django.core.files.uploadedfile import SimpleUploadedFile
 from h5pp.h5p.h5pclasses import H5PDjango
+from h5pp.h5p.h5pcache import H5PLibraryCache, H5PExportCache
+from h5pp.h5p.h5pupload import H5PUploadSession, H5PChunkedUpload, cleanupStagingFolders
+from h5pp.h5p.library.h5pclasses import H5PContentValidator, H5PExport
 from h5pp.h5p.library.h5pdefaultstorage import H5PDefaultStorage
+from h5pp.h5p.library.h5ppackage import H5PPackage
+from h5pp.h5p.library.h5pxss import H5PXssFilter
+from h5pp.h5p.library.h5pmediaprobe import probeMedia
+from h5pp.h5p.library.h5pimages import H5PImageDerivatives, Image
 from h5pp.h5p.editor.library.h5peditorstorage import H5PEditorStorage
 from h5pp.models import *
+import tempfile
+import hashlib
+import StringIO
+import struct
+import zipfile
+import json
 import shutil
 import os
 
@@ -108,6 +122,249 @@ class CoreTestCase(TestCase):
 		self.assertEqual(1, result['library_id'])
 		print('test_load_library ---- Check')
 
+	def test_library_cache(self):
+		user = User.objects.get(username='titi')
+		interface = H5PDjango(user)
+		core = interface.h5pGetInstance('core')
+		core.libraryCache = H5PLibraryCache()
+
+		result = core.loadLibrary('H5P.Test', 1, 1)
+		result['title'] = 'Altered'
+		h5p_libraries.objects.filter(library_id=1).update(title='Test2')
+
+		# Served from cache and not altered by the caller
+		self.assertEqual('Test', core.loadLibrary('H5P.Test', 1, 1)['title'])
+
+		core.libraryCache.invalidate()
+		self.assertEqual('Test2', core.loadLibrary('H5P.Test', 1, 1)['title'])
+		print('test_library_cache ---- Check')
+
+	def test_dependency_graph(self):
+		user = User.objects.get(username='titi')
+		interface = H5PDjango(user)
+		core = interface.h5pGetInstance('core')
+		for libraryId, name in [(2, 'H5P.Dep'), (3, 'H5PEditor.Test'), (4, 'H5P.Main')]:
+			h5p_libraries.objects.create(library_id=libraryId, machine_name=name, title=name, major_version=1,
+				minor_version=0, patch_version=0, runnable=0, fullscreen=0, embed_types='', preloaded_js='',
+				preloaded_css='', drop_library_css=None, semantics='', restricted=0, tutorial_url='')
+		for libraryId, requiredLibraryId, dependencyType in [(4, 1, 'preloaded'), (4, 3, 'editor'),
+				(1, 2, 'preloaded'), (3, 2, 'preloaded')]:
+			h5p_libraries_libraries.objects.create(library_id=libraryId, required_library_id=requiredLibraryId,
+				dependency_type="'" + dependencyType + "'")
+
+		def findDependencies():
+			dependencies = dict()
+			weight = core.findLibraryDependencies(dependencies, core.loadLibrary('H5P.Main', 1, 0))
+			return weight, dict((key, (dependency['type'], dependency['weight'], dependency['library']['library_id']))
+				for key, dependency in dependencies.iteritems())
+
+		core.libraryCache = None
+		expected = findDependencies()
+		self.assertEqual((4, {'preloaded-H5P.Dep': ('preloaded', 1, 2), 'preloaded-H5P.Test': ('preloaded', 2, 1),
+			'editor-H5P.Dep': ('editor', 3, 2), 'editor-H5PEditor.Test': ('editor', 4, 3)}), expected)
+
+		core.libraryCache = H5PLibraryCache()
+		self.assertEqual(expected, findDependencies())
+		# Resolved in memory once the graph and the library are cached
+		with self.assertNumQueries(0):
+			self.assertEqual(expected, findDependencies())
+
+		h5p_libraries_libraries.objects.filter(library_id=3).delete()
+		core.libraryCache.invalidate()
+		self.assertFalse('editor-H5P.Dep' in findDependencies()[1])
+		print('test_dependency_graph ---- Check')
+
+	def test_export_cache(self):
+		path = tempfile.mkdtemp()
+		cache = H5PExportCache(path, 10)
+		generated = list()
+
+		def generate(data):
+			generated.append(data)
+			return iter([data[0:3], data[3:]])
+
+		self.assertEqual('abcdef', ''.join(cache.stream('a', lambda: generate('abcdef'))))
+		self.assertEqual('abcdef', ''.join(cache.stream('a', lambda: generate('abcdef'))))
+		self.assertEqual(['abcdef'], generated)
+
+		# The least recently used package is removed when the cache is full
+		os.utime(os.path.join(path, 'a.h5p'), (1, 1))
+		self.assertEqual('ghijkl', ''.join(cache.stream('b', lambda: generate('ghijkl'))))
+		self.assertEqual(['b.h5p'], os.listdir(path))
+
+		shutil.rmtree(path, ignore_errors=True)
+		print('test_export_cache ---- Check')
+
+	def test_save_libraries(self):
+		user = User.objects.get(username='titi')
+		interface = H5PDjango(user)
+		core = interface.h5pGetInstance('core')
+		path = tempfile.mkdtemp()
+		core.fs = H5PDefaultStorage(path)
+
+		packagePath = os.path.join(path, 'test.h5p')
+		package = zipfile.ZipFile(packagePath, 'w')
+		libraries = dict()
+		for name, version, dependencies in [('H5P.Test', (1, 1, 2), []), ('H5P.Dep', (1, 0, 0), []),
+				('H5P.Main', (1, 0, 0), [{'machineName': 'H5P.Dep', 'majorVersion': 1, 'minorVersion': 0},
+				{'machineName': 'H5P.Test', 'majorVersion': 1, 'minorVersion': 1}])]:
+			folder = '%s-%d.%d' % (name, version[0], version[1])
+			package.writestr(folder + '/scripts/test.js', 'var test;')
+			libraries['%s %d.%d' % (name, version[0], version[1])] = {
+				'machineName': name, 'title': name, 'majorVersion': version[0], 'minorVersion': version[1],
+				'patchVersion': version[2], 'runnable': 1, 'packageFolder': folder,
+				'preloadedDependencies': dependencies, 'language': {'fr': '{}'}}
+		package.close()
+		core.package = H5PPackage(packagePath)
+		core.librariesJsonData = libraries
+
+		interface.h5pGetInstance('storage').saveLibraries()
+
+		# The installed library is neither saved again nor extracted
+		self.assertEqual(3, h5p_libraries.objects.count())
+		self.assertFalse(os.path.exists(os.path.join(path, 'libraries', 'H5P.Test-1.1')))
+		self.assertTrue(os.path.exists(os.path.join(path, 'libraries', 'H5P.Main-1.0', 'scripts', 'test.js')))
+		self.assertTrue(os.path.exists(os.path.join(path, 'libraries', 'H5P.Dep-1.0', 'scripts', 'test.js')))
+		mainId = libraries['H5P.Main 1.0']['libraryId']
+		self.assertEqual(set([libraries['H5P.Dep 1.0']['libraryId'], 1]), set(h5p_libraries_libraries.objects.filter(
+			library_id=mainId).values_list('required_library_id', flat=True)))
+		self.assertEqual(2, h5p_libraries_languages.objects.count())
+		core.package.delete()
+
+		# Nothing is installed when the meta data is rolled back
+		package = zipfile.ZipFile(packagePath, 'w')
+		package.writestr('H5P.Broken-1.0/scripts/test.js', 'var test;')
+		package.close()
+		core.package = H5PPackage(packagePath)
+		core.librariesJsonData = {'H5P.Broken 1.0': {
+			'machineName': 'H5P.Broken', 'title': 'H5P.Broken', 'majorVersion': 1, 'minorVersion': 0,
+			'patchVersion': 0, 'runnable': 1, 'packageFolder': 'H5P.Broken-1.0',
+			'preloadedDependencies': [{'machineName': 'H5P.Missing', 'majorVersion': 1, 'minorVersion': 0}]}}
+		self.assertRaises(KeyError, interface.h5pGetInstance('storage').saveLibraries)
+		self.assertEqual(3, h5p_libraries.objects.count())
+		self.assertEqual(['H5P.Dep-1.0', 'H5P.Main-1.0'], sorted(os.listdir(os.path.join(path, 'libraries'))))
+
+		core.package.delete()
+		shutil.rmtree(path, ignore_errors=True)
+		print('test_save_libraries ---- Check')
+
+	def test_content_validator(self):
+		user = User.objects.get(username='titi')
+		interface = H5PDjango(user)
+		core = interface.h5pGetInstance('core')
+		core.libraryCache = H5PLibraryCache()
+		h5p_libraries.objects.filter(library_id=1).update(semantics=json.dumps([
+			{'name': 'title', 'type': 'text'},
+			{'name': 'score', 'type': 'number', 'min': 0, 'max': 10},
+			{'name': 'answers', 'type': 'list', 'field': {'name': 'answer', 'type': 'boolean'}}
+		]))
+
+		params = {
+			'library': 'H5P.Test 1.1',
+			'params': {'title': '<b>Title</b>', 'score': 42, 'answers': [True, 'no'], 'unknown': 1}
+		}
+		validator = H5PContentValidator(interface, core)
+		validator.validateLibrary(params, {'options': params['library']})
+
+		self.assertEqual({'title': '&lt;b&gt;Title&lt;/b&gt;', 'score': 10, 'answers': [True, False]}, params['params'])
+		self.assertTrue('preloaded-H5P.Test' in validator.getDependencies())
+		# The compiled semantics are shared by the next validators
+		self.assertTrue('H5P.Test 1.1' in H5PContentValidator.compiledLibraries)
+		print('test_content_validator ---- Check')
+
+	def test_incremental_filter(self):
+		user = User.objects.get(username='titi')
+		interface = H5PDjango(user)
+		core = interface.h5pGetInstance('core')
+		h5p_libraries.objects.filter(library_id=1).update(semantics=json.dumps([
+			{'name': 'title', 'type': 'text'},
+			{'name': 'items', 'type': 'list', 'field': {'name': 'item', 'type': 'library', 'options': ['H5P.Test 1.1']}}
+		]))
+		subContentId = 'a1b2c3d4-0000-4000-8000-000000000001'
+
+		def filterContent(title, cache):
+			params = {
+				'library': 'H5P.Test 1.1',
+				'params': {'title': 'Root', 'items': [
+					{'library': 'H5P.Test 1.1', 'subContentId': subContentId, 'params': {'title': title}}
+				]}
+			}
+			validator = H5PContentValidator(interface, core)
+			validator.cachedSubContents = cache
+			validator.validateLibrary(params, {'options': params['library']})
+			return params['params']['items'][0]['params']['title'], json.loads(json.dumps(validator.filteredSubContents))
+
+		title, cache = filterContent('<b>A</b>', dict())
+		self.assertEqual('&lt;b&gt;A&lt;/b&gt;', title)
+		self.assertEqual(['H5P.Test 1.1'], cache[subContentId]['libraries'])
+
+		# Unchanged subcontents are taken from the cache
+		cache[subContentId]['value']['params']['title'] = 'cached'
+		title, cache = filterContent('<b>A</b>', cache)
+		self.assertEqual('cached', title)
+
+		# Changed ones are validated again
+		title, cache = filterContent('<b>B</b>', cache)
+		self.assertEqual('&lt;b&gt;B&lt;/b&gt;', title)
+		print('test_incremental_filter ---- Check')
+
+	def test_stale_filter(self):
+		user = User.objects.get(username='titi')
+		interface = H5PDjango(user)
+		core = interface.h5pGetInstance('core')
+		core.exportEnabled = False
+		h5p_libraries.objects.filter(library_id=1).update(semantics=json.dumps([{'name': 'title', 'type': 'text'}]))
+		contentId = interface.insertContent({'title': 'ContentTest', 'params': '{"title": "A"}', 'disable': 0, 'author': 'titi',
+			'library': {'libraryId': 1, 'machineName': 'H5P.Test', 'majorVersion': 1, 'minorVersion': 1}})
+
+		def loadContent():
+			content = core.loadContent(contentId)
+			content['id'] = str(contentId)
+			content['embedType'] = content['embed_type']
+			return content
+
+		# Saved again while the old parameters were filtered
+		content = loadContent()
+		h5p_contents.objects.filter(content_id=contentId).update(json_contents='{"title": "B"}')
+		core.filterParameters(content)
+		self.assertEqual('', h5p_contents.objects.get(content_id=contentId).filtered)
+
+		core.filterParameters(loadContent())
+		self.assertEqual({'title': 'B'}, json.loads(h5p_contents.objects.get(content_id=contentId).filtered))
+		print('test_stale_filter ---- Check')
+
+	def test_filter_xss(self):
+		htmlFilter = H5PXssFilter(['p', 'a', 'strong'], ['(?i)^text-align: *(center|left|right);?$'], ['p'])
+
+		self.assertEqual('<p>Hello alert(1)</p>', htmlFilter.filter('<p>Hello <script>alert(1)</script></p>'))
+		self.assertEqual('<a href="http://h5p.org">link</a>', htmlFilter.filter('<a href="http://h5p.org" onclick="evil()">link</a>'))
+		self.assertEqual('<a href="alert(1)">x</a>', htmlFilter.filter('<a href="java&#115;cript:alert(1)">x</a>'))
+		self.assertEqual('Tom &amp; Jerry &eacute; &lt;3', htmlFilter.filter('Tom & Jerry &eacute; <3'))
+		self.assertEqual('<p style="text-align: center">x</p>', htmlFilter.filter('<p style="text-align: center; position: fixed">x</p>'))
+		self.assertEqual('<strong>x</strong>', htmlFilter.filter('<strong style="text-align: center">x</strong>'))
+		print('test_filter_xss ---- Check')
+
+	def test_probe_media(self):
+		def box(typ, data):
+			return struct.pack('>I4s', 8 + len(data), typ) + data
+
+		png = '\x89PNG\r\n\x1a\n' + struct.pack('>I4sII', 13, 'IHDR', 640, 480) + '\x08\x02\0\0\0'
+		self.assertEqual({'format': 'png', 'width': 640, 'height': 480}, probeMedia(StringIO.StringIO(png)))
+		jpeg = '\xff\xd8\xff\xe0' + struct.pack('>H', 16) + '\0' * 14 + '\xff\xc0' + struct.pack('>HBHH', 17, 8, 300, 400) + '\0' * 12
+		self.assertEqual({'format': 'jpeg', 'width': 400, 'height': 300}, probeMedia(StringIO.StringIO(jpeg)))
+
+		# The index of the video is found after the media data without reading it
+		stsd = box('stsd', struct.pack('>II', 0, 1) + box('avc1', '\0' * 78 + box('avcC', '\x01\x64\x00\x1f')))
+		trak = box('trak', box('tkhd', '\0' * 76 + struct.pack('>II', 1280 << 16, 720 << 16)) +
+			box('mdia', box('minf', box('stbl', stsd))))
+		moov = box('moov', box('mvhd', '\0' * 12 + struct.pack('>II', 1000, 93500) + '\0' * 80) + trak)
+		mp4 = box('ftyp', 'isom\0\0\0\0') + box('mdat', '\0' * 100000) + moov
+		self.assertEqual({'format': 'mp4', 'width': 1280, 'height': 720, 'duration': 93.5, 'codecs': 'avc1.64001F'},
+			probeMedia(StringIO.StringIO(mp4)))
+
+		self.assertEqual(None, probeMedia(StringIO.StringIO('<?php echo "not an image";')))
+		print('test_probe_media ---- Check')
+
 class StorageTestCase(TestCase):
 
 	def setUp(self):
@@ -168,6 +425,229 @@ class StorageTestCase(TestCase):
 		shutil.rmtree('/home/pod/H5PP/media/content/1', ignore_errors=True)
 		print('test_save_content ---- Check')
 
+	def test_cache_assets(self):
+		path = tempfile.mkdtemp()
+		storage = H5PDefaultStorage(path)
+		os.makedirs(os.path.join(path, 'libraries', 'H5P.Test-1.1', 'styles'))
+		with open(os.path.join(path, 'libraries', 'H5P.Test-1.1', 'styles', 'test.css'), 'w') as f:
+			f.write('a { background: url("../images/a.png"); } b { background: url(data:image/png;base64,AA); }')
+		files = {
+			'scripts': [],
+			'styles': [{'path': '/libraries/H5P.Test-1.1/styles/test.css', 'version': '?ver=1.1.2'}]
+		}
+
+		storage.cacheAssets(files, 'testhash')
+		cssPath = path + files['styles'][0]['path']
+		with open(cssPath) as f:
+			css = f.read()
+
+		self.assertTrue(files['styles'][0]['path'].startswith('/cachedassets/testhash-'))
+		self.assertTrue(os.path.exists(cssPath + '.gz'))
+		self.assertTrue('url("../libraries/H5P.Test-1.1/styles/../images/a.png")' in css)
+		self.assertTrue('url(data:image/png;base64,AA)' in css)
+		self.assertEqual(files['styles'], storage.getCachedAssets('testhash')['styles'])
+		self.assertEqual(None, storage.getCachedAssets('otherhash'))
+
+		storage.deleteCachedAssets(['testhash'])
+		self.assertFalse(os.path.exists(cssPath))
+		self.assertFalse(os.path.exists(cssPath + '.gz'))
+
+		shutil.rmtree(path, ignore_errors=True)
+		print('test_cache_assets ---- Check')
+
+	def test_create_export_file(self):
+		path = tempfile.mkdtemp()
+		interface = H5PDjango(User.objects.get(username='titi'))
+		core = interface.h5pGetInstance('core')
+		core.fs = H5PDefaultStorage(path)
+		os.makedirs(os.path.join(path, 'content', '1', 'images'))
+		os.makedirs(os.path.join(path, 'libraries', 'H5P.Test-1.1', 'scripts'))
+		with open(os.path.join(path, 'content', '1', 'content.json'), 'w') as f:
+			f.write('{"old": true}')
+		with open(os.path.join(path, 'content', '1', 'images', 'a.png'), 'w') as f:
+			f.write('png')
+		with open(os.path.join(path, 'libraries', 'H5P.Test-1.1', 'scripts', 'test.js'), 'w') as f:
+			f.write('var test;')
+		content = {
+			'id': '1',
+			'slug': 'contenttest',
+			'title': 'ContentTest',
+			'embedType': 'div',
+			'params': u'{"new": true}',
+			'library': {'name': 'H5P.Test'},
+			'dependencies': {'preloaded-H5P.Test': {
+				'type': 'preloaded',
+				'library': h5p_libraries.objects.filter(library_id=1).values()[0]
+			}}
+		}
+
+		self.assertTrue(H5PExport(interface, core).createExportFile(content))
+		self.assertEqual(['contenttest-1.h5p'], os.listdir(os.path.join(path, 'exports')))
+		package = zipfile.ZipFile(os.path.join(path, 'exports', 'contenttest-1.h5p'))
+		self.assertEqual('{"new": true}', package.read('content/content.json'))
+		self.assertEqual('H5P.Test', json.loads(package.read('h5p.json'))['preloadedDependencies'][0]['machineName'])
+		self.assertEqual(zipfile.ZIP_STORED, package.getinfo('content/images/a.png').compress_type)
+		self.assertEqual(zipfile.ZIP_DEFLATED, package.getinfo('H5P.Test-1.1/scripts/test.js').compress_type)
+
+		# The streamed package holds the same files
+		streamed = zipfile.ZipFile(StringIO.StringIO(''.join(H5PExport(interface, core).streamExportFile(content))))
+		self.assertEqual(None, streamed.testzip())
+		self.assertEqual(package.namelist(), streamed.namelist())
+		self.assertEqual('var test;', streamed.read('H5P.Test-1.1/scripts/test.js'))
+
+		shutil.rmtree(path, ignore_errors=True)
+		print('test_create_export_file ---- Check')
+
+	def test_save_from_package(self):
+		path = tempfile.mkdtemp()
+		storage = H5PDefaultStorage(path)
+		packagePath = os.path.join(path, 'test.h5p')
+		package = zipfile.ZipFile(packagePath, 'w')
+		package.writestr('h5p.json', '{}')
+		package.writestr('content/content.json', '{"test": 1}')
+		package.writestr('content/images/a.png', 'png')
+		package.writestr('H5P.Test-1.1/library.json', '{"machineName": "H5P.Test"}')
+		package.writestr('H5P.Test-1.1/scripts/test.js', 'var test;')
+		package.close()
+
+		package = H5PPackage(packagePath)
+		self.assertEqual(['h5p.json'], package.getRootFiles())
+		self.assertEqual(['H5P.Test-1.1', 'content'], sorted(package.getFolders()))
+		self.assertEqual('H5P.Test', package.getJsonData('H5P.Test-1.1/library.json')['machineName'])
+		self.assertFalse(package.getJsonData('H5P.Test-1.1/missing.json'))
+
+		storage.saveContent('content', 1, package)
+		storage.saveLibrary({'machineName': 'H5P.Test', 'majorVersion': 1, 'minorVersion': 1, 'packageFolder': 'H5P.Test-1.1'}, package)
+		self.assertTrue(os.path.exists(os.path.join(path, 'content', '1', 'images', 'a.png')))
+		self.assertTrue(os.path.exists(os.path.join(path, 'libraries', 'H5P.Test-1.1', 'scripts', 'test.js')))
+
+		package.delete()
+		self.assertFalse(os.path.exists(packagePath))
+
+		# Files which would be extracted outside of their folder are refused
+		package = zipfile.ZipFile(packagePath, 'w')
+		package.writestr('content/../../evil.js', 'evil')
+		package.close()
+		self.assertRaises(ValueError, H5PPackage, packagePath)
+
+		shutil.rmtree(path, ignore_errors=True)
+		print('test_save_from_package ---- Check')
+
+	def test_upload_session(self):
+		path = tempfile.mkdtemp()
+		first = H5PUploadSession(path)
+		second = H5PUploadSession(path)
+		self.assertNotEqual(first.folderPath, second.folderPath)
+
+		# Both requests upload a file with the same name
+		first.saveUploadedFile(SimpleUploadedFile('test.h5p', 'first'), 'test.h5p')
+		second.saveUploadedFile(SimpleUploadedFile('test.h5p', 'second'), '../../test.h5p')
+		self.assertEqual(os.path.join(second.folderPath, 'test.h5p'), second.path)
+		with open(first.path) as f:
+			self.assertEqual('first', f.read())
+
+		first.cleanup()
+		self.assertFalse(os.path.exists(first.folderPath))
+
+		# Staging folders left by interrupted requests are removed
+		os.utime(second.folderPath, (1, 1))
+		self.assertEqual(1, cleanupStagingFolders(path))
+		self.assertEqual([], os.listdir(path))
+
+		shutil.rmtree(path, ignore_errors=True)
+		print('test_upload_session ---- Check')
+
+	def test_chunked_upload(self):
+		path = tempfile.mkdtemp()
+		upload = H5PChunkedUpload(User(pk=1), None, path, 6)
+		upload.chunkSize = 4
+		self.assertEqual(4, upload.appendPart(['ab', 'cd'], 0, hashlib.sha256('abcd').hexdigest()))
+
+		# Refused parts are not kept, the client resumes from the offset
+		self.assertRaises(ValueError, upload.appendPart, ['ef'], 2)
+		self.assertRaises(ValueError, upload.appendPart, ['efghi'], 4)
+		self.assertRaises(ValueError, upload.appendPart, ['ef'], 4, hashlib.sha256('xx').hexdigest())
+		self.assertEqual(4, upload.getOffset())
+
+		resumed = H5PChunkedUpload(User(pk=1), upload.uploadId, path)
+		self.assertRaises(ValueError, resumed.appendPart, ['efg'], 4)
+		self.assertEqual(6, resumed.appendPart(['ef'], 4))
+		self.assertTrue(resumed.isComplete())
+		self.assertRaises(ValueError, resumed.appendPart, ['g'], 6)
+		self.assertRaises(ValueError, H5PChunkedUpload, User(pk=2), upload.uploadId, path)
+		self.assertRaises(ValueError, H5PChunkedUpload, User(pk=1), '../' + upload.uploadId, path)
+
+		# Only logged in users start uploads, of at most H5P_UPLOAD_MAX_SIZE bytes
+		self.assertRaises(ValueError, H5PChunkedUpload, User(), None, path, 6)
+		with self.settings(H5P_UPLOAD_MAX_SIZE=5):
+			self.assertRaises(ValueError, H5PChunkedUpload, User(pk=1), None, path, 6)
+
+		# The assembled file is moved to the media store
+		storage = H5PDefaultStorage(path)
+		destination = os.path.join(path, 'editor', 'videos', 'a.mp4')
+		storage.blobs.saveFilePath(resumed.getFile('a.mp4').temporary_file_path(), destination)
+		with open(destination) as f:
+			self.assertEqual('abcdef', f.read())
+		resumed.cleanup()
+
+		shutil.rmtree(path, ignore_errors=True)
+		print('test_chunked_upload ---- Check')
+
+	def test_blob_store(self):
+		path = tempfile.mkdtemp()
+		storage = H5PDefaultStorage(path)
+		first = os.path.join(path, 'content', '1', 'videos', 'a.mp4')
+		second = os.path.join(path, 'content', '2', 'videos', 'b.mp4')
+		storage.blobs.saveFile(['video', 'data'], first)
+		storage.blobs.saveFile(['videodata'], second)
+
+		# Identical files share their bytes
+		self.assertEqual(os.stat(first).st_ino, os.stat(second).st_ino)
+		storage.cloneContent('2', '3')
+		self.assertEqual(os.stat(first).st_ino, os.stat(os.path.join(path, 'content', '3', 'videos', 'b.mp4')).st_ino)
+		self.assertEqual((0, 0), storage.blobs.collectGarbage(0))
+
+		# The blob is removed once no content uses it
+		for pid in ['1', '2', '3']:
+			storage.deleteContent(pid)
+		self.assertEqual((1, 9), storage.blobs.collectGarbage(0))
+
+		shutil.rmtree(path, ignore_errors=True)
+		print('test_blob_store ---- Check')
+
+	def test_image_variants(self):
+		path = tempfile.mkdtemp()
+		storage = H5PDefaultStorage(path)
+		derivatives = H5PImageDerivatives(storage, [320, 640])
+		params = {'background': {'path': 'images/slide.png', 'mime': 'image/png', 'width': 1000},
+			'slides': [{'image': {'path': 'https://example.com/a.jpg', 'mime': 'image/jpeg'}},
+				{'image': {'path': '../../1/images/a.png', 'mime': 'image/png'}},
+				{'video': {'path': 'videos/a.mp4', 'mime': 'video/mp4'}}]}
+		self.assertEqual(['images/slide.png'], derivatives.findImages(params))
+
+		if derivatives.isEnabled():
+			for pid in ['1', '2']:
+				os.makedirs(os.path.join(path, 'content', pid, 'images'))
+				Image.new('RGB', (1000, 500)).save(os.path.join(path, 'content', pid, 'images', 'slide.png'))
+			self.assertTrue(derivatives.update('1', params))
+			self.assertFalse(derivatives.update('1', params))
+			derivatives.update('2', params)
+
+			variants = storage.getImageVariants('1')['images/slide.png']['variants']
+			self.assertEqual([320, 640], [variant['width'] for variant in variants if variant['mime'] == 'image/png'])
+			small = os.path.join(path, 'content', '1', 'images', 'slide.png-320w.png')
+			self.assertEqual((320, 160), Image.open(small).size)
+			# Rendered once for both contents
+			self.assertEqual(os.stat(small).st_ino, os.stat(os.path.join(path, 'content', '2', 'images', 'slide.png-320w.png')).st_ino)
+
+			# The variants of the images which are not used anymore are removed
+			self.assertTrue(derivatives.update('1', {}))
+			self.assertFalse(os.path.exists(small))
+			self.assertEqual(dict(), storage.getImageVariants('1'))
+
+		shutil.rmtree(path, ignore_errors=True)
+		print('test_image_variants ---- Check')
+
 class EditorStorageTestCase(TestCase):
 
 	def setUp(self):
@@ -1,3 +1,4 @@
+from django.conf import settings
 from django.conf.urls import url
 from django.contrib.auth.views import login, logout
 
@@ -28,4 +29,9 @@ urlpatterns = [
     # Ajax
     url(r'^ajax/$', 'h5pp.views.ajax', name='h5pajax'),
     url(r'^editorajax/(?P<contentId>\d+)/$', 'h5pp.views.editorAjax', name='h5peditorAjax'),
-]
\ No newline at end of file
+]
+
+# Download of the h5p package, generated when it is requested
+if getattr(settings, 'H5P_EXPORT', False) and getattr(settings, 'H5P_EXPORT_ON_DEMAND', False):
+    urlpatterns.append(
+        url(r'^export/(?P<contentId>\d+)/$', 'h5pp.views.exportView', name='h5pexport'))
\ No newline at end of file
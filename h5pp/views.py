@@ -1,7 +1,6 @@
 from django.conf import settings
-from django.core.files.base import ContentFile
 from django.shortcuts import render
-from django.http import HttpResponse, HttpResponseRedirect, HttpResponseForbidden, Http404
+from django.http import HttpResponse, StreamingHttpResponse, HttpResponseRedirect, HttpResponseForbidden, HttpResponseBadRequest, Http404
 from django.views.decorators.csrf import csrf_exempt
 from django.contrib.auth.models import User
 from h5pp.forms import LibrariesForm, CreateForm
@@ -11,6 +10,14 @@ from h5pp.h5p.h5pclasses import H5PDjango
 from h5pp.h5p.editor.h5peditormodule import h5peditorContent, handleContentUserData
 from h5pp.h5p.editor.h5peditorclasses import H5PDjangoEditor
 from h5pp.h5p.editor.library.h5peditorfile import H5PEditorFile
+from h5pp.h5p.h5pupload import H5PChunkedUpload
+import json
+
+EXPORT_FORMATS = {
+    'txt': 'text/plain',
+    'csv': 'text/csv',
+    'jsonl': 'application/x-ndjson'
+}
 
 
 def home(request):
@@ -77,8 +84,7 @@ def contentsView(request):
             owner = h5p_contents.objects.get(content_id=h5pGetContentId(request))
         except:
             raise Http404
-        h5pLoad(request)
-        content = includeH5p(request)
+        content = includeH5p(request, owner)
         score = None
 
         if not 'html' in content:
@@ -104,8 +110,10 @@ def listView(request):
         return render(request, 'h5p/listContents.html', {'status': 'You do not have the necessary rights to delete a video.'})
 
     listContent = h5pGetListContent(request)
-    if listContent > 0:
-        return render(request, 'h5p/listContents.html', {'listContent': listContent})
+    if listContent == None:
+        return HttpResponseBadRequest('Invalid page')
+    if listContent != 0:
+        return render(request, 'h5p/listContents.html', {'listContent': listContent['contents'], 'next': listContent['next']})
 
     return render(request, 'h5p/listContents.html', {'status': 'No contents installed.'})
 
@@ -137,18 +145,21 @@ def scoreView(request, contentId):
             return HttpResponseRedirect('/h5p/score/%s' % content.content_id, {'status': "%s's score has been reset !" % user.username})
 
         if 'download' in request.GET and request.user.is_superuser:
-            if request.GET['download'] == 'all':
-                scores = exportScore()
-                scores = ContentFile(scores)
-                response = HttpResponse(scores, 'text/plain')
-                response['Content-Length'] = scores.size
-                response['Content-Disposition'] = 'attachment; filename="h5pp_users_score.txt"'
+            exportFormat = request.GET.get('format', 'txt')
+            if exportFormat not in EXPORT_FORMATS:
+                exportFormat = 'txt'
+            # Checked before the response is streamed, its status is sent first
+            download = request.GET['download']
+            if download != 'all' and not download.isdigit():
+                return HttpResponseBadRequest('Invalid content id')
+            if download != 'all' and not h5p_contents.objects.filter(content_id=download).exists():
+                raise Http404
+            if download == 'all':
+                response = StreamingHttpResponse(exportScore(None, exportFormat), EXPORT_FORMATS[exportFormat])
+                response['Content-Disposition'] = 'attachment; filename="h5pp_users_score.%s"' % exportFormat
             else:
-                scores = exportScore(request.GET['download'])
-                scores = ContentFile(scores)
-                response = HttpResponse(scores, 'text/plain')
-                response['Content-Length'] = scores.size
-                response['Content-Disposition'] = 'attachment; filename="content_%s_users_score.txt"' % request.GET['download']
+                response = StreamingHttpResponse(exportScore(download, exportFormat), EXPORT_FORMATS[exportFormat])
+                response['Content-Disposition'] = 'attachment; filename="content_%s_users_score.%s"' % (download, exportFormat)
 
             return response
 
@@ -166,8 +177,11 @@ def scoreView(request, contentId):
 
 def embedView(request):
     if 'contentId' in request.GET:
-        h5pLoad(request)
-        embed = h5pEmbed(request)
+        try:
+            content = h5p_contents.objects.get(content_id=h5pGetContentId(request))
+        except:
+            raise Http404
+        embed = h5pEmbed(request, content)
         score = None
         if request.user.is_authenticated():
             h5pSetStarted(request.user, h5pGetContentId(request))
@@ -176,9 +190,25 @@ def embedView(request):
 
     return HttpResponseForbidden()
 
+def exportView(request, contentId):
+    export = h5pGetExportStream(request.user, contentId)
+    if export == None:
+        raise Http404
+    if export == False:
+        response = HttpResponse('The package is being prepared, try again shortly.', status=503)
+        response['Retry-After'] = '30'
+        return response
+
+    filename, chunks = export
+    response = StreamingHttpResponse(chunks, 'application/zip')
+    response['Content-Disposition'] = 'attachment; filename="%s"' % filename
+    return response
+
 @csrf_exempt
 def editorAjax(request, contentId):
     data = None
+    if 'chunk' in request.GET:
+        return editorUploadChunk(request)
     if request.method == 'POST':
         if 'libraries' in request.GET:
             framework = H5PDjango(request.user)
@@ -236,6 +266,79 @@ def editorAjax(request, contentId):
     )
 
 
+##
+# Receive a part of a chunked editor upload, or give the offset to resume
+# an upload from. Once the last part is received, the file is processed
+# like a regular upload.
+##
+
+
+def editorUploadChunk(request):
+    uploadId = request.POST.get('uploadId', request.GET.get('uploadId')) or None
+    isPart = request.method == 'POST' and 'file' in request.FILES
+    size = None
+    if isPart:
+        try:
+            offset = int(request.POST.get('offset', 0))
+            size = int(request.POST['size'])
+        except (KeyError, ValueError):
+            return uploadChunkResponse({'success': False, 'message': 'Invalid offset or size'}, 400)
+    elif uploadId == None:
+        # Only a part starts an upload
+        return uploadChunkResponse({'success': False, 'message': 'Missing upload id'}, 400)
+
+    if uploadId == None and not request.user.is_authenticated():
+        return uploadChunkResponse({'success': False, 'message': 'Login required'}, 403)
+
+    try:
+        upload = H5PChunkedUpload(request.user, uploadId, None, size)
+    except ValueError as e:
+        return uploadChunkResponse({'success': False, 'message': str(e)}, 404 if uploadId else 400)
+
+    result = {'uploadId': upload.uploadId, 'chunkSize': upload.chunkSize}
+    if isPart:
+        try:
+            offset = upload.appendPart(request.FILES['file'].chunks(), offset, request.POST.get('checksum'))
+        except ValueError as e:
+            result.update({'success': False, 'message': str(e), 'offset': upload.getOffset()})
+            return uploadChunkResponse(result, 409)
+
+        if upload.isComplete():
+            framework = H5PDjango(request.user)
+            assembled = upload.getFile(request.POST.get(
+                'name', 'file'), request.POST.get('type'))
+            try:
+                f = H5PEditorFile(request, {'file': assembled}, framework)
+                if not f.isLoaded():
+                    return HttpResponse(
+                        'File Not Found',
+                        content_type='application/json'
+                    )
+
+                if f.validate():
+                    core = framework.h5pGetInstance('core')
+                    core.fs.saveFile(f, request.POST['contentId'])
+                data = f.printResult()
+            finally:
+                assembled.close()
+                upload.cleanup()
+            return HttpResponse(
+                data,
+                content_type='application/json'
+            )
+
+    result['offset'] = upload.getOffset()
+    return uploadChunkResponse(result)
+
+
+def uploadChunkResponse(result, status=200):
+    return HttpResponse(
+        json.dumps(result),
+        content_type='application/json',
+        status=status
+    )
+
+
 @csrf_exempt
 def ajax(request):
     if request.method == 'POST':
@@ -253,6 +356,13 @@ def ajax(request):
                 content_type='application/json'
             )
 
+        elif 'batch' in request.GET:
+            data = h5pSaveBatch(request)
+            return HttpResponse(
+                data,
+                content_type='application/json'
+            )
+
     if 'content-user-data' in request.GET:
         data = handleContentUserData(request)
         return HttpResponse(